@@ -1,62 +1,122 @@
 # General imports
-from dotenv import load_dotenv
-from urllib.parse import quote_plus
-import os
-from pymongo import MongoClient
-import certifi
-from datetime import datetime
+from pymongo import ReturnDocument
+from datetime import datetime, timedelta
+from collections import OrderedDict
+from functools import lru_cache
 from bson.objectid import ObjectId
 
 # Discord-relative imports
 from discord import Embed
+from discord_slash import ComponentContext
 from discord_slash.model import ButtonStyle
 from discord_slash.utils.manage_components import create_actionrow, create_select, create_select_option, create_button
 
 # Local-relative imports
+from database import Database
 from session import Session
-from user import User
+from session_cache import upcoming_sessions
+from user import User, EQUIPMENT_FIELDS
 from exceptions import *
 from custom_emojis import CustomEmojis
 from equipment import Equipment
+from metrics import measure
+from reminders import session_reminders
 
 
-# Sensitive information are stored in .env file not present in the repository
-load_dotenv()
-USER = quote_plus(os.environ.get('SMASH_SESSION_DB_USER'))
-PASS = quote_plus(os.environ.get('SMASH_SESSION_DB_PASS'))
-SERVER = os.environ.get('SMASH_SESSION_DB_SERVER')
-DATABASE = os.environ.get('SMASH_SESSION_DB_DATABASE')
-BOT_TOKEN = os.environ.get('SMASH_SESSION_BOT_TOKEN')
+# Reference date to encode dates in custom ids
+EPOCH = datetime(1970, 1, 1)
 
-# Initialize database
-ca = certifi.where()
-db = MongoClient(f'mongodb+srv://{USER}:{PASS}@{SERVER}/{DATABASE}?retryWrites=true&w=majority', tlsCAFile=ca)[DATABASE]
+# Database, connected on its first use with the credentials of the environment
+db = Database()
 
+# Session details messages already rendered, by (session id, version, index), the most recently used last
+RENDER_CACHE_SIZE = 256
+rendered_sessions = OrderedDict()
 
-def get_session_list_message() -> (Embed, list):
+
+def get_list_custom_id(name: str, index: int, document: dict) -> str:
+    """
+    Build the custom id of a button of the session list message, which carries the index and the (date_start, _id) key
+    of the session the next or previous page is relative to.
+
+    :param name: The name of the callback of the button.
+    :param index: The index of the session the page is relative to.
+    :param document: The document of the session the page is relative to.
+    :return: The custom id, formatted as `<callback name>:<index>:<date_start in milliseconds>:<session id>`.
+    """
+    milliseconds = (document['date_start'] - EPOCH) // timedelta(milliseconds=1)
+    return f"{name}:{index}:{milliseconds}:{document['_id']}"
+
+
+def parse_list_custom_id(custom_id: str) -> (int, (datetime, ObjectId)):
+    """
+    Parse the custom id of a button of the session list message.
+
+    :param custom_id: The custom id, as built by `get_list_custom_id`.
+    :return: A tuple (int, (datetime, ObjectId)) representing respectively the index and the (date_start, _id) key of
+    the session the page is relative to.
     """
-    Find all the future sessions and return them as a list in an embed. Create also the appropriated dropdown menu to
-    show the details of a session.
+    _, index, milliseconds, session_id = custom_id.split(':')
+    return int(index), (EPOCH + timedelta(milliseconds=int(milliseconds)), ObjectId(session_id))
 
+
+async def get_session_list_message(cursor_index: int = 0, cursor: (datetime, ObjectId) = None,
+                                   backward: bool = False, guild_id: int = None) -> (Embed, list):
+    """
+    Find a page of the future sessions and return them as a list in an embed. Create also the appropriated dropdown
+    menu to show the details of a session, and the buttons to browse the other pages.
+
+    :param cursor_index: The index of the session the page is relative to, 0 for the first page.
+    :param cursor: The (date_start, _id) key of the session the page is relative to, None for the first page.
+    :param backward: True to get the page before the cursor, False to get the page after the cursor.
+    :param guild_id: The Discord id of the guild of the sessions.
     :return: A tuple (Embed, list of components) representing the bot message to be sent.
     """
-    # Get all the future sessions
-    future_sessions = Session.get_future_sessions(db)
+    # Get a page of the future sessions
+    page, has_more = await Session.get_future_sessions_page(db, cursor, backward, guild_id)
+
+    # The sessions around the cursor may have started or been deleted: show the first page instead
+    if len(page) == 0 and cursor is not None:
+        return await get_session_list_message(guild_id=guild_id)
 
     # Check if there is no session
-    if len(future_sessions) == 0:
+    if len(page) == 0:
         raise NoSessionAvailableError()
 
+    # Find the index of the first session of the page
+    if not backward:
+        first_index = cursor_index + 1
+    elif has_more:
+        first_index = cursor_index - len(page)
+    else:
+        first_index = 1
+    has_previous = has_more if backward else first_index > 1
+    has_next = True if backward else has_more
+
+    return render_session_list(page, first_index, has_previous, has_next)
+
+
+@measure('render')
+def render_session_list(page: list[dict], first_index: int, has_previous: bool, has_next: bool) -> (Embed, list):
+    """
+    Build the session list message from a page of the future sessions.
+
+    :param page: The projected documents of the sessions of the page.
+    :param first_index: The index of the first session of the page.
+    :param has_previous: True if there is a page before this one.
+    :param has_next: True if there is a page after this one.
+    :return: A tuple (Embed, list of components) representing the bot message to be sent.
+    """
     # Create embed
     embed = Embed(title="Sessions à venir")
     dropdown_options = []
-    for session in future_sessions:
-        embed.add_field(name=session.title,
-                        value=f"Hôte: <@{session.host.id}>\n"
-                              f"Participants: {session.nb_participants} / {session.places}",
+    for index, session in enumerate(page, start=first_index):
+        embed.add_field(name=Session.get_title(index, session['date_start'], session['date_end']),
+                        value=f"Hôte: <@{session['host']['id']}>\n"
+                              f"Participants: {session['nb_participants']} / {session['places']}",
                         inline=False)
-        dropdown_options.append(create_select_option(f"#{session.index}   Session chez {session.host.name}",
-                                                     value=str(session.index)))
+        dropdown_options.append(create_select_option(f"#{index}   Session chez {session['host']['name']}",
+                                                     value=str(session['_id'])))
 
     # Create dropdown
     dropdown = create_select(
@@ -66,24 +126,113 @@ def get_session_list_message() -> (Embed, list):
         max_values=1,
         custom_id='dropdown_select_session_callback'
     )
+    components = [create_actionrow(dropdown)]
+
+    # Create buttons to browse the pages
+    if has_previous or has_next:
+        last_index = first_index + len(page) - 1
+        components.append(create_actionrow(
+            create_button(style=ButtonStyle.grey, label="◀ Précédentes", disabled=not has_previous,
+                          custom_id=get_list_custom_id('btn_list_previous_callback', first_index, page[0])),
+            create_button(style=ButtonStyle.grey, label="Suivantes ▶", disabled=not has_next,
+                          custom_id=get_list_custom_id('btn_list_next_callback', last_index, page[-1]))
+        ))
 
     # Return embed and components
-    return embed, [create_actionrow(dropdown)]
+    return embed, components
+
+
+async def get_component_session(ctx: ComponentContext) -> Session:
+    """
+    Find the session a component of a session details message refers to, from the session id in its custom id.
+
+    :param ctx: The context of the component.
+    :return: A Session instance.
+    """
+    _, separator, session_id = ctx.custom_id.partition(':')
+
+    # Components sent before the session id was part of the custom id: find the session from the title of the embed
+    if not separator:
+        return await Session.from_index(db, Session.get_index_from_title(ctx.origin_message.embeds[0].title),
+                                        ctx.guild_id)
+
+    session = await Session.from_id(db, ObjectId(session_id), ctx.guild_id)
+    if session is None:
+        raise SessionNotFoundError()
+    return session
 
 
+async def get_selected_session(value: str, guild_id: int = None) -> Session:
+    """
+    Find the session selected in the dropdown of the session list message, from the session id in the option value.
+
+    :param value: The value of the selected option.
+    :param guild_id: The Discord id of the guild of the session.
+    :return: A Session instance.
+    """
+    # Options sent before the session id was the option value: the value is the index of the session
+    if not ObjectId.is_valid(value):
+        return await Session.from_index(db, int(value), guild_id)
+
+    session = await Session.from_id(db, ObjectId(value), guild_id)
+    if session is None:
+        raise SessionNotFoundError()
+    return session
+
+
+@lru_cache(maxsize=RENDER_CACHE_SIZE)
+def get_session_details_components(session_id: ObjectId) -> list:
+    """
+    Create the buttons to perform actions on a displayed session. They only depend on the session id, so they are
+    created once per session.
+
+    :param session_id: The database id of the session.
+    :return: The list of components of the session details message.
+    """
+    return [create_actionrow(
+        create_button(style=ButtonStyle.blurple, label="Je participe !",
+                      custom_id=f'btn_join_session_callback:{session_id}'),
+        create_button(style=ButtonStyle.red, label="Je me désinscris...",
+                      custom_id=f'btn_leave_session_callback:{session_id}')
+    ), create_actionrow(
+        create_button(emoji=CustomEmojis.switch_emoji, style=ButtonStyle.grey,
+                      label="J'apporte une console", custom_id=f'btn_bring_switch_callback:{session_id}'),
+        create_button(emoji=CustomEmojis.screen_emoji, style=ButtonStyle.grey,
+                      label="J'apporte un écran", custom_id=f'btn_bring_screen_callback:{session_id}'),
+        create_button(emoji=CustomEmojis.adapter_emoji, style=ButtonStyle.grey,
+                      label="J'apporte un adaptateur GC", custom_id=f'btn_bring_adapter_callback:{session_id}')
+    )]
+
+
+@measure('render')
 def get_session_details_message(session: Session) -> (Embed, list):
     """
     From a given session, return an embed of its details. Create also the appropriated buttons to perform actions based
     on the displayed session.
 
+    The messages are cached by state of the session, which changes with its version and its index in the list.
+
     :param session: The session to be detailed.
     :return: A tuple (Embed, list of components) representing the bot message to be sent.
     """
+    # Reuse the message rendered for the same state of the session
+    key = (session.id, session.version, session.index)
+    if key in rendered_sessions:
+        rendered_sessions.move_to_end(key)
+        return rendered_sessions[key]
+
     # Create embed
     embed = Embed(title=session.title)
     embed.add_field(name="Hôte", value=session.host.details)
     embed.add_field(name=f"Participants ({session.nb_participants} / {session.places})",
                     value=session.get_participants_details())
+    embed.add_field(name="Équipement",
+                    value=Session.get_equipment_summary(session.equipment, session.nb_participants + 1),
+                    inline=False)
+    if len(session.waitlist) > 0:
+        embed.add_field(name=f"Liste d'attente ({len(session.waitlist)})",
+                        value=session.get_waitlist_details(),
+                        inline=False)
     embed.add_field(name="Adresse",
                     value=session.address,
                     inline=False)
@@ -93,24 +242,151 @@ def get_session_details_message(session: Session) -> (Embed, list):
                         inline=False)
 
     # Create buttons
-    components = [create_actionrow(
-        create_button(style=ButtonStyle.blurple, label="Je participe !", custom_id='btn_join_session_callback'),
-        create_button(style=ButtonStyle.red, label="Je me désinscris...", custom_id='btn_leave_session_callback')
-    ), create_actionrow(
-        create_button(emoji=CustomEmojis.switch_emoji, style=ButtonStyle.grey,
-                      label="J'apporte une console", custom_id='btn_bring_switch_callback'),
-        create_button(emoji=CustomEmojis.screen_emoji, style=ButtonStyle.grey,
-                      label="J'apporte un écran", custom_id='btn_bring_screen_callback'),
-        create_button(emoji=CustomEmojis.adapter_emoji, style=ButtonStyle.grey,
-                      label="J'apporte un adaptateur GC", custom_id='btn_bring_adapter_callback')
-    )]
+    components = get_session_details_components(session.id)
+
+    # Keep the message for the next renders of the same state
+    rendered_sessions[key] = embed, components
+    if len(rendered_sessions) > RENDER_CACHE_SIZE:
+        rendered_sessions.popitem(last=False)
 
     # Return embed and components
     return embed, components
 
 
-def create_session(host: User, date_start: datetime, date_end: datetime, places: int,
-                   address: str, comment: str) -> Session:
+async def get_user_sessions_message(user: User, guild_id: int = None) -> (Embed, list):
+    """
+    Find the future sessions the given user hosts, participates in or waits for, and return them as a list in an
+    embed. Create also the appropriated dropdown menu to show the details of a session.
+
+    :param user: The user whose sessions are listed.
+    :param guild_id: The Discord id of the guild of the sessions.
+    :return: A tuple (Embed, list of components) representing the bot message to be sent.
+    """
+    documents = await Session.get_user_sessions(db, user.id, guild_id)
+    if len(documents) == 0:
+        raise NoUserSessionError()
+
+    # The index of each session is found in the session cache, since users refer to the sessions by index
+    indexes = [await upcoming_sessions.get_index(db, document) for document in documents]
+    return render_user_sessions(documents, indexes, user)
+
+
+@measure('render')
+def render_user_sessions(documents: list[dict], indexes: list[int], user: User) -> (Embed, list):
+    """
+    Build the message listing the sessions of a user.
+
+    :param documents: The projected documents of the sessions of the user.
+    :param indexes: The index of each session.
+    :param user: The user whose sessions are listed.
+    :return: A tuple (Embed, list of components) representing the bot message to be sent.
+    """
+    # Create embed
+    embed = Embed(title="Mes sessions à venir")
+    dropdown_options = []
+    for index, session in zip(indexes, documents):
+        waitlist = [waiting_user['id'] for waiting_user in session.get('waitlist', [])]
+        if session['host']['id'] == user.id:
+            role = "Hôte"
+        elif user.id in waitlist:
+            role = f"Liste d'attente (position {waitlist.index(user.id) + 1})"
+        else:
+            role = "Participant"
+        embed.add_field(name=Session.get_title(index, session['date_start'], session['date_end']),
+                        value=f"{role}\n"
+                              f"Participants: {session['nb_participants']} / {session['places']}",
+                        inline=False)
+        dropdown_options.append(create_select_option(f"#{index}   {role}", value=str(session['_id'])))
+
+    # Create dropdown
+    dropdown = create_select(
+        options=dropdown_options,
+        placeholder="Sélectionne une session pour afficher ses détails :",
+        min_values=1,
+        max_values=1,
+        custom_id='dropdown_select_session_callback'
+    )
+
+    # Return embed and components
+    return embed, [create_actionrow(dropdown)]
+
+
+async def get_equipment_message(guild_id: int = None) -> Embed:
+    """
+    Find the equipment summary of the next sessions of a guild and return them in an embed.
+
+    :param guild_id: The Discord id of the guild of the sessions.
+    :return: The embed representing the bot message to be sent.
+    """
+    # Get the summaries with a single aggregation
+    documents = await Session.get_future_sessions_equipment(db, guild_id)
+
+    # Check if there is no session
+    if len(documents) == 0:
+        raise NoSessionAvailableError()
+
+    return render_equipment(documents)
+
+
+@measure('render')
+def render_equipment(documents: list[dict]) -> Embed:
+    """
+    Build the equipment overview message from the summaries of the next sessions.
+
+    :param documents: The projected documents of the next sessions, sorted chronologically.
+    :return: The embed representing the bot message to be sent.
+    """
+    embed = Embed(title="Équipement des sessions à venir")
+    for index, session in enumerate(documents, start=1):
+        equipment = session.get('equipment') or {'consoles': 0, 'screens': 0, 'adapters': 0}
+        embed.add_field(name=Session.get_title(index, session['date_start'], session['date_end']),
+                        value=Session.get_equipment_summary(equipment, session['nb_players']),
+                        inline=False)
+    return embed
+
+
+async def backfill_equipment(guild_ids: list[int]):
+    """
+    Add the equipment summary to the upcoming sessions created before it existed, so that the updates of the actions
+    keep it up to date from there.
+
+    :param guild_ids: The Discord ids of the guilds whose sessions are backfilled, so that the query uses the index of
+    the upcoming sessions of a guild.
+    """
+    documents = await db['session'].find({
+        'guild_id': {'$in': guild_ids},
+        'date_start': {'$gt': datetime.now()},
+        'equipment': {'$exists': False}
+    }).to_list(length=None)
+    for document in documents:
+        await db['session'].update_one({
+            '_id': document['_id'],
+            'equipment': {'$exists': False}
+        }, {
+            '$set': {'equipment': Session.count_equipment(document)}
+        })
+
+
+async def backfill_guild(guild_id: int):
+    """
+    Move the sessions created before guilds were stored to the given guild, the community the bot served until then.
+
+    :param guild_id: The Discord id of the guild.
+    """
+    await db['session'].update_many({'guild_id': {'$exists': False}}, {'$set': {'guild_id': guild_id}})
+
+
+async def count_legacy_sessions() -> int:
+    """
+    Count the sessions created before guilds were stored, which belong to no guild until they are backfilled.
+
+    :return: The number of sessions without guild.
+    """
+    return await db['session'].count_documents({'guild_id': {'$exists': False}})
+
+
+async def create_session(host: User, date_start: datetime, date_end: datetime, places: int,
+                         address: str, comment: str, guild_id: int = None) -> Session:
     """
     Add to the database a new session hosted by the given user and with the given details.
 
@@ -120,14 +396,33 @@ def create_session(host: User, date_start: datetime, date_end: datetime, places:
     :param places: The number of places available for the session.
     :param address: The address of the session.
     :param comment: An extra comment about the session.
+    :param guild_id: The Discord id of the guild of the session.
     :return: A Session instance corresponding to the created session.
     """
+    return await create_sessions(host, [(date_start, date_end)], places, address, comment, guild_id)
+
+
+async def create_sessions(host: User, dates: list[(datetime, datetime)], places: int,
+                          address: str, comment: str, guild_id: int = None) -> Session:
+    """
+    Add to the database new sessions hosted by the given user at the given dates and with the same details, with a
+    single insert.
+
+    :param host: The User who hosts the sessions.
+    :param dates: The (date_start, date_end) tuples of the sessions, sorted chronologically.
+    :param places: The number of places available for the sessions.
+    :param address: The address of the sessions.
+    :param comment: An extra comment about the sessions.
+    :param guild_id: The Discord id of the guild of the sessions.
+    :return: A Session instance corresponding to the first created session.
+    """
     # Places
     if places < 0:
         raise ValueError("Tu ne peux pas avoir un nombre négatif de places chez toi ! :sweat_smile:")
 
     # Insert in database
-    inserted_id = db['session'].insert_one({
+    documents = [{
+        'guild_id': guild_id,
         'host': {
             'id': host.id,
             'name': host.name,
@@ -141,119 +436,237 @@ def create_session(host: User, date_start: datetime, date_end: datetime, places:
         'places': places,
         'address': address,
         'comment': comment,
-        'participants': []
-    }).inserted_id
+        'participants': [],
+        'equipment': {'consoles': 0, 'screens': 0, 'adapters': 0},
+        'version': 0
+    } for date_start, date_end in dates]
+    await db['session'].insert_many(documents)
+
+    # Keep the cache of the upcoming sessions and their reminders in sync
+    for document in documents:
+        upcoming_sessions.put(document)
+        session_reminders.schedule(document)
 
-    # Get the session instance of the created session
-    return Session.from_id(db, inserted_id)
+    # Get the session instance of the first created session, unless it was deleted or started in the meantime
+    session = await Session.from_id(db, documents[0]['_id'], guild_id)
+    if session is None:
+        raise SessionNotFoundError()
+    return session
 
 
-def update_session(session: Session, places: int, address: str, comment: str):
+async def update_session(session: Session, places: int, address: str, comment: str) -> (Session, list[User]):
     """
     Update the session wit the specified details.
 
+    When places are added, the first users of the waitlist take them in the same update, on condition that the session
+    did not change in the meantime.
+
     :param session: The session to update.
     :param places: The number of places available for the session.
     :param address: The address of the session.
     :param comment: An extra comment about the session.
-    :return:
+    :return: A tuple (Session, list of users) representing respectively the updated state of the session and the users
+    promoted from the waitlist to the participants.
     """
-    # Update session and prepare fields to update
-    fields = {}
-    if places is not None:
-        session.places = places
-        fields['places'] = places
-    if address is not None:
-        session.address = address
-        fields['address'] = address
-    if comment is not None:
-        session.comment = comment
-        fields['comment'] = comment
+    while True:
+        # Update session and prepare fields to update
+        fields = {}
+        if places is not None:
+            session.places = places
+            fields['places'] = places
+        if address is not None:
+            session.address = address
+            fields['address'] = address
+        if comment is not None:
+            session.comment = comment
+            fields['comment'] = comment
+
+        # Give the new places to the first waiting users
+        promoted = session.waitlist[:max(session.places - session.nb_participants, 0)]
+        if len(promoted) == 0:
+            query = {'_id': session.id}
+            # Nobody may have joined the waitlist in the meantime, or they would miss the free places
+            if session.places > session.nb_participants:
+                query['waitlist.0'] = {'$exists': False}
+            update = {'$set': fields, '$inc': {'version': 1}}
+        else:
+            query = {'_id': session.id, 'version': session.version}
+            update = {
+                '$set': {**fields, 'waitlist': [user.data for user in session.waitlist[len(promoted):]]},
+                '$push': {'participants': {'$each': [user.data for user in promoted]}},
+                '$inc': {'equipment.consoles': sum(user.consoles for user in promoted),
+                         'equipment.screens': sum(user.screens for user in promoted),
+                         'equipment.adapters': sum(user.adapters for user in promoted), 'version': 1}
+            }
 
-    # Update database
-    db['session'].update_one({
-        '_id': session.id
-    }, {
-        '$set': fields
-    })
+        # Update database
+        data = await db['session'].find_one_and_update(query, update, return_document=ReturnDocument.AFTER)
+        if data is not None:
+            upcoming_sessions.put(data)
+            session_reminders.schedule(data)
+            return Session(data, session.index), promoted
+
+        # The session changed in the meantime: check again against its current state
+        session = await reload_session(session)
 
 
-def join_session(session: Session, joining_user: User):
+async def reload_session(session: Session) -> Session:
     """
-    Add the given user to the list of participants of the given session with the specified equipment.
+    Get the current state of the given session from the database, after a conditional update was refused because the
+    session changed in the meantime.
+
+    :param session: The outdated session.
+    :return: A Session instance with the current state of the session.
+    """
+    data = await db['session'].find_one({'_id': session.id})
+    if data is None:
+        upcoming_sessions.remove(session.id)
+        raise SessionNotFoundError()
+    upcoming_sessions.put(data)
+    return Session(data, session.index)
+
+
+async def join_session(session: Session, joining_user: User) -> Session:
+    """
+    Add the given user to the list of participants of the given session with the specified equipment. If the session is
+    full, the user is added at the end of its waitlist instead.
+
+    The participant is pushed with a single conditional update, so that concurrent joins can neither exceed the number
+    of places nor add the same user twice.
 
     :param session: The session to join.
     :param joining_user: The user who wants to join the session.
+    :return: A Session instance with the updated state of the session.
     """
-    # Join session
-    session.add_participant(joining_user)
+    while True:
+        # Check the known state of the session to fail without a round trip
+        try:
+            session.add_participant(joining_user)
+            full = False
+        except SessionIsFullError:
+            session.add_waiting_user(joining_user)
+            full = True
 
-    # Update database
-    db['session'].update_one({
-        '_id': session.id
-    }, {
-        '$set': {
-            'participants': [user.data for user in session.participants]
+        # Update database
+        query = {
+            '_id': session.id,
+            'host.id': {'$ne': joining_user.id},
+            'participants.id': {'$ne': joining_user.id},
+            'waitlist.id': {'$ne': joining_user.id}
         }
-    })
+        if full:
+            query['$expr'] = {'$gte': [{'$size': '$participants'}, '$places']}
+            update = {'$push': {'waitlist': joining_user.data}, '$inc': {'version': 1}}
+        else:
+            query['$expr'] = {'$lt': [{'$size': '$participants'}, '$places']}
+            update = {
+                '$push': {'participants': joining_user.data},
+                '$inc': {'equipment.consoles': joining_user.consoles, 'equipment.screens': joining_user.screens,
+                         'equipment.adapters': joining_user.adapters, 'version': 1}
+            }
+        data = await db['session'].find_one_and_update(query, update, return_document=ReturnDocument.AFTER)
+        if data is not None:
+            upcoming_sessions.put(data)
+            return Session(data, session.index)
+
+        # The session changed in the meantime: check again against its current state
+        session = await reload_session(session)
 
 
-def leave_session(session: Session, leaving_user: User):
+async def leave_session(session: Session, leaving_user: User) -> (Session, list[User]):
     """
-    Remove the given user from the list of participants of the given session if he participates in it.
+    Remove the given user from the list of participants of the given session if they participate in it, or from its
+    waitlist if they wait for a place.
+
+    The place left by a participant is given to the first user of the waitlist in the same update, so that a join can
+    never take it in the meantime.
 
     :param session: The session to leave.
     :param leaving_user: The user who wants to leave the session.
+    :return: A tuple (Session, list of users) representing respectively the updated state of the session and the users
+    promoted from the waitlist to the participants.
     """
-    # Leave session
-    session.remove_participant(leaving_user)
+    while True:
+        # Check the known state of the session to fail without a round trip, and prepare the conditional update
+        if session.is_waiting(leaving_user):
+            session.remove_waiting_user(leaving_user)
+            promoted = []
+            query = {'_id': session.id, 'waitlist.id': leaving_user.id}
+            update = {'$pull': {'waitlist': {'id': leaving_user.id}}, '$inc': {'version': 1}}
+        else:
+            participant = session.get_participant(leaving_user)
+            participants = [user.id for user in session.participants]
+            session.remove_participant(leaving_user)
+
+            # The participant must still bring the equipment removed from the summary, and nobody may have joined the
+            # waitlist in the meantime, or they would miss the place left
+            if len(session.waitlist) == 0:
+                promoted = []
+                query = {'_id': session.id,
+                         'participants': {'$elemMatch': {'id': leaving_user.id, 'consoles': participant.consoles,
+                                                         'screens': participant.screens,
+                                                         'adapters': participant.adapters}},
+                         'waitlist.0': {'$exists': False}}
+                update = {'$pull': {'participants': {'id': leaving_user.id}}}
+            else:
+                # The first waiting user takes the position of the participant
+                promoted = session.waitlist[:1]
+                position = participants.index(leaving_user.id)
+                query = {'_id': session.id, f'participants.{position}.id': leaving_user.id,
+                         f'participants.{position}.consoles': participant.consoles,
+                         f'participants.{position}.screens': participant.screens,
+                         f'participants.{position}.adapters': participant.adapters,
+                         'waitlist.0.id': promoted[0].id}
+                update = {'$set': {f'participants.{position}': promoted[0].data}, '$pop': {'waitlist': -1}}
+            update['$inc'] = {
+                'equipment.consoles': sum(user.consoles for user in promoted) - participant.consoles,
+                'equipment.screens': sum(user.screens for user in promoted) - participant.screens,
+                'equipment.adapters': sum(user.adapters for user in promoted) - participant.adapters,
+                'version': 1
+            }
 
-    # Update database
-    db['session'].update_one({
-        '_id': session.id
-    }, {
-        '$set': {
-            'participants': [user.data for user in session.participants]
-        }
-    })
+        # Update database
+        data = await db['session'].find_one_and_update(query, update, return_document=ReturnDocument.AFTER)
+        if data is not None:
+            upcoming_sessions.put(data)
+            return Session(data, session.index), promoted
+
+        # The session changed in the meantime: check again against its current state
+        session = await reload_session(session)
 
 
-def bring_equipment(session: Session, user: User, equipment: Equipment):
+async def bring_equipment(session: Session, user: User, equipment: Equipment) -> Session:
     """
     Update the equipment brought by the given user to the given session.
 
     :param session: The session the user participates in.
     :param user: The user to be updated.
     :param equipment: The kind of equipment the user brings.
+    :return: A Session instance with the updated state of the session.
     """
-    if session.is_host(user):
-        # Update user's equipment
-        session.host.add_equipment(equipment)
-
-        # Update database
-        db['session'].update_one({
-            '_id': session.id
-        }, {
-            '$set': {
-                'host': session.host.data
-            }
-        })
-
-    elif session.is_participant(user):
-        # Update user's equipment
-        for participant in session.participants:
-            if participant.id == user.id:
-                participant.add_equipment(equipment)
+    field, maximum = EQUIPMENT_FIELDS[equipment]
+
+    while True:
+        # Check the known state of the session to fail without a round trip, and prepare the conditional update
+        if session.is_host(user):
+            session.host.add_equipment(equipment)
+            query = {'_id': session.id, 'host.id': user.id, f'host.{field}': {'$lt': maximum}}
+            update = {'$inc': {f'host.{field}': 1, f'equipment.{field}': 1, 'version': 1}}
+        elif session.is_participant(user):
+            # The position of the participant is part of the condition, in case the participants changed meanwhile
+            position = [participant.id for participant in session.participants].index(user.id)
+            session.participants[position].add_equipment(equipment)
+            query = {'_id': session.id, f'participants.{position}.id': user.id,
+                     f'participants.{position}.{field}': {'$lt': maximum}}
+            update = {'$inc': {f'participants.{position}.{field}': 1, f'equipment.{field}': 1, 'version': 1}}
+        else:
+            raise UserIsNotParticipantError()
 
         # Update database
-        db['session'].update_one({
-            '_id': session.id
-        }, {
-            '$set': {
-                'participants': [participant.data for participant in session.participants]
-            }
-        })
-
-    else:
-        raise UserIsNotParticipantError()
+        data = await db['session'].find_one_and_update(query, update, return_document=ReturnDocument.AFTER)
+        if data is not None:
+            upcoming_sessions.put(data)
+            return Session(data, session.index)
 
+        # The session changed in the meantime: check again against its current state
+        session = await reload_session(session)
@@ -0,0 +1,273 @@
+#############
+#  IMPORTS  #
+#############
+# General imports
+import argparse
+import asyncio
+import json
+import random
+import subprocess
+import time
+from datetime import datetime, timedelta
+from statistics import quantiles
+from types import SimpleNamespace
+from dotenv import load_dotenv
+
+# Local imports
+from main import slash, list_sessions, show, join
+from actions import db, create_session
+from database import connect_in_memory
+from session_cache import upcoming_sessions
+from user import User
+
+
+###############
+#  CONSTANTS  #
+###############
+HEARTBEAT_INTERVAL = 0.01
+DEFAULT_MIX = 'list=1,show=2,join_click=4,equipment_click=3'
+EQUIPMENT_CALLBACKS = ['btn_bring_switch_callback', 'btn_bring_screen_callback', 'btn_bring_adapter_callback']
+
+
+class FakeContext:
+    ##################
+    #  CONSTRUCTORS  #
+    ##################
+    def __init__(self, user_id: int, latency: float, custom_id: str = None, origin_message_id: int = None):
+        """
+        Instantiate a FakeContext object, which stands for a SlashContext or a ComponentContext and simulates the
+        latency of the Discord API on every response.
+
+        :param user_id: The Discord id of the author of the interaction.
+        :param latency: The number of seconds a response to Discord takes.
+        :param custom_id: The custom id of the clicked component, for component interactions.
+        :param origin_message_id: The Discord id of the message of the clicked component.
+        """
+        self.author = SimpleNamespace(id=user_id, name=f'user{user_id}', discriminator='0000')
+        self.custom_id = custom_id
+        self.component_type = 2
+        self.selected_options = None
+        self.origin_message = None
+        self.origin_message_id = origin_message_id
+        self.guild_id = None
+        self._latency = latency
+
+    #############
+    #  METHODS  #
+    #############
+    async def send(self, content: str = None, **kwargs):
+        await asyncio.sleep(self._latency)
+
+    async def edit_origin(self, **kwargs):
+        await asyncio.sleep(self._latency)
+
+    async def defer(self, **kwargs):
+        await asyncio.sleep(self._latency)
+
+
+async def invoke(command, ctx: FakeContext, **kwargs) -> bool:
+    """
+    Invoke a slash command or a component callback, and answer its errors the same way the bot does.
+
+    :param command: The command or component callback object registered by the bot.
+    :param ctx: The context of the interaction.
+    :param kwargs: The options of the slash command.
+    :return: True if the interaction succeeded, False if it was answered with an error.
+    """
+    try:
+        await command.invoke(ctx, **kwargs)
+        return True
+    except Exception as exception:
+        await ctx.send(str(exception), hidden=True)
+        return False
+
+
+async def click(ctx: FakeContext) -> bool:
+    """
+    Route a component interaction to its callback, the same way `on_component` does.
+
+    :param ctx: The context of the interaction.
+    :return: True if the interaction succeeded, False if it was answered with an error.
+    """
+    name = ctx.custom_id.partition(':')[0]
+    return await invoke(slash.get_component_callback(custom_id=name, component_type=ctx.component_type), ctx)
+
+
+def simulate_interaction(kind: str, sessions: list, users: int, latency: float):
+    """
+    Build an interaction of the given kind, by a random user on a random session.
+
+    :param kind: The kind of interaction: list, show, join, join_click or equipment_click.
+    :param sessions: The sessions which can be interacted with.
+    :param users: The number of distinct users.
+    :param latency: The number of seconds a response to Discord takes.
+    :return: The coroutine performing the interaction.
+    """
+    session = random.choice(sessions)
+    user_id = random.randrange(users)
+    if kind == 'list':
+        return invoke(list_sessions, FakeContext(user_id, latency))
+    if kind == 'show':
+        return invoke(show, FakeContext(user_id, latency), n=random.randint(1, len(sessions)))
+    if kind == 'join':
+        return invoke(join, FakeContext(user_id, latency), n=random.randint(1, len(sessions)))
+    if kind == 'join_click':
+        return click(FakeContext(user_id, latency, f'btn_join_session_callback:{session.id}', session.index))
+    if kind == 'equipment_click':
+        return click(FakeContext(user_id, latency, f'{random.choice(EQUIPMENT_CALLBACKS)}:{session.id}',
+                                 session.index))
+    raise ValueError(f"Unknown kind of interaction: {kind}")
+
+
+async def seed(sessions: int) -> list:
+    """
+    Create the given number of upcoming sessions, each one hosted by a different user.
+
+    :param sessions: The number of sessions to create.
+    :return: The list of the created sessions.
+    """
+    now = datetime.now()
+    created = []
+    for n in range(sessions):
+        host = User({'id': -n - 1, 'name': f'host{n}', 'discriminator': '0000', 'consoles': 1, 'screens': 1,
+                     'adapters': 0})
+        created.append(await create_session(host, now + timedelta(hours=n + 1), now + timedelta(hours=n + 5),
+                                            random.randint(4, 12), None, None))
+    return created
+
+
+async def heartbeat(stop: asyncio.Event) -> float:
+    """
+    Tick at a fixed interval until stopped and measure how late the event loop wakes up.
+
+    :param stop: The event which stops the heartbeat.
+    :return: The maximum lag of the event loop, in seconds.
+    """
+    max_lag = 0.
+    while not stop.is_set():
+        expected = time.perf_counter() + HEARTBEAT_INTERVAL
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+        max_lag = max(max_lag, time.perf_counter() - expected)
+    return max_lag
+
+
+async def run(kinds: list, sessions: list, users: int, concurrency: int, latency: float) -> (list, int):
+    """
+    Replay the given interactions with at most `concurrency` of them in flight at the same time.
+
+    :param kinds: The kinds of the interactions to replay.
+    :param sessions: The sessions which can be interacted with.
+    :param users: The number of distinct users.
+    :param concurrency: The maximum number of interactions in flight.
+    :param latency: The number of seconds a response to Discord takes.
+    :return: A tuple (list, int) representing respectively the latency of every interaction, in seconds, and the
+    number of interactions answered with an error.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def measure(kind: str):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            succeeded = await simulate_interaction(kind, sessions, users, latency)
+            latencies.append(time.perf_counter() - start)
+            errors += not succeeded
+
+    await asyncio.gather(*[measure(kind) for kind in kinds])
+    return latencies, errors
+
+
+def get_commit() -> str:
+    """
+    Returns the hash of the current git commit, so that results of different versions can be compared.
+
+    :return: The short commit hash, or None if it is not available.
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def main(args: argparse.Namespace) -> dict:
+    """
+    Seed the database, then replay an interaction storm against the command handlers and measure it.
+
+    :param args: The command line arguments.
+    :return: The results of the benchmark.
+    """
+    random.seed(args.seed)
+    if not args.configured_backend:
+        db.use(connect_in_memory())
+    await upcoming_sessions.load(db)
+    sessions = await seed(args.sessions)
+
+    # Draw the interactions according to the mix
+    mix = {kind: float(weight) for kind, weight in (item.split('=') for item in args.mix.split(','))}
+    kinds = random.choices(list(mix), weights=list(mix.values()), k=args.interactions)
+
+    # Replay the storm
+    operations = sum(db.operations.values())
+    hits, misses = upcoming_sessions.hits, upcoming_sessions.misses
+    stop = asyncio.Event()
+    lag = asyncio.create_task(heartbeat(stop))
+    start = time.perf_counter()
+    latencies, errors = await run(kinds, sessions, args.users, args.concurrency, args.discord_latency / 1000)
+    elapsed = time.perf_counter() - start
+    stop.set()
+
+    percentiles = quantiles(latencies, n=100, method='inclusive')
+    return {
+        'commit': get_commit(),
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'config': {
+            'interactions': args.interactions,
+            'concurrency': args.concurrency,
+            'sessions': args.sessions,
+            'users': args.users,
+            'mix': mix,
+            'discord_latency_ms': args.discord_latency,
+            'backend': 'configured' if args.configured_backend else 'memory'
+        },
+        'latency_ms': {
+            'p50': percentiles[49] * 1000,
+            'p95': percentiles[94] * 1000,
+            'p99': percentiles[98] * 1000,
+            'max': max(latencies) * 1000
+        },
+        'throughput': len(latencies) / elapsed,
+        'errors': errors,
+        'db_operations_per_interaction': (sum(db.operations.values()) - operations) / len(latencies),
+        'cache_hits': upcoming_sessions.hits - hits,
+        'cache_misses': upcoming_sessions.misses - misses,
+        'max_event_loop_lag_ms': await lag * 1000
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay a storm of interactions against the command handlers.")
+    parser.add_argument('-n', '--interactions', type=int, default=1000, help="The number of interactions to replay.")
+    parser.add_argument('-c', '--concurrency', type=int, default=50,
+                        help="The maximum number of interactions in flight at the same time.")
+    parser.add_argument('--sessions', type=int, default=30, help="The number of upcoming sessions to create.")
+    parser.add_argument('--users', type=int, default=200, help="The number of distinct users.")
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help="The weights of the kinds of interactions: list, show, join, join_click, equipment_click.")
+    parser.add_argument('--discord-latency', type=float, default=0,
+                        help="The simulated latency of every response to Discord, in milliseconds.")
+    parser.add_argument('--configured-backend', action='store_true',
+                        help="Run against the backend selected by the environment instead of an in-memory database. "
+                             "The sessions created by the benchmark are not deleted.")
+    parser.add_argument('--seed', type=int, default=0, help="The seed of the random generator.")
+    parser.add_argument('-o', '--output', help="The JSON file where the results are saved.")
+    args = parser.parse_args()
+
+    load_dotenv()
+    results = asyncio.run(main(args))
+    print(json.dumps(results, indent=2))
+    if args.output is not None:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
@@ -0,0 +1,230 @@
+#############
+#  IMPORTS  #
+#############
+# General imports
+import argparse
+import json
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from bson.objectid import ObjectId
+from typing import Union
+
+# Local imports
+from session import Session
+from user import MAX_CONSOLES, MAX_SCREENS, MAX_ADAPTERS
+from exceptions import TooManyEquipmentError
+
+
+class CopyingUser:
+    ##################
+    #  CONSTRUCTORS  #
+    ##################
+    def __init__(self, data: dict):
+        """
+        Instantiate a CopyingUser object, a user copying every field of its document, as the models did before they
+        wrapped the documents of the session cache.
+
+        :param data: The user data retrieved from the database.
+        """
+        self._id = data['id']
+        self._name = data['name']
+        self._discriminator = data['discriminator']
+        self._consoles = data['consoles']
+        self._screens = data['screens']
+        self._adapters = data['adapters']
+
+        # Check if any equipment is negative or too high
+        if min(self._consoles, self._screens, self._adapters) < 0:
+            raise ValueError("Tu ne peux pas apporter un nombre négatif d'équipement... :sweat_smile:")
+        if self._consoles > MAX_CONSOLES or self._screens > MAX_SCREENS or self._adapters > MAX_ADAPTERS:
+            raise TooManyEquipmentError()
+
+    ################
+    #  PROPERTIES  #
+    ################
+    @property
+    def id(self) -> int:
+        """
+        Getter for id.
+
+        :return: The id attribute.
+        """
+        return self._id
+
+    @property
+    def data(self) -> dict:
+        """
+        Rebuild the document of the user from its fields.
+
+        :return: The user document.
+        """
+        return {
+            'id': self._id,
+            'name': self._name,
+            'discriminator': self._discriminator,
+            'consoles': self._consoles,
+            'screens': self._screens,
+            'adapters': self._adapters
+        }
+
+
+class CopyingSession:
+    ##################
+    #  CONSTRUCTORS  #
+    ##################
+    def __init__(self, data: dict, index: int):
+        """
+        Instantiate a CopyingSession object, a session copying every field of its document and wrapping its host and
+        participants at once, as the models did before they wrapped the documents of the session cache.
+
+        :param data: The session data retrieved from the database.
+        :param index: The index of the session in the list of the next sessions.
+        """
+        self._index = index
+        self._id = ObjectId(str(data['_id']))
+        self._date_start = data['date_start']
+        self._date_end = data['date_end']
+        self._places = data['places']
+        self._address = data['address']
+        self._comment = data['comment']
+        self._host = CopyingUser(data['host'])
+        self._participants = [CopyingUser(user) for user in data['participants']]
+        self._version = data.get('version', 0)
+
+    #############
+    #  METHODS  #
+    #############
+    def is_host(self, user: CopyingUser) -> bool:
+        """
+        Check if the user is the host of the session.
+
+        :param user: The user to look for.
+        :return: True if the user is the host of the session, False otherwise.
+        """
+        return self._host.id == user.id
+
+    ################
+    #  PROPERTIES  #
+    ################
+    @property
+    def host(self) -> CopyingUser:
+        """
+        Getter for host.
+
+        :return: The host attribute.
+        """
+        return self._host
+
+    @property
+    def participants(self) -> list[CopyingUser]:
+        """
+        Getter for participants.
+
+        :return: The participants attribute.
+        """
+        return self._participants
+
+
+###############
+#  CONSTANTS  #
+###############
+# Models compared by the benchmark, the copying one being the baseline
+MODELS = {
+    'copying': CopyingSession,
+    'slotted': Session
+}
+
+
+def get_document(n: int, participants: int) -> dict:
+    """
+    Build a session document as stored in the database and in the session cache.
+
+    :param n: The number of the session, to spread their dates.
+    :param participants: The number of participants of the session.
+    :return: The session document.
+    """
+    date_start = datetime.now() + timedelta(hours=n + 1)
+    return {
+        '_id': ObjectId(),
+        'host': {'id': 10 ** 17 + n, 'name': f'host{n}', 'discriminator': '0000', 'consoles': 1, 'screens': 1,
+                 'adapters': 0},
+        'date_start': date_start,
+        'date_end': date_start + timedelta(hours=4),
+        'places': participants + 2,
+        'address': "Quelque part",
+        'comment': None,
+        'participants': [{'id': 10 ** 17 + p, 'name': f'user{p}', 'discriminator': '0000', 'consoles': 0,
+                          'screens': 0, 'adapters': p % 2} for p in range(participants)],
+        'version': 0
+    }
+
+
+def use(session: Union[Session, CopyingSession]) -> int:
+    """
+    Use a session the way the actions do: check its host and participants, then serialize the participants.
+
+    :param session: The session.
+    :return: The number of serialized participants.
+    """
+    session.is_host(session.host)
+    return len([participant.data for participant in session.participants])
+
+
+def measure(model: type, documents: list[dict], rounds: int) -> dict:
+    """
+    Measure the memory held by the models of the cached sessions, and the time to build and use them.
+
+    :param model: The class of the session models.
+    :param documents: The session documents the models are built from.
+    :param rounds: The number of times the models are rebuilt to measure the time.
+    :return: The results of the model.
+    """
+    # Memory held by the models, on top of the documents they are built from
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    models = [model(document, n + 1) for n, document in enumerate(documents)]
+    for session in models:
+        use(session)
+    after, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # Time to build and use the models, as every interaction does
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for n, document in enumerate(documents):
+            use(model(document, n + 1))
+    elapsed = time.perf_counter() - start
+
+    return {
+        'bytes_per_session': (after - before) / len(documents),
+        'peak_bytes_per_session': (peak - before) / len(documents),
+        'microseconds_per_session': elapsed / (rounds * len(documents)) * 10 ** 6
+    }
+
+
+def main(sessions: int, participants: int, rounds: int) -> dict:
+    """
+    Compare the memory and time cost of the session models, from the same session documents.
+
+    :param sessions: The number of sessions.
+    :param participants: The number of participants of each session.
+    :param rounds: The number of times the models are rebuilt to measure the time.
+    :return: The results of the benchmark, by model.
+    """
+    documents = [get_document(n, participants) for n in range(sessions)]
+    return {
+        'sessions': sessions,
+        'participants': participants,
+        **{name: measure(model, documents, rounds) for name, model in MODELS.items()}
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure the memory and time cost of the session models.")
+    parser.add_argument('--sessions', type=int, default=500, help="The number of cached sessions.")
+    parser.add_argument('--participants', type=int, default=8, help="The number of participants of each session.")
+    parser.add_argument('--rounds', type=int, default=20, help="The number of times the models are rebuilt.")
+    args = parser.parse_args()
+
+    print(json.dumps(main(args.sessions, args.participants, args.rounds), indent=2))
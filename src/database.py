@@ -0,0 +1,215 @@
+#############
+#  IMPORTS  #
+#############
+# General imports
+import asyncio
+import inspect
+import os
+from collections import Counter
+from typing import Callable
+from urllib.parse import quote_plus
+import certifi
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+
+# Local imports
+from metrics import measure, count_operation
+
+
+###############
+#  CONSTANTS  #
+###############
+# Collection methods which send a request to the database
+OPERATIONS = {
+    'aggregate', 'bulk_write', 'count_documents', 'create_index', 'create_indexes', 'delete_many', 'delete_one', 'find',
+    'find_one', 'find_one_and_delete', 'find_one_and_replace', 'find_one_and_update', 'insert_many', 'insert_one',
+    'replace_one', 'update_many', 'update_one', 'watch'
+}
+
+
+def connect_to_atlas() -> AsyncIOMotorDatabase:
+    """
+    Open a connection to the MongoDB Atlas database described by the environment variables.
+
+    The pool size and timeouts can be tuned with SMASH_SESSION_DB_MAX_POOL_SIZE, SMASH_SESSION_DB_CONNECT_TIMEOUT_MS
+    and SMASH_SESSION_DB_SERVER_SELECTION_TIMEOUT_MS.
+
+    :return: The MongoDB database instance.
+    """
+    user = quote_plus(os.environ['SMASH_SESSION_DB_USER'])
+    password = quote_plus(os.environ['SMASH_SESSION_DB_PASS'])
+    server = os.environ['SMASH_SESSION_DB_SERVER']
+    database = os.environ['SMASH_SESSION_DB_DATABASE']
+
+    client = AsyncIOMotorClient(
+        f'mongodb+srv://{user}:{password}@{server}/{database}?retryWrites=true&w=majority',
+        tlsCAFile=certifi.where(),
+        maxPoolSize=int(os.environ.get('SMASH_SESSION_DB_MAX_POOL_SIZE', 10)),
+        connectTimeoutMS=int(os.environ.get('SMASH_SESSION_DB_CONNECT_TIMEOUT_MS', 5000)),
+        serverSelectionTimeoutMS=int(os.environ.get('SMASH_SESSION_DB_SERVER_SELECTION_TIMEOUT_MS', 5000))
+    )
+    return client[database]
+
+
+def connect_in_memory() -> AsyncIOMotorDatabase:
+    """
+    Create an in-memory stand-in of the database, which lives as long as the process. Useful to run the bot, the tests
+    and the benchmarks offline.
+
+    :return: The in-memory database instance.
+    """
+    # Optional dependency from requirements-dev.txt, only needed to run without a MongoDB server
+    from mongomock_motor import AsyncMongoMockClient
+
+    return AsyncMongoMockClient()['smash-session']
+
+
+# Storage backends, selected with SMASH_SESSION_DB_BACKEND
+BACKENDS = {
+    'atlas': connect_to_atlas,
+    'memory': connect_in_memory
+}
+
+
+def connect_from_environment() -> AsyncIOMotorDatabase:
+    """
+    Open a connection to the storage backend selected by the environment, MongoDB Atlas by default.
+
+    :return: The MongoDB database instance.
+    """
+    return BACKENDS[os.environ.get('SMASH_SESSION_DB_BACKEND', 'atlas')]()
+
+
+class Database:
+    ##################
+    #  CONSTRUCTORS  #
+    ##################
+    def __init__(self, connect: Callable[[], AsyncIOMotorDatabase] = connect_from_environment):
+        """
+        Instantiate a Database object, which connects to the database the first time it is used.
+
+        Collections are accessed the same way as on a Motor database, e.g. `db['session']`.
+
+        :param connect: The function which opens the connection and returns the MongoDB database instance.
+        """
+        self._connect = connect
+        self._database = None
+        self.operations = Counter()
+
+    #############
+    #  METHODS  #
+    #############
+    async def connect(self):
+        """
+        Open the connection ahead of its first use, without blocking the event loop on the DNS resolution of the
+        server.
+        """
+        if self._database is None:
+            database = await asyncio.get_event_loop().run_in_executor(None, self._connect)
+            if self._database is None:
+                self._database = database
+
+    def use(self, database: AsyncIOMotorDatabase):
+        """
+        Replace the connection by the given database instance, e.g. to run against another server in tests.
+
+        :param database: The MongoDB database instance to use.
+        """
+        self._database = database
+
+    ################
+    #  PROPERTIES  #
+    ################
+    @property
+    def database(self) -> AsyncIOMotorDatabase:
+        """
+        Returns the MongoDB database instance, connecting to it if it is the first use.
+
+        :return: The MongoDB database instance.
+        """
+        if self._database is None:
+            self._database = self._connect()
+        return self._database
+
+    ######################
+    #  SPECIAL METHODS   #
+    ######################
+    def __getitem__(self, name: str):
+        return Collection(self.database[name], self.operations)
+
+    def __getattr__(self, name: str):
+        return getattr(self.database, name)
+
+
+class Collection:
+    ##################
+    #  CONSTRUCTORS  #
+    ##################
+    def __init__(self, collection, operations: Counter):
+        """
+        Instantiate a Collection object, a proxy of a Motor collection which counts the operations sent to the
+        database and adds the time spent waiting for them to the db phase of the current interaction.
+
+        :param collection: The Motor collection.
+        :param operations: The counter of the operations, by (collection name, method name).
+        """
+        self._collection = collection
+        self._operations = operations
+
+    ######################
+    #  SPECIAL METHODS   #
+    ######################
+    def __getattr__(self, name: str):
+        attribute = getattr(self._collection, name)
+        if name not in OPERATIONS:
+            return attribute
+
+        def counted(*args, **kwargs):
+            self._operations[(self._collection.name, name)] += 1
+            count_operation()
+            return timed(attribute(*args, **kwargs))
+        return counted
+
+
+class Cursor:
+    ##################
+    #  CONSTRUCTORS  #
+    ##################
+    def __init__(self, cursor):
+        """
+        Instantiate a Cursor object, a proxy of a Motor cursor which adds the time spent waiting for its results to the
+        db phase of the current interaction.
+
+        :param cursor: The Motor cursor.
+        """
+        self._cursor = cursor
+
+    ######################
+    #  SPECIAL METHODS   #
+    ######################
+    def __getattr__(self, name: str):
+        attribute = getattr(self._cursor, name)
+        if not callable(attribute):
+            return attribute
+
+        def chained(*args, **kwargs):
+            result = attribute(*args, **kwargs)
+            # Methods like `sort` or `limit` return the cursor itself
+            return self if result is self._cursor else timed(result)
+        return chained
+
+
+def timed(result):
+    """
+    Wrap the result of a database method so that the time spent waiting for it is measured.
+
+    :param result: An awaitable, a cursor, or any other result which is returned as is.
+    :return: The wrapped result.
+    """
+    if inspect.isawaitable(result):
+        async def wait():
+            with measure('db'):
+                return await result
+        return wait()
+    if hasattr(result, 'to_list'):
+        return Cursor(result)
+    return result
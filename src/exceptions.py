@@ -6,6 +6,11 @@ class NoSessionAvailableError(Exception):
         )
 
 
+class NoUserSessionError(Exception):
+    def __str__(self) -> str:
+        return "Tu n'as aucune session à venir ! Utilise `/list` pour en trouver une à rejoindre."
+
+
 class UserIsAlreadyHostError(Exception):
     def __str__(self) -> str:
         return "Euh... Tu essayes de rejoindre ta propre session ? :sweat_smile:"
@@ -21,6 +26,12 @@ class SessionIsFullError(Exception):
         return "Il n'y a plus de place dans cette session..."
 
 
+class UserIsAlreadyWaitingError(Exception):
+    def __str__(self) -> str:
+        return "Tu es déjà sur la liste d'attente de cette session ! " \
+               "Tu recevras un message dès qu'une place se libère."
+
+
 class UserIsHostError(Exception):
     def __str__(self) -> str:
         return (
@@ -42,3 +53,11 @@ class UserIsNotParticipantError(Exception):
 class TooManyEquipmentError(Exception):
     def __str__(self) -> str:
         return "Euh t'abuses pas un peu sur les équipements là ? :thinking:"
+
+
+class SessionNotFoundError(Exception):
+    def __str__(self) -> str:
+        return (
+            "Cette session n'existe plus...\n"
+            "Tu peux voir la liste des sessions à venir avec `/list` !"
+        )
@@ -0,0 +1,246 @@
+#############
+#  IMPORTS  #
+#############
+# General imports
+import asyncio
+import sys
+from datetime import datetime
+from bson.objectid import ObjectId
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import IndexModel, ASCENDING
+from pymongo.errors import OperationFailure
+from dotenv import load_dotenv
+
+# Local imports
+from actions import db
+
+###############
+#  CONSTANTS  #
+###############
+SESSION_INDEXES = [
+    # Upcoming sessions of a guild, sorted chronologically
+    IndexModel([('guild_id', ASCENDING), ('date_start', ASCENDING), ('_id', ASCENDING)], name='guild_id_date_start_id'),
+    # Sessions of a user in a guild, as host, participant or waiting user
+    IndexModel([('guild_id', ASCENDING), ('host.id', ASCENDING), ('date_start', ASCENDING)],
+               name='guild_id_host_id_date_start'),
+    IndexModel([('guild_id', ASCENDING), ('participants.id', ASCENDING), ('date_start', ASCENDING)],
+               name='guild_id_participants_id_date_start'),
+    IndexModel([('guild_id', ASCENDING), ('waitlist.id', ASCENDING), ('date_start', ASCENDING)],
+               name='guild_id_waitlist_id_date_start'),
+    # Finished sessions, to be archived
+    IndexModel([('date_end', ASCENDING)], name='date_end')
+]
+
+# Indexes superseded by the ones prefixed by the guild, which would only slow the writes down
+SUPERSEDED_INDEXES = ['date_start_id', 'host_id_date_start', 'participants_id_date_start', 'waitlist_id_date_start']
+
+# Error code of MongoDB when dropping an index which does not exist
+INDEX_NOT_FOUND = 27
+
+
+async def ensure_indexes(db: AsyncIOMotorDatabase):
+    """
+    Create the indexes of the session collection, if they do not exist yet, and drop the superseded ones.
+
+    :param db: The MongoDB database instance.
+    """
+    await db['session'].create_indexes(SESSION_INDEXES)
+    existing_indexes = await db['session'].index_information()
+    for name in SUPERSEDED_INDEXES:
+        if name not in existing_indexes:
+            continue
+        try:
+            await db['session'].drop_index(name)
+        except OperationFailure as exception:
+            # Another process may have dropped it in the meantime
+            if exception.code != INDEX_NOT_FOUND:
+                raise
+
+
+def get_query_shapes() -> dict:
+    """
+    Returns a sample of every query shape the bot sends to the session collection, as the commands to be explained.
+
+    :return: A dictionary of the commands, by name of the query shape.
+    """
+    now = datetime.now()
+    session_id = ObjectId()
+    user_id = 0
+    guild_id = 0
+    return {
+        'upcoming sessions': {
+            'find': 'session',
+            'filter': {'guild_id': guild_id, 'date_start': {'$gt': now}},
+            'sort': {'date_start': 1, '_id': 1}
+        },
+        'session list page': {
+            'aggregate': 'session',
+            'pipeline': [
+                {'$match': {'guild_id': guild_id, 'date_start': {'$gt': now},
+                            '$or': [{'date_start': {'$gt': now}}, {'date_start': now, '_id': {'$gt': session_id}}]}},
+                {'$sort': {'date_start': 1, '_id': 1}},
+                {'$limit': 26}
+            ],
+            'cursor': {}
+        },
+        'equipment overview': {
+            'aggregate': 'session',
+            'pipeline': [
+                {'$match': {'guild_id': guild_id, 'date_start': {'$gt': now}}},
+                {'$sort': {'date_start': 1, '_id': 1}},
+                {'$limit': 25}
+            ],
+            'cursor': {}
+        },
+        'user sessions': {
+            'aggregate': 'session',
+            'pipeline': [
+                {'$match': {'$or': [{'guild_id': guild_id, 'host.id': user_id, 'date_start': {'$gt': now}},
+                                    {'guild_id': guild_id, 'participants.id': user_id, 'date_start': {'$gt': now}},
+                                    {'guild_id': guild_id, 'waitlist.id': user_id, 'date_start': {'$gt': now}}]}},
+                {'$sort': {'date_start': 1, '_id': 1}},
+                {'$limit': 25}
+            ],
+            'cursor': {}
+        },
+        'finished sessions': {
+            'find': 'session',
+            'filter': {'date_end': {'$lt': now}},
+            'sort': {'date_end': 1},
+            'limit': 500
+        },
+        'session by id': {
+            'find': 'session',
+            'filter': {'_id': session_id}
+        },
+        'join session': {
+            'findAndModify': 'session',
+            'query': {'_id': session_id, 'host.id': {'$ne': user_id}, 'participants.id': {'$ne': user_id},
+                      'waitlist.id': {'$ne': user_id}, '$expr': {'$lt': [{'$size': '$participants'}, '$places']}},
+            'update': {'$push': {'participants': {'id': user_id}}, '$inc': {'equipment.consoles': 0, 'version': 1}}
+        },
+        'join waitlist': {
+            'findAndModify': 'session',
+            'query': {'_id': session_id, 'host.id': {'$ne': user_id}, 'participants.id': {'$ne': user_id},
+                      'waitlist.id': {'$ne': user_id}, '$expr': {'$gte': [{'$size': '$participants'}, '$places']}},
+            'update': {'$push': {'waitlist': {'id': user_id}}, '$inc': {'version': 1}}
+        },
+        'leave session': {
+            'findAndModify': 'session',
+            'query': {'_id': session_id, 'participants': {'$elemMatch': {'id': user_id, 'consoles': 0, 'screens': 0,
+                                                                         'adapters': 0}}},
+            'update': {'$pull': {'participants': {'id': user_id}}, '$inc': {'equipment.consoles': 0, 'version': 1}}
+        },
+        'leave session with promotion': {
+            'findAndModify': 'session',
+            'query': {'_id': session_id, 'participants.0.id': user_id, 'participants.0.consoles': 0,
+                      'participants.0.screens': 0, 'participants.0.adapters': 0, 'waitlist.0.id': user_id},
+            'update': {'$set': {'participants.0': {'id': user_id}}, '$pop': {'waitlist': -1},
+                       '$inc': {'equipment.consoles': 0, 'version': 1}}
+        },
+        'leave waitlist': {
+            'findAndModify': 'session',
+            'query': {'_id': session_id, 'waitlist.id': user_id},
+            'update': {'$pull': {'waitlist': {'id': user_id}}, '$inc': {'version': 1}}
+        },
+        'bring equipment': {
+            'findAndModify': 'session',
+            'query': {'_id': session_id, 'participants.0.id': user_id, 'participants.0.consoles': {'$lt': 3}},
+            'update': {'$inc': {'participants.0.consoles': 1, 'equipment.consoles': 1, 'version': 1}}
+        },
+        'update session': {
+            'findAndModify': 'session',
+            'query': {'_id': session_id},
+            'update': {'$set': {'places': 0}, '$inc': {'version': 1}}
+        },
+        'update session with promotion': {
+            'findAndModify': 'session',
+            'query': {'_id': session_id, 'version': 0},
+            'update': {'$set': {'places': 0, 'waitlist': []}, '$push': {'participants': {'$each': [{'id': user_id}]}},
+                       '$inc': {'equipment.consoles': 0, 'version': 1}}
+        },
+        'reminders': {
+            'find': 'session',
+            'filter': {'guild_id': {'$in': [guild_id]}, 'date_start': {'$gt': now}, 'reminded': {'$ne': True}},
+            'projection': {'date_start': 1}
+        },
+        'claim reminder': {
+            'findAndModify': 'session',
+            'query': {'_id': session_id, 'date_start': {'$gt': now}, 'reminded': {'$ne': True}},
+            'update': {'$set': {'reminded': True}}
+        },
+        'archived sessions': {
+            'delete': 'session',
+            'deletes': [{'q': {'_id': {'$in': [session_id]}}, 'limit': 0}]
+        },
+        'legacy sessions': {
+            'count': 'session',
+            'query': {'guild_id': {'$exists': False}}
+        },
+        'backfill guild': {
+            'update': 'session',
+            'updates': [{'q': {'guild_id': {'$exists': False}}, 'u': {'$set': {'guild_id': guild_id}}, 'multi': True}]
+        },
+        'sessions without equipment': {
+            'find': 'session',
+            'filter': {'guild_id': {'$in': [guild_id]}, 'date_start': {'$gt': now}, 'equipment': {'$exists': False}}
+        },
+        'backfill equipment': {
+            'update': 'session',
+            'updates': [{'q': {'_id': session_id, 'equipment': {'$exists': False}},
+                         'u': {'$set': {'equipment': {'consoles': 0, 'screens': 0, 'adapters': 0}}}}]
+        },
+        'delete session': {
+            'delete': 'session',
+            'deletes': [{'q': {'_id': session_id}, 'limit': 1}]
+        }
+    }
+
+
+def find_collection_scans(plan) -> bool:
+    """
+    Look for a collection scan in the winning plan of an explain output.
+
+    :param plan: The explain output, or a part of it.
+    :return: True if a COLLSCAN stage was found, False otherwise.
+    """
+    if isinstance(plan, dict):
+        if plan.get('stage') == 'COLLSCAN':
+            return True
+        return any(find_collection_scans(value) for key, value in plan.items() if key != 'rejectedPlans')
+    if isinstance(plan, list):
+        return any(find_collection_scans(value) for value in plan)
+    return False
+
+
+async def check_query_plans(db: AsyncIOMotorDatabase) -> list[str]:
+    """
+    Explain every query shape the bot uses and find the ones which fall back to a collection scan.
+
+    :param db: The MongoDB database instance.
+    :return: The names of the query shapes which scan the whole collection.
+    """
+    collection_scans = []
+    for name, command in get_query_shapes().items():
+        explanation = await db.command({'explain': command, 'verbosity': 'queryPlanner'})
+        if find_collection_scans(explanation):
+            collection_scans.append(name)
+    return collection_scans
+
+
+async def main() -> int:
+    """
+    Ensure the indexes of the session collection, then check the query plans of the bot.
+
+    :return: The exit code of the script, 1 if any query shape falls back to a collection scan.
+    """
+    await ensure_indexes(db)
+    collection_scans = await check_query_plans(db)
+    for name in get_query_shapes():
+        print(f"{'COLLSCAN' if name in collection_scans else 'ok':<10}{name}")
+    return 1 if collection_scans else 0
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    sys.exit(asyncio.run(main()))
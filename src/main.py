@@ -1,28 +1,148 @@
 #############
 #  IMPORTS  #
 #############
+# Startup time is measured from here, before the heavy imports
+import time
+STARTED_AT = time.perf_counter()
+
 # General imports
 import locale
+import logging
 import ssl
+import os
+from dotenv import load_dotenv
+
+# Sensitive information are stored in .env file not present in the repository
+load_dotenv()
 
 # Discord-relative imports
-from discord import Intents, Embed
-from discord.ext.commands import Bot
-from discord_slash import SlashCommand, SlashContext, ComponentContext
+from discord import Intents, Embed, HTTPException
+from discord.ext.commands import Bot, AutoShardedBot
+from discord_slash import SlashContext, ComponentContext
 from discord_slash.model import SlashCommandOptionType
 from discord_slash.utils.manage_components import create_select, create_select_option, create_actionrow
 
 # Local imports
-from session import Session
+from session import Session, MAX_REPEAT
+from session_cache import upcoming_sessions
+from session_watcher import SessionWatcher
+from session_archiver import SessionArchiver
 from user import User
+from indexes import ensure_indexes
 from custom_emojis import CustomEmojis
 from actions import *
 from exceptions import *
 from equipment import Equipment
+from metrics import metrics, instrumented, METRICS_HOST, METRICS_PORT, METRICS_LOG_INTERVAL
+from responses import DeferringSlashCommand, message_edits
+from reminders import session_reminders
+from outbound import outbound, BACKGROUND
+
+# Sessions can be changed by several bot processes or directly in the database
+WATCH_SESSIONS = os.environ.get('SMASH_SESSION_WATCH', 'false').lower() in ('1', 'true', 'yes')
+
+# Finished sessions are moved to another collection, to keep the session collection small
+ARCHIVE_SESSIONS = os.environ.get('SMASH_SESSION_ARCHIVE', 'true').lower() in ('1', 'true', 'yes')
+
+# Sessions created before guilds were stored belong to the community the bot served until then
+LEGACY_GUILD_ID = os.environ.get('SMASH_SESSION_LEGACY_GUILD_ID')
+
+# The guilds can be split into shards run by several processes, each one running the shards listed in SHARD_IDS
+SHARD_COUNT = os.environ.get('SMASH_SESSION_SHARD_COUNT')
+SHARD_IDS = os.environ.get('SMASH_SESSION_SHARD_IDS')
 
 # Bot initialization
-bot = Bot(command_prefix="!", self_bot=True, help_command=None, intents=Intents.default())
-slash = SlashCommand(bot, sync_commands=False)
+logger = logging.getLogger(__name__)
+session_watcher = None
+session_archiver = None
+session_reminder = None
+metrics_server = None
+metrics_log = None
+startup_time = None
+if SHARD_COUNT is None:
+    bot = Bot(command_prefix="!", self_bot=True, help_command=None, intents=Intents.default())
+else:
+    bot = AutoShardedBot(command_prefix="!", self_bot=True, help_command=None, intents=Intents.default(),
+                         shard_count=int(SHARD_COUNT),
+                         shard_ids=[int(shard_id) for shard_id in SHARD_IDS.split(',')] if SHARD_IDS else None)
+slash = DeferringSlashCommand(bot, sync_commands=False)
+
+
+#############
+#  HELPERS  #
+#############
+def get_waitlist_message(session: Session, user: User) -> str:
+    """
+    Tell the user their position on the waitlist of the session, if they have been put on it.
+
+    :param session: The session the user joined.
+    :param user: The user who joined the session.
+    :return: The message for the user, or None if they participate in the session.
+    """
+    position = session.get_waitlist_position(user)
+    if position is None:
+        return None
+    return f"La session est complète : tu es en position {position} sur la liste d'attente. " \
+           f"Tu recevras un message dès qu'une place se libère !"
+
+
+def notify_promoted_users(session: Session, promoted: list[User]):
+    """
+    Send a direct message to the users promoted from the waitlist to the participants of the session, in the background
+    so that the response to the interaction does not wait for them.
+
+    :param session: The updated session.
+    :param promoted: The users promoted from the waitlist.
+    """
+    for user in promoted:
+        bot.loop.create_task(notify_promoted_user(session, user))
+
+
+async def notify_promoted_user(session: Session, user: User):
+    """
+    Send a direct message to a user promoted from the waitlist to the participants of the session.
+
+    :param session: The updated session.
+    :param user: The promoted user.
+    """
+    try:
+        await send_direct_message(user.id, f"Une place s'est libérée : tu participes maintenant à la session "
+                                           f"{session.title} !")
+    except HTTPException as exception:
+        logger.warning(f"Could not notify the user {user.id} of their promotion ({exception}).")
+
+
+async def send_direct_message(user_id: int, content: str):
+    """
+    Send a direct message to a user, after the responses to the interactions.
+
+    :param user_id: The Discord id of the user.
+    :param content: The content of the message.
+    """
+    async def send():
+        discord_user = bot.get_user(user_id) or await bot.fetch_user(user_id)
+        await discord_user.send(content)
+
+    await outbound.submit(send, BACKGROUND, ('channel', user_id))
+
+
+async def backfill_legacy_sessions():
+    """
+    Move the sessions created before guilds were stored to the community the bot served until then: the guild set in
+    SMASH_SESSION_LEGACY_GUILD_ID, or else the only guild of an unsharded bot. They would be hidden from every guild
+    otherwise, so a warning is logged when the guild cannot be told.
+    """
+    if LEGACY_GUILD_ID is not None:
+        return await backfill_guild(int(LEGACY_GUILD_ID))
+
+    nb_legacy_sessions = await count_legacy_sessions()
+    if nb_legacy_sessions == 0:
+        return
+    if SHARD_COUNT is None and len(bot.guilds) == 1:
+        logger.info(f"Moving {nb_legacy_sessions} sessions without guild to the guild {bot.guilds[0].id}.")
+        return await backfill_guild(bot.guilds[0].id)
+    logger.warning(f"{nb_legacy_sessions} sessions have no guild and are hidden: set SMASH_SESSION_LEGACY_GUILD_ID "
+                   f"to the guild they belong to.")
 
 
 #############
@@ -39,6 +159,46 @@ async def on_ready():
     # Initialize custom emojis
     CustomEmojis(bot)
 
+    # Initialize database connection, indexes and session cache
+    await db.connect()
+    await ensure_indexes(db)
+    await backfill_legacy_sessions()
+
+    # Backfill and cache the sessions of the guilds of the shards of this process only
+    guild_ids = [guild.id for guild in bot.guilds]
+    await backfill_equipment(guild_ids)
+    for guild_id in guild_ids:
+        await upcoming_sessions.load(db, guild_id)
+    await session_reminders.load(db, guild_ids)
+
+    # Follow the changes made to the sessions by other processes
+    global session_watcher
+    if WATCH_SESSIONS and session_watcher is None:
+        session_watcher = bot.loop.create_task(SessionWatcher(upcoming_sessions).run(db))
+
+    # Archive the finished sessions in the background
+    global session_archiver
+    if ARCHIVE_SESSIONS and session_archiver is None:
+        session_archiver = bot.loop.create_task(SessionArchiver().run(db))
+
+    # Remind the members of the sessions before they start
+    global session_reminder
+    if session_reminder is None:
+        session_reminder = bot.loop.create_task(session_reminders.run(db, send_direct_message))
+
+    # Expose the metrics of the interactions over HTTP and/or in the logs
+    global metrics_server, metrics_log
+    if METRICS_PORT is not None and metrics_server is None:
+        metrics_server = await metrics.serve(METRICS_HOST, int(METRICS_PORT))
+    if METRICS_LOG_INTERVAL is not None and metrics_log is None:
+        metrics_log = bot.loop.create_task(metrics.log_periodically(float(METRICS_LOG_INTERVAL)))
+
+    # Report how long the bot took to be ready, the first time only
+    global startup_time
+    if startup_time is None:
+        startup_time = time.perf_counter() - STARTED_AT
+        logger.info(f"Ready {startup_time:.2f} seconds after start.")
+
 
 @bot.event
 async def on_slash_command_error(ctx: SlashContext, exception: Exception):
@@ -48,7 +208,8 @@ async def on_slash_command_error(ctx: SlashContext, exception: Exception):
     :param ctx: The context.
     :param exception: The exception caught.
     """
-    await ctx.send(str(exception), hidden=True)
+    # A deferred response cannot be made ephemeral anymore
+    await ctx.send(str(exception), hidden=not ctx.deferred)
 
 
 @bot.event
@@ -59,20 +220,39 @@ async def on_component_callback_error(ctx: ComponentContext, exception: Exceptio
     :param ctx: The context.
     :param exception: The exception caught.
     """
+    # A deferred response edits the message of the component: keep it unchanged and answer with a follow-up message
+    if ctx.deferred:
+        await ctx.edit_origin()
     await ctx.send(str(exception), hidden=True)
 
 
+@bot.event
+async def on_component(ctx: ComponentContext):
+    """
+    Event triggered when a component is used. Route the components whose custom id carries arguments, formatted as
+    `<callback name>:<arguments>`, to their callback.
+
+    :param ctx: The context.
+    """
+    name, separator, _ = ctx.custom_id.partition(':')
+    if separator:
+        callback = slash.get_component_callback(custom_id=name, component_type=ctx.component_type)
+        if callback is not None:
+            await slash.invoke_component_callback(callback, ctx)
+
+
 @slash.slash(
     name='list',
     description="Affiche la liste des sessions à venir."
 )
+@instrumented
 async def list_sessions(ctx: SlashContext):
     """
     Slash command to list and show all the future sessions.
 
     :param ctx: The context.
     """
-    embed, components = get_session_list_message()
+    embed, components = await get_session_list_message(guild_id=ctx.guild_id)
     await ctx.send(embed=embed, components=components)
 
 
@@ -88,6 +268,7 @@ async def list_sessions(ctx: SlashContext):
         }
     ]
 )
+@instrumented
 async def show(ctx: SlashContext, n: int):
     """
     Slash command which sends an embed of the nth next session with its components.
@@ -96,7 +277,7 @@ async def show(ctx: SlashContext, n: int):
     :param n: The index of the nth session to look for.
     """
     # Find nth next session
-    session = Session.from_index(db, n)
+    session = await Session.from_index(db, n, ctx.guild_id)
 
     # Show the details of the session
     embed, components = get_session_details_message(session)
@@ -107,6 +288,7 @@ async def show(ctx: SlashContext, n: int):
     name='next',
     description="Affiche les détails de la prochaine session. Équivalent à `/show 1`."
 )
+@instrumented
 async def show_next(ctx: SlashContext):
     """
     Slash command which sends an embed of the next session with its components. Equivalent to `/show 1`.
@@ -114,7 +296,7 @@ async def show_next(ctx: SlashContext):
     :param ctx: The context.
     """
     # Find next session
-    session = Session.from_index(db, 1)
+    session = await Session.from_index(db, 1, ctx.guild_id)
 
     # Show the details of the session
     embed, components = get_session_details_message(session)
@@ -161,13 +343,26 @@ async def show_next(ctx: SlashContext):
             'description': "Note toute information supplémentaire que tu juges utile ici.",
             'type': SlashCommandOptionType.STRING,
             'required': 'false'
+        },
+        {
+            'name': 'repeat',
+            'description': f"Le nombre de sessions à créer, pour une session régulière (jusqu'à {MAX_REPEAT}).",
+            'type': SlashCommandOptionType.INTEGER,
+            'required': 'false'
+        },
+        {
+            'name': 'interval',
+            'description': "Le nombre de jours entre deux sessions régulières, une semaine par défaut.",
+            'type': SlashCommandOptionType.INTEGER,
+            'required': 'false'
         }
     ]
 )
+@instrumented
 async def create(ctx: SlashContext, day: int, start_hour: str, end_hour: str, places: int,
-                 address: str = None, comment: str = None):
+                 address: str = None, comment: str = None, repeat: int = 1, interval: int = 7):
     """
-    Slash command to create a session with the specified information.
+    Slash command to create a session with the specified information, or several sessions at a regular interval.
 
     :param ctx: The context.
     :param day: The day of the session.
@@ -176,16 +371,21 @@ async def create(ctx: SlashContext, day: int, start_hour: str, end_hour: str, pl
     :param places: The number of places available for the session.
     :param address: The address of the session.
     :param comment: An extra comment about the session.
+    :param repeat: The number of sessions to create.
+    :param interval: The number of days between two sessions.
     """
-    # Get start and end dates of the session
+    # Get start and end dates of the sessions
     date_start, date_end = Session.get_dates(day, float(start_hour), float(end_hour))
+    dates = Session.get_recurring_dates(date_start, date_end, repeat, interval)
 
-    # Add the session in database and get the created session instance
-    created_session = create_session(User.from_author(ctx.author), date_start, date_end, places, address, comment)
+    # Add the sessions in database and get the first created session instance
+    created_session = await create_sessions(User.from_author(ctx.author), dates, places, address, comment,
+                                            ctx.guild_id)
 
-    # Show the details of the created session
+    # Show the details of the first created session
+    content = f"{repeat} sessions créées, tous les {interval} jours. Voici la première :" if repeat > 1 else ""
     embed, components = get_session_details_message(created_session)
-    await ctx.send(embed=embed, components=components)
+    await ctx.send(content, embed=embed, components=components)
 
 
 @slash.slash(
@@ -218,6 +418,7 @@ async def create(ctx: SlashContext, day: int, start_hour: str, end_hour: str, pl
         }
     ]
 )
+@instrumented
 async def update(ctx: SlashContext, n: int, places: int = None, address: str = None, comment: str = None):
     """
     Slash command to update the nth next session with the specified information.
@@ -229,14 +430,15 @@ async def update(ctx: SlashContext, n: int, places: int = None, address: str = N
     :param comment: An extra comment about the session.
     """
     # Find the session to update
-    session = Session.from_index(db, n)
+    session = await Session.from_index(db, n, ctx.guild_id)
 
     # Check if the user is the host (only the host can update its session)
     if not session.is_host(User.from_author(ctx.author)):
         raise UserIsNotHostError()
 
     # Update the session in the database
-    update_session(session, places, address, comment)
+    session, promoted = await update_session(session, places, address, comment)
+    notify_promoted_users(session, promoted)
 
     # Show the details of the updated session
     embed, components = get_session_details_message(session)
@@ -255,6 +457,7 @@ async def update(ctx: SlashContext, n: int, places: int = None, address: str = N
         }
     ]
 )
+@instrumented
 async def delete(ctx: SlashContext, n: int):
     """
     Slash command to delete the nth next session.
@@ -263,14 +466,16 @@ async def delete(ctx: SlashContext, n: int):
     :param n: The index of the nth session to delete.
     """
     # Find the session to delete
-    session = Session.from_index(db, n)
+    session = await Session.from_index(db, n, ctx.guild_id)
 
     # Check if the user is the host (only the host can delete its session)
     if not session.is_host(User.from_author(ctx.author)):
         raise UserIsNotHostError()
 
     # Delete session
-    db['session'].delete_one({'_id': session.id})
+    await db['session'].delete_one({'_id': session.id})
+    upcoming_sessions.remove(session.id)
+    session_reminders.unschedule(session.id)
 
     # Send a success message
     await ctx.send("Ta session a bien été supprimée !", hidden=True)
@@ -306,6 +511,7 @@ async def delete(ctx: SlashContext, n: int):
         }
     ]
 )
+@instrumented
 async def join(ctx: SlashContext, n: int, consoles: int = 0, screens: int = 0, adapters: int = 0):
     """
     Slash command to join the nth next session with the specified equipment.
@@ -317,15 +523,15 @@ async def join(ctx: SlashContext, n: int, consoles: int = 0, screens: int = 0, a
     :param adapters: The number of adapters the user brings to the session.
     """
     # Find the session to join
-    session = Session.from_index(db, n)
+    session = await Session.from_index(db, n, ctx.guild_id)
 
     # Join the session
     user = User.from_author(ctx.author, consoles, screens, adapters)
-    join_session(session, user)
+    session = await join_session(session, user)
 
     # Show updated session
     embed, components = get_session_details_message(session)
-    await ctx.send(embed=embed, components=components)
+    await ctx.send(content=get_waitlist_message(session, user), embed=embed, components=components)
 
 
 @slash.slash(
@@ -340,6 +546,7 @@ async def join(ctx: SlashContext, n: int, consoles: int = 0, screens: int = 0, a
         }
     ]
 )
+@instrumented
 async def leave(ctx: SlashContext, n: int):
     """
     Slash command to leave the nth next session if the user participates in it.
@@ -348,17 +555,49 @@ async def leave(ctx: SlashContext, n: int):
     :param n: The index of the nth session to leave.
     """
     # Find session to leave
-    session = Session.from_index(db, n)
+    session = await Session.from_index(db, n, ctx.guild_id)
 
     # Leave the session
-    leave_session(session, User.from_author(ctx.author))
+    session, promoted = await leave_session(session, User.from_author(ctx.author))
+    notify_promoted_users(session, promoted)
 
     # Send the embed of the updated session
     embed, components = get_session_details_message(session)
     await ctx.send(embed=embed, components=components)
 
 
+@slash.slash(
+    name='mine',
+    description="Affiche les sessions à venir dont tu es l'hôte, auxquelles tu participes ou que tu attends."
+)
+@instrumented
+async def show_mine(ctx: SlashContext):
+    """
+    Slash command to show the future sessions of the user.
+
+    :param ctx: The context.
+    """
+    embed, components = await get_user_sessions_message(User.from_author(ctx.author), ctx.guild_id)
+    await ctx.send(embed=embed, components=components)
+
+
+@slash.slash(
+    name='equipment',
+    description="Affiche l'équipement apporté aux sessions à venir."
+)
+@instrumented
+async def show_equipment(ctx: SlashContext):
+    """
+    Slash command to show the equipment brought to the future sessions compared to their number of players.
+
+    :param ctx: The context.
+    """
+    embed = await get_equipment_message(ctx.guild_id)
+    await ctx.send(embed=embed)
+
+
 @slash.component_callback()
+@instrumented
 async def dropdown_select_session_callback(ctx: ComponentContext):
     """
     The callback after the used chose a session to be detailed in the dropdown.
@@ -366,7 +605,7 @@ async def dropdown_select_session_callback(ctx: ComponentContext):
     :param ctx: The context.
     """
     # Find selected session
-    selected_session = Session.from_index(db, int(ctx.selected_options[0]))
+    selected_session = await get_selected_session(ctx.selected_options[0], ctx.guild_id)
 
     # Show the details of the session
     embed, components = get_session_details_message(selected_session)
@@ -374,109 +613,140 @@ async def dropdown_select_session_callback(ctx: ComponentContext):
 
 
 @slash.component_callback()
+@instrumented
+async def btn_list_previous_callback(ctx: ComponentContext):
+    """
+    The callback after the user clicked on the button to show the previous page of the session list.
+
+    :param ctx: The context.
+    """
+    # Find the first session of the displayed page
+    index, cursor = parse_list_custom_id(ctx.custom_id)
+
+    # Show the previous page
+    embed, components = await get_session_list_message(index, cursor, backward=True, guild_id=ctx.guild_id)
+    await ctx.edit_origin(embed=embed, components=components)
+
+
+@slash.component_callback()
+@instrumented
+async def btn_list_next_callback(ctx: ComponentContext):
+    """
+    The callback after the user clicked on the button to show the next page of the session list.
+
+    :param ctx: The context.
+    """
+    # Find the last session of the displayed page
+    index, cursor = parse_list_custom_id(ctx.custom_id)
+
+    # Show the next page
+    embed, components = await get_session_list_message(index, cursor, guild_id=ctx.guild_id)
+    await ctx.edit_origin(embed=embed, components=components)
+
+
+@slash.component_callback()
+@instrumented
 async def btn_join_session_callback(ctx: ComponentContext):
     """
     The callback after the user clicked on the button to join the displayed session.
 
     :param ctx: The context.
     """
-    # Find the index of the session with the title of the embed origin message
-    n = Session.get_index_from_title(ctx.origin_message.embeds[0].title)
-
     # Find the session to join
-    session = Session.from_index(db, n)
+    session = await get_component_session(ctx)
 
     # Join the session
-    join_session(session, User.from_author(ctx.author))
+    user = User.from_author(ctx.author)
+    session = await join_session(session, user)
 
     # Update the embed
     embed, components = get_session_details_message(session)
-    await ctx.edit_origin(embed=embed, components=components)
+    content = get_waitlist_message(session, user)
+    if content is None:
+        await message_edits.edit_origin(ctx, session.version, embed=embed, components=components)
+    else:
+        # Tell the user their position on the waitlist in a follow-up, once the interaction has been responded to
+        await message_edits.edit_origin_now(ctx, session.version, embed=embed, components=components)
+        await ctx.send(content, hidden=True)
 
 
 @slash.component_callback()
+@instrumented
 async def btn_leave_session_callback(ctx: ComponentContext):
     """
     The callback after the user clicked on the button to leave the displayed session.
 
     :param ctx: The context.
     """
-    # Find the index of the session with the title of the embed origin message
-    n = Session.get_index_from_title(ctx.origin_message.embeds[0].title)
-
     # Find the session to leave
-    session = Session.from_index(db, n)
+    session = await get_component_session(ctx)
 
     # Leave the session
-    leave_session(session, User.from_author(ctx.author))
+    session, promoted = await leave_session(session, User.from_author(ctx.author))
+    notify_promoted_users(session, promoted)
 
     # Update the embed
     embed, components = get_session_details_message(session)
-    await ctx.edit_origin(embed=embed, components=components)
+    await message_edits.edit_origin(ctx, session.version, embed=embed, components=components)
 
 
 @slash.component_callback()
+@instrumented
 async def btn_bring_switch_callback(ctx: ComponentContext):
     """
     The callback after the user clicked on the button to bring a console to the session.
 
     :param ctx: The context.
     """
-    # Find the index of the session with the title of the embed origin message
-    n = Session.get_index_from_title(ctx.origin_message.embeds[0].title)
-
     # Find the concerned session
-    session = Session.from_index(db, n)
+    session = await get_component_session(ctx)
 
     # Update the user's equipment
-    bring_equipment(session, User.from_author(ctx.author), Equipment.Console)
+    session = await bring_equipment(session, User.from_author(ctx.author), Equipment.Console)
 
     # Update the embed
     embed, components = get_session_details_message(session)
-    await ctx.edit_origin(embed=embed, components=components)
+    await message_edits.edit_origin(ctx, session.version, embed=embed, components=components)
 
 
 @slash.component_callback()
+@instrumented
 async def btn_bring_screen_callback(ctx: ComponentContext):
     """
     The callback after the user clicked on the button to bring a screen to the session.
 
     :param ctx: The context.
     """
-    # Find the index of the session with the title of the embed origin message
-    n = Session.get_index_from_title(ctx.origin_message.embeds[0].title)
-
     # Find the concerned session
-    session = Session.from_index(db, n)
+    session = await get_component_session(ctx)
 
     # Update the user's equipment
-    bring_equipment(session, User.from_author(ctx.author), Equipment.Screen)
+    session = await bring_equipment(session, User.from_author(ctx.author), Equipment.Screen)
 
     # Update the embed
     embed, components = get_session_details_message(session)
-    await ctx.edit_origin(embed=embed, components=components)
+    await message_edits.edit_origin(ctx, session.version, embed=embed, components=components)
 
 
 @slash.component_callback()
+@instrumented
 async def btn_bring_adapter_callback(ctx: ComponentContext):
     """
     The callback after the user clicked on the button to bring an adapter to the session.
 
     :param ctx: The context.
     """
-    # Find the index of the session with the title of the embed origin message
-    n = Session.get_index_from_title(ctx.origin_message.embeds[0].title)
-
     # Find the concerned session
-    session = Session.from_index(db, n)
+    session = await get_component_session(ctx)
 
     # Update the user's equipment
-    bring_equipment(session, User.from_author(ctx.author), Equipment.Adapter)
+    session = await bring_equipment(session, User.from_author(ctx.author), Equipment.Adapter)
 
     # Update the embed
     embed, components = get_session_details_message(session)
-    await ctx.edit_origin(embed=embed, components=components)
+    await message_edits.edit_origin(ctx, session.version, embed=embed, components=components)
 
 
 if __name__ == '__main__':
-    bot.run(BOT_TOKEN)
+    logging.basicConfig(level=logging.INFO)
+    bot.run(os.environ.get('SMASH_SESSION_BOT_TOKEN'))
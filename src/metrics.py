@@ -0,0 +1,317 @@
+#############
+#  IMPORTS  #
+#############
+# General imports
+import asyncio
+import logging
+import os
+import time
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from aiohttp import web
+
+
+###############
+#  CONSTANTS  #
+###############
+# Upper bounds of the latency histogram buckets, in seconds. Discord fails the interaction after 3 seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2., 3., 5., 10.)
+
+# Phases of an interaction: waiting for the database, building the messages and answering Discord
+PHASES = ('db', 'render', 'send')
+
+METRICS_HOST = os.environ.get('SMASH_SESSION_METRICS_HOST', '127.0.0.1')
+METRICS_PORT = os.environ.get('SMASH_SESSION_METRICS_PORT')
+METRICS_LOG_INTERVAL = os.environ.get('SMASH_SESSION_METRICS_LOG_INTERVAL')
+
+logger = logging.getLogger(__name__)
+
+
+class Interaction:
+    ##################
+    #  CONSTRUCTORS  #
+    ##################
+    def __init__(self, name: str):
+        """
+        Instantiate an Interaction object, which collects the timings of a slash command or component callback while
+        it runs.
+
+        :param name: The name of the command or callback.
+        """
+        self.name = name
+        self.durations = Counter()
+        self.operations = 0
+
+
+# Interaction being handled by the current task, if any
+current_interaction = ContextVar('current_interaction', default=None)
+
+
+class Histogram:
+    ##################
+    #  CONSTRUCTORS  #
+    ##################
+    def __init__(self):
+        """
+        Instantiate an empty Histogram object, which counts the observed durations by bucket.
+        """
+        self.buckets = [0] * len(BUCKETS)
+        self.sum = 0.
+        self.count = 0
+
+    #############
+    #  METHODS  #
+    #############
+    def observe(self, value: float):
+        """
+        Count a duration in its bucket.
+
+        :param value: The duration, in seconds.
+        """
+        position = bisect_left(BUCKETS, value)
+        if position < len(BUCKETS):
+            self.buckets[position] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimate a quantile of the observed durations, as the upper bound of the bucket it falls in.
+
+        :param q: The quantile to estimate, between 0 and 1.
+        :return: The estimated duration, in seconds, or infinity if it is beyond the last bucket.
+        """
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float('inf')
+
+
+class Metrics:
+    ##################
+    #  CONSTRUCTORS  #
+    ##################
+    def __init__(self):
+        """
+        Instantiate an empty Metrics object, which aggregates the interactions handled by the bot.
+        """
+        self.latencies = defaultdict(Histogram)
+        self.interactions = Counter()
+        self.errors = Counter()
+        self.operations = Counter()
+        self.outbound_depths = Counter()
+        self.outbound_waits = defaultdict(Histogram)
+        self.cache_reads = Counter()
+
+    #############
+    #  METHODS  #
+    #############
+    def record(self, interaction: Interaction, exception: Exception = None):
+        """
+        Aggregate a finished interaction.
+
+        :param interaction: The interaction, with its durations.
+        :param exception: The exception which ended the interaction, if any.
+        """
+        self.interactions[interaction.name] += 1
+        self.operations[interaction.name] += interaction.operations
+        for phase in (*PHASES, 'total'):
+            self.latencies[(interaction.name, phase)].observe(interaction.durations[phase])
+        if exception is not None:
+            self.errors[(interaction.name, type(exception).__name__)] += 1
+
+    def render(self) -> str:
+        """
+        Format the metrics in the Prometheus text exposition format.
+
+        :return: The metrics, one sample per line.
+        """
+        lines = ['# TYPE smash_session_interactions_total counter']
+        lines += [f'smash_session_interactions_total{{interaction="{name}"}} {count}'
+                  for name, count in self.interactions.items()]
+
+        lines.append('# TYPE smash_session_interaction_errors_total counter')
+        lines += [f'smash_session_interaction_errors_total{{interaction="{name}",exception="{exception}"}} {count}'
+                  for (name, exception), count in self.errors.items()]
+
+        lines.append('# TYPE smash_session_db_operations_total counter')
+        lines += [f'smash_session_db_operations_total{{interaction="{name}"}} {count}'
+                  for name, count in self.operations.items()]
+
+        lines.append('# TYPE smash_session_interaction_seconds histogram')
+        for (name, phase), histogram in self.latencies.items():
+            labels = f'interaction="{name}",phase="{phase}"'
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram.buckets):
+                cumulative += count
+                lines.append(f'smash_session_interaction_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'smash_session_interaction_seconds_bucket{{{labels},le="+Inf"}} {histogram.count}')
+            lines.append(f'smash_session_interaction_seconds_sum{{{labels}}} {histogram.sum}')
+            lines.append(f'smash_session_interaction_seconds_count{{{labels}}} {histogram.count}')
+
+        lines.append('# TYPE smash_session_outbound_queue_depth gauge')
+        lines += [f'smash_session_outbound_queue_depth{{priority="{priority}"}} {depth}'
+                  for priority, depth in self.outbound_depths.items()]
+
+        lines.append('# TYPE smash_session_outbound_wait_seconds histogram')
+        for priority, histogram in self.outbound_waits.items():
+            labels = f'priority="{priority}"'
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram.buckets):
+                cumulative += count
+                lines.append(f'smash_session_outbound_wait_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'smash_session_outbound_wait_seconds_bucket{{{labels},le="+Inf"}} {histogram.count}')
+            lines.append(f'smash_session_outbound_wait_seconds_sum{{{labels}}} {histogram.sum}')
+            lines.append(f'smash_session_outbound_wait_seconds_count{{{labels}}} {histogram.count}')
+
+        lines.append('# TYPE smash_session_cache_reads_total counter')
+        lines += [f'smash_session_cache_reads_total{{result="{result}"}} {count}'
+                  for result, count in self.cache_reads.items()]
+        return '\n'.join(lines) + '\n'
+
+    def summarize(self) -> list[str]:
+        """
+        Summarize the metrics of every interaction in a human-readable way.
+
+        :return: One line per interaction.
+        """
+        lines = []
+        for name, count in sorted(self.interactions.items()):
+            total = self.latencies[(name, 'total')]
+            means = '  '.join(f"{phase} {self.latencies[(name, phase)].sum / count * 1000:.1f} ms" for phase in PHASES)
+            errors = sum(errors for (interaction, _), errors in self.errors.items() if interaction == name)
+            lines.append(f"{name}: {count} calls, {errors} errors, p95 <= {total.quantile(0.95) * 1000:.0f} ms "
+                         f"(mean {means}), {self.operations[name] / count:.1f} db operations per call")
+        for priority, histogram in sorted(self.outbound_waits.items()):
+            lines.append(f"outbound {priority}: {histogram.count} requests, {self.outbound_depths[priority]} queued, "
+                         f"p95 wait <= {histogram.quantile(0.95) * 1000:.0f} ms")
+        reads = sum(self.cache_reads.values())
+        if reads > 0:
+            lines.append(f"session cache: {reads} reads, {self.cache_reads['hit'] / reads:.1%} served from memory")
+        return lines
+
+    async def serve(self, host: str, port: int) -> web.AppRunner:
+        """
+        Expose the metrics over HTTP at `/metrics`, to be scraped by Prometheus.
+
+        :param host: The interface to listen on.
+        :param port: The port to listen on.
+        :return: The runner of the web application, to be cleaned up on shutdown.
+        """
+        async def handle(request: web.Request) -> web.Response:
+            return web.Response(text=self.render(), content_type='text/plain')
+
+        app = web.Application()
+        app.router.add_get('/metrics', handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+    async def log_periodically(self, interval: float):
+        """
+        Log a summary of the metrics at a fixed interval, forever.
+
+        :param interval: The number of seconds between two summaries.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            for line in self.summarize():
+                logger.info(line)
+
+
+@contextmanager
+def measure(phase: str):
+    """
+    Add the time spent in the block to the given phase of the current interaction, if any. Can also decorate a
+    function.
+
+    :param phase: The phase of the interaction: db, render or send.
+    """
+    interaction = current_interaction.get()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if interaction is not None:
+            interaction.durations[phase] += time.perf_counter() - start
+
+
+def count_operation():
+    """
+    Count a database operation sent by the current interaction, if any.
+    """
+    interaction = current_interaction.get()
+    if interaction is not None:
+        interaction.operations += 1
+
+
+class TimedContext:
+    ##################
+    #  CONSTRUCTORS  #
+    ##################
+    def __init__(self, ctx):
+        """
+        Instantiate a TimedContext object, a proxy of a SlashContext or ComponentContext which adds the time spent
+        answering Discord to the send phase of the current interaction.
+
+        :param ctx: The context.
+        """
+        self._ctx = ctx
+
+    #############
+    #  METHODS  #
+    #############
+    async def send(self, *args, **kwargs):
+        with measure('send'):
+            return await self._ctx.send(*args, **kwargs)
+
+    async def edit_origin(self, **kwargs):
+        with measure('send'):
+            return await self._ctx.edit_origin(**kwargs)
+
+    async def defer(self, *args, **kwargs):
+        with measure('send'):
+            return await self._ctx.defer(*args, **kwargs)
+
+    ######################
+    #  SPECIAL METHODS   #
+    ######################
+    def __getattr__(self, name: str):
+        return getattr(self._ctx, name)
+
+
+def instrumented(callback):
+    """
+    Decorator which measures every call of a slash command or component callback, and records it in the metrics of the
+    bot, along with the class of the exception which ended it, if any.
+
+    :param callback: The coroutine function of the command or callback, taking the context as first argument.
+    :return: The instrumented coroutine function.
+    """
+    @wraps(callback)
+    async def wrapper(ctx, *args, **kwargs):
+        interaction = Interaction(callback.__name__)
+        token = current_interaction.set(interaction)
+        start = time.perf_counter()
+        exception = None
+        try:
+            return await callback(TimedContext(ctx), *args, **kwargs)
+        except Exception as e:
+            exception = e
+            raise
+        finally:
+            interaction.durations['total'] = time.perf_counter() - start
+            current_interaction.reset(token)
+            metrics.record(interaction, exception)
+    return wrapper
+
+
+# Metrics shared by all the interactions of the bot
+metrics = Metrics()
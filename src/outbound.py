@@ -0,0 +1,270 @@
+#############
+#  IMPORTS  #
+#############
+# General imports
+import asyncio
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Awaitable, Callable
+
+# Local imports
+from metrics import metrics
+
+
+###############
+#  CONSTANTS  #
+###############
+# Priorities of the outbound requests, the lowest first: the responses to the interactions must be sent within 3
+# seconds, the deferred edits of the messages and the direct messages can wait
+INTERACTION, EDIT, BACKGROUND = 0, 1, 2
+PRIORITY_NAMES = ('interaction', 'edit', 'background')
+
+# Rate limits of the Discord routes, as (number of requests, period in seconds), known ahead of the responses of Discord
+ROUTE_LIMITS = {
+    'message': (5, 5.),
+    'channel': (5, 5.)
+}
+GLOBAL_LIMIT = (int(os.environ.get('SMASH_SESSION_GLOBAL_RATE_LIMIT', 50)), 1.)
+
+# Maximum number of requests sent to Discord at the same time
+MAX_IN_FLIGHT = int(os.environ.get('SMASH_SESSION_MAX_IN_FLIGHT', 50))
+
+# Priority, route and merge key of the requests sent by the current task
+current_route = ContextVar('current_route', default=(INTERACTION, None, None))
+
+
+class Bucket:
+    ##################
+    #  CONSTRUCTORS  #
+    ##################
+    def __init__(self, limit: int, period: float):
+        """
+        Instantiate a Bucket object, which counts the requests sent on a route during fixed windows of time.
+
+        :param limit: The number of requests allowed in a window.
+        :param period: The duration of a window, in seconds.
+        """
+        self._limit = limit
+        self._period = period
+        self._remaining = limit
+        self._reset_at = 0.
+
+    #############
+    #  METHODS  #
+    #############
+    def get_delay(self, now: float) -> float:
+        """
+        Compute how long a request has to wait before being sent on the route.
+
+        :param now: The current monotonic time.
+        :return: The number of seconds to wait, 0 if the request can be sent now.
+        """
+        if now >= self._reset_at or self._remaining > 0:
+            return 0.
+        return self._reset_at - now
+
+    def take(self, now: float):
+        """
+        Count a request sent on the route.
+
+        :param now: The current monotonic time.
+        """
+        if now >= self._reset_at:
+            self._remaining = self._limit
+            self._reset_at = now + self._period
+        self._remaining -= 1
+
+
+class Request:
+    # Many requests are queued during a burst of interactions
+    __slots__ = ('priority', 'route', 'merge_key', 'call', 'future', 'enqueued_at')
+
+    ##################
+    #  CONSTRUCTORS  #
+    ##################
+    def __init__(self, priority: int, route: (str, int), merge_key, call: Callable[[], Awaitable]):
+        """
+        Instantiate a Request object, an outbound call waiting in the queue of its priority.
+
+        :param priority: The priority of the request.
+        :param route: The (kind, id) route of the request, or None if it is not rate limited.
+        :param merge_key: The key of the request, for a queued request with the same key to be replaced by this one.
+        :param call: The coroutine function sending the request.
+        """
+        self.priority = priority
+        self.route = route
+        self.merge_key = merge_key
+        self.call = call
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.monotonic()
+
+
+class OutboundDispatcher:
+    ##################
+    #  CONSTRUCTORS  #
+    ##################
+    def __init__(self, global_limit: (int, float) = GLOBAL_LIMIT, max_in_flight: int = MAX_IN_FLIGHT):
+        """
+        Instantiate an OutboundDispatcher object, which sends all the requests of the bot to Discord from a single queue
+        per priority.
+
+        The requests of a route are held back before its rate limit is reached, from the limits known for the route,
+        instead of being sent and backed off by Discord. A held back request does not hold back the requests of the
+        other routes. The responses to the interactions are sent first, and are not subject to the global rate limit.
+        A queued request is replaced by a request with the same merge key, as only the latest edit of a message matters.
+
+        :param global_limit: The (number of requests, period in seconds) allowed for the whole bot.
+        :param max_in_flight: The maximum number of requests sent at the same time.
+        """
+        self._global = Bucket(*global_limit)
+        self._max_in_flight = max_in_flight
+        self._queues = [deque() for _ in PRIORITY_NAMES]
+        self._buckets = {}
+        self._merged = {}
+        self._loop = None
+        self._wake_up = None
+        self._slots = None
+        self._worker = None
+
+    #############
+    #  METHODS  #
+    #############
+    async def submit(self, call: Callable[[], Awaitable], priority: int = None, route: (str, int) = None,
+                     merge_key=None):
+        """
+        Queue a request and wait for it to be sent. The priority, route and merge key default to the ones of the
+        current task, set with `routed`.
+
+        :param call: The coroutine function sending the request.
+        :param priority: The priority of the request.
+        :param route: The (kind, id) route of the request, or None if it is not rate limited.
+        :param merge_key: The key of the request, for a queued request with the same key to be replaced by this one.
+        :return: The result of the call.
+        """
+        if priority is None:
+            priority, route, merge_key = current_route.get()
+        self._start()
+
+        # Replace the call of a queued request with the same key, whose sender gets the result of this one
+        if merge_key is not None and merge_key in self._merged:
+            request = self._merged[merge_key]
+            request.call = call
+        else:
+            request = Request(priority, route, merge_key, call)
+            if merge_key is not None:
+                self._merged[merge_key] = request
+            self._queues[priority].append(request)
+            metrics.outbound_depths[PRIORITY_NAMES[priority]] = len(self._queues[priority])
+            self._wake_up.set()
+
+        # A request is sent even if its sender stops waiting for it, as other senders may wait for the same request
+        return await asyncio.shield(request.future)
+
+    def _start(self):
+        """
+        Start the worker of the dispatcher in the running event loop, if it does not run there yet.
+        """
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return
+        # The requests queued in another event loop, such as a closed one, can never be sent
+        self._loop = loop
+        self._queues = [deque() for _ in PRIORITY_NAMES]
+        self._merged = {}
+        self._wake_up = asyncio.Event()
+        self._slots = asyncio.Semaphore(self._max_in_flight)
+        self._worker = loop.create_task(self._run())
+
+    async def _run(self):
+        """
+        Send the queued requests as soon as their routes allow it, the highest priority first, forever.
+        """
+        while True:
+            await self._slots.acquire()
+            request, delay = self._next(time.monotonic())
+            while request is None:
+                self._slots.release()
+                self._wake_up.clear()
+                try:
+                    await asyncio.wait_for(self._wake_up.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                await self._slots.acquire()
+                request, delay = self._next(time.monotonic())
+            asyncio.ensure_future(self._send(request))
+
+    def _next(self, now: float) -> (Request, float):
+        """
+        Take the first request which can be sent now, by priority, and count it in the buckets of its route.
+
+        :param now: The current monotonic time.
+        :return: A tuple (Request, float) representing respectively the request to send, or None if there is none, and
+        the number of seconds until a held back request can be sent, or None if no request is held back.
+        """
+        delays = []
+        for queue in self._queues:
+            for request in queue:
+                buckets = self._get_buckets(request.route)
+                delay = max([bucket.get_delay(now) for bucket in buckets], default=0.)
+                if delay > 0:
+                    delays.append(delay)
+                    continue
+
+                for bucket in buckets:
+                    bucket.take(now)
+                queue.remove(request)
+                if request.merge_key is not None:
+                    del self._merged[request.merge_key]
+                metrics.outbound_depths[PRIORITY_NAMES[request.priority]] = len(queue)
+                return request, None
+        return None, min(delays, default=None)
+
+    def _get_buckets(self, route: (str, int)) -> list[Bucket]:
+        """
+        Find the buckets a request on the given route counts in.
+
+        :param route: The (kind, id) route of the request, or None if it is not rate limited.
+        :return: The bucket of the route and the global bucket, or no bucket for the routes which are not rate limited.
+        """
+        if route is None:
+            return []
+        if route not in self._buckets:
+            self._buckets[route] = Bucket(*ROUTE_LIMITS[route[0]])
+        return [self._buckets[route], self._global]
+
+    async def _send(self, request: Request):
+        """
+        Send a request and pass its result, or its exception, to its sender.
+
+        :param request: The request.
+        """
+        metrics.outbound_waits[PRIORITY_NAMES[request.priority]].observe(time.monotonic() - request.enqueued_at)
+        try:
+            request.future.set_result(await request.call())
+        except Exception as exception:
+            request.future.set_exception(exception)
+        finally:
+            self._slots.release()
+
+
+@contextmanager
+def routed(priority: int, route: (str, int) = None, merge_key=None):
+    """
+    Send the requests of the block with the given priority and route, and merge them by the given key.
+
+    :param priority: The priority of the requests.
+    :param route: The (kind, id) route of the requests, or None if they are not rate limited.
+    :param merge_key: The key of the requests, for a queued request with the same key to be replaced by a newer one.
+    """
+    token = current_route.set((priority, route, merge_key))
+    try:
+        yield
+    finally:
+        current_route.reset(token)
+
+
+# Dispatcher shared by all the requests of the bot
+outbound = OutboundDispatcher()
@@ -0,0 +1,203 @@
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo.errors import PyMongoError
+from bson.objectid import ObjectId
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable
+import asyncio
+import heapq
+import logging
+import os
+
+from session import Session
+
+
+###############
+#  CONSTANTS  #
+###############
+# Participants are reminded of a session this number of hours before it starts
+DEFAULT_REMINDER_HOURS = float(os.environ.get('SMASH_SESSION_REMINDER_HOURS', 24))
+
+# Direct messages are sent a few at a time, to stay under the rate limit of Discord
+DEFAULT_BATCH_SIZE = int(os.environ.get('SMASH_SESSION_REMINDER_BATCH_SIZE', 5))
+DEFAULT_BATCH_DELAY = float(os.environ.get('SMASH_SESSION_REMINDER_BATCH_DELAY', 1))
+
+logger = logging.getLogger(__name__)
+
+
+class ReminderScheduler:
+    ##################
+    #  CONSTRUCTORS  #
+    ##################
+    def __init__(self, hours: float = DEFAULT_REMINDER_HOURS, batch_size: int = DEFAULT_BATCH_SIZE,
+                 batch_delay: float = DEFAULT_BATCH_DELAY):
+        """
+        Instantiate an empty ReminderScheduler object, which sends a direct message to the host and the participants of
+        every session some hours before it starts.
+
+        The reminders are kept in a heap of (remind_at, _id) entries, so that the scheduler only wakes up when the next
+        reminder is due. An entry is stale when the session it refers to has been rescheduled or unscheduled since: it
+        is skipped when it reaches the top of the heap, instead of being searched for and removed from the heap.
+
+        A session is marked as reminded in the database before its reminder is sent, so that it is never sent twice,
+        even by another process or after a restart.
+
+        :param hours: The number of hours before the start of a session when its members are reminded of it.
+        :param batch_size: The maximum number of direct messages sent at the same time.
+        :param batch_delay: The number of seconds between two batches of direct messages.
+        """
+        self._delay = timedelta(hours=hours)
+        self._batch_size = batch_size
+        self._batch_delay = batch_delay
+        self._heap = []
+        self._scheduled = {}
+        self._changed = None
+
+    #############
+    #  METHODS  #
+    #############
+    async def load(self, db: AsyncIOMotorDatabase, guild_ids: list[int] = None):
+        """
+        (Re)build the heap from the database with a single query on the upcoming sessions not reminded yet.
+
+        :param db: The MongoDB database instance.
+        :param guild_ids: The Discord ids of the guilds whose sessions are reminded by this process, or None for all
+        the guilds.
+        """
+        query = {'date_start': {'$gt': datetime.now()}, 'reminded': {'$ne': True}}
+        if guild_ids is not None:
+            query['guild_id'] = {'$in': guild_ids}
+        documents = await db['session'].find(query, {'date_start': 1}).to_list(length=None)
+        self._scheduled = {document['_id']: document['date_start'] - self._delay for document in documents}
+        self._heap = [(remind_at, session_id) for session_id, remind_at in self._scheduled.items()]
+        heapq.heapify(self._heap)
+        self._wake_up()
+
+    def schedule(self, document: dict):
+        """
+        Schedule the reminder of a session, or reschedule it if the session was already scheduled.
+
+        :param document: The session document, as stored in the database.
+        """
+        if document.get('reminded', False):
+            return self.unschedule(document['_id'])
+        remind_at = document['date_start'] - self._delay
+        if self._scheduled.get(document['_id']) == remind_at:
+            return
+        self._scheduled[document['_id']] = remind_at
+        heapq.heappush(self._heap, (remind_at, document['_id']))
+        self._wake_up()
+
+    def unschedule(self, session_id: ObjectId):
+        """
+        Cancel the reminder of a session. Its entry is left in the heap and skipped once due.
+
+        :param session_id: The id of the session.
+        """
+        self._scheduled.pop(session_id, None)
+
+    async def run(self, db: AsyncIOMotorDatabase, send: Callable[[int, str], Awaitable]):
+        """
+        Sleep until the next reminder is due and send it, forever.
+
+        :param db: The MongoDB database instance.
+        :param send: The coroutine function sending a direct message, from the Discord id of a user and the content of
+        the message.
+        """
+        # The event is created here, to belong to the event loop of the bot
+        self._changed = asyncio.Event()
+        while True:
+            # Drop the stale entries at the top of the heap
+            while len(self._heap) > 0 and self._scheduled.get(self._heap[0][1]) != self._heap[0][0]:
+                heapq.heappop(self._heap)
+
+            # Sleep until the next reminder is due, or until a reminder is scheduled
+            self._changed.clear()
+            if len(self._heap) == 0:
+                await self._changed.wait()
+                continue
+            remind_at, session_id = self._heap[0]
+            delay = (remind_at - datetime.now()).total_seconds()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._changed.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self._heap)
+            del self._scheduled[session_id]
+            try:
+                await self.remind(db, session_id, send)
+            except PyMongoError as exception:
+                logger.warning(f"Could not send the reminder of the session {session_id} ({exception}).")
+
+    def _wake_up(self):
+        """
+        Wake the scheduler up, so that it sleeps again until the reminder now at the top of the heap.
+        """
+        if self._changed is not None:
+            self._changed.set()
+
+    async def remind(self, db: AsyncIOMotorDatabase, session_id: ObjectId, send: Callable[[int, str], Awaitable]):
+        """
+        Mark a session as reminded, then send its reminder to its host and participants, batch by batch.
+
+        :param db: The MongoDB database instance.
+        :param session_id: The id of the session.
+        :param send: The coroutine function sending a direct message, from the Discord id of a user and the content of
+        the message.
+        """
+        # Claim the reminder, unless another process did or the session is over
+        document = await db['session'].find_one_and_update({
+            '_id': session_id,
+            'date_start': {'$gt': datetime.now()},
+            'reminded': {'$ne': True}
+        }, {
+            '$set': {'reminded': True}
+        }, projection={'host.id': 1, 'participants.id': 1, 'date_start': 1, 'date_end': 1, 'address': 1})
+        if document is None:
+            return
+
+        content = ReminderScheduler.get_message(document)
+        user_ids = [document['host']['id'], *[participant['id'] for participant in document['participants']]]
+        for start in range(0, len(user_ids), self._batch_size):
+            if start > 0:
+                await asyncio.sleep(self._batch_delay)
+            results = await asyncio.gather(*[send(user_id, content)
+                                             for user_id in user_ids[start:start + self._batch_size]],
+                                           return_exceptions=True)
+            for user_id, result in zip(user_ids[start:start + self._batch_size], results):
+                if isinstance(result, Exception):
+                    logger.warning(f"Could not remind the user {user_id} of the session {session_id} ({result}).")
+
+    ################
+    #  PROPERTIES  #
+    ################
+    @property
+    def nb_scheduled(self) -> int:
+        """
+        Count the number of sessions whose reminder is scheduled.
+
+        :return: The number of scheduled reminders.
+        """
+        return len(self._scheduled)
+
+    ####################
+    #  STATIC METHODS  #
+    ####################
+    @staticmethod
+    def get_message(document: dict) -> str:
+        """
+        Returns the reminder of a session.
+
+        :param document: The session document, with its dates and address.
+        :return: The content of the direct message.
+        """
+        date_start, date_end = document['date_start'], document['date_end']
+        return f"Rappel : la session {date_start.strftime('%A %d %B').lower()} de {date_start.strftime('%H:%M')} " \
+               f"à {date_end.strftime('%H:%M')} approche ! Adresse : " \
+               f"{Session.get_address(document.get('address'))}"
+
+
+# Reminders of the upcoming sessions, scheduled by the actions and sent by the bot
+session_reminders = ReminderScheduler()
@@ -0,0 +1,218 @@
+#############
+#  IMPORTS  #
+#############
+# General imports
+import asyncio
+import logging
+import os
+from functools import partial
+
+# Discord-relative imports
+from discord_slash import SlashCommand, ComponentContext
+
+# Local imports
+from outbound import outbound, routed, EDIT
+
+
+###############
+#  CONSTANTS  #
+###############
+# Discord fails the interaction if it is not acknowledged within 3 seconds
+DEFER_AFTER = float(os.environ.get('SMASH_SESSION_DEFER_AFTER', 2))
+
+# Minimum number of seconds between two edits of the same message, to stay under the rate limit of Discord
+EDIT_WINDOW = float(os.environ.get('SMASH_SESSION_EDIT_WINDOW', 1))
+
+logger = logging.getLogger(__name__)
+
+
+class DeferringContext:
+    ##################
+    #  CONSTRUCTORS  #
+    ##################
+    def __init__(self, ctx):
+        """
+        Instantiate a DeferringContext object, a proxy of a SlashContext or ComponentContext which can acknowledge the
+        interaction in the background while the command is still running.
+
+        The responses go through a lock, so that the deferred acknowledgement and the response of the command are never
+        sent at the same time. Once deferred, the response of the command edits the deferred message in place. They are
+        sent by the outbound dispatcher, with the priority of the current task.
+
+        :param ctx: The context.
+        """
+        self._ctx = ctx
+        self._lock = asyncio.Lock()
+
+    #############
+    #  METHODS  #
+    #############
+    async def send(self, *args, **kwargs):
+        async with self._lock:
+            return await outbound.submit(partial(self._ctx.send, *args, **kwargs))
+
+    async def edit_origin(self, **kwargs):
+        async with self._lock:
+            return await outbound.submit(partial(self._ctx.edit_origin, **kwargs))
+
+    async def defer(self, *args, **kwargs):
+        """
+        Acknowledge the interaction, unless it has already been acknowledged in the background.
+        """
+        async with self._lock:
+            if not self._ctx.responded and not self._ctx.deferred:
+                await outbound.submit(partial(self._ctx.defer, *args, **kwargs))
+
+    async def defer_after(self, delay: float):
+        """
+        Acknowledge the interaction after the given delay, unless the command has already responded.
+
+        Component callbacks edit the message of the component, so their acknowledgement keeps the message unchanged
+        until they do. Slash commands show a loading message instead.
+
+        :param delay: The number of seconds to wait before acknowledging the interaction.
+        """
+        await asyncio.sleep(delay)
+        # Once started, the acknowledgement must not be interrupted by the end of the command
+        await asyncio.shield(self._defer_if_pending())
+
+    async def _defer_if_pending(self):
+        async with self._lock:
+            if not self._ctx.responded and not self._ctx.deferred:
+                # Only the component contexts can defer an edit of their message
+                if isinstance(self._ctx, ComponentContext):
+                    await outbound.submit(partial(self._ctx.defer, edit_origin=True))
+                else:
+                    await outbound.submit(self._ctx.defer)
+
+    ######################
+    #  SPECIAL METHODS   #
+    ######################
+    def __getattr__(self, name: str):
+        return getattr(self._ctx, name)
+
+
+class DeferringSlashCommand(SlashCommand):
+    ##################
+    #  CONSTRUCTORS  #
+    ##################
+    def __init__(self, *args, defer_after: float = DEFER_AFTER, **kwargs):
+        """
+        Instantiate a DeferringSlashCommand object, a SlashCommand which acknowledges the interactions whose command or
+        component callback takes longer than the given budget, so that they do not fail under a slow database.
+
+        :param defer_after: The number of seconds after which a running interaction is acknowledged.
+        """
+        super().__init__(*args, **kwargs)
+        self._defer_after = defer_after
+
+    #############
+    #  METHODS  #
+    #############
+    async def invoke_command(self, func, ctx, args):
+        ctx = DeferringContext(ctx)
+        timer = asyncio.ensure_future(ctx.defer_after(self._defer_after))
+        try:
+            await super().invoke_command(func, ctx, args)
+        finally:
+            timer.cancel()
+
+    async def invoke_component_callback(self, func, ctx):
+        ctx = DeferringContext(ctx)
+        timer = asyncio.ensure_future(ctx.defer_after(self._defer_after))
+        try:
+            await super().invoke_component_callback(func, ctx)
+        finally:
+            timer.cancel()
+
+
+class EditCoalescer:
+    ##################
+    #  CONSTRUCTORS  #
+    ##################
+    def __init__(self, window: float = EDIT_WINDOW):
+        """
+        Instantiate an EditCoalescer object, which limits the edits of each message to one per window.
+
+        The first click on a message edits it at once. The clicks which come during the following window are
+        acknowledged at once, and only the latest of their renders is applied, in one edit at the end of the window.
+        Renders are ordered by the version of the session they show, so that a slow click never brings back an older
+        state of the session.
+
+        :param window: The minimum number of seconds between two edits of the same message.
+        """
+        self._window = window
+        self._pending = {}
+        self._cooling_down = {}
+        self._latest = {}
+
+    #############
+    #  METHODS  #
+    #############
+    async def edit_origin(self, ctx: ComponentContext, version: int, **fields):
+        """
+        Edit the message of the component, now or at the end of the current window of the message.
+
+        :param ctx: The context of the component.
+        :param version: The version of the session shown by the render.
+        :param fields: The fields of the message, as for `ComponentContext.edit_origin`.
+        """
+        message_id = ctx.origin_message_id
+        if message_id is None:
+            await ctx.edit_origin(**fields)
+        elif message_id in self._cooling_down:
+            # Replace the render waiting for the end of the window before acknowledging, so that it is never missed
+            if version >= self._latest[message_id][0]:
+                self._pending[message_id] = (ctx, fields)
+                self._latest[message_id] = (version, fields)
+            await ctx.defer(edit_origin=True)
+        else:
+            self._cooling_down[message_id] = asyncio.ensure_future(self._cool_down(message_id))
+            self._latest[message_id] = (version, fields)
+            await ctx.edit_origin(**fields)
+
+    async def edit_origin_now(self, ctx: ComponentContext, version: int, **fields):
+        """
+        Edit the message of the component at once, even during the window of the message, for the callbacks which send
+        a follow-up message: a deferred interaction would have its message replaced by the follow-up.
+
+        The latest render of the message is applied: this one, or else the newer render waiting for the end of the
+        window or already applied, so that the message is never brought back to an older state.
+
+        :param ctx: The context of the component.
+        :param version: The version of the session shown by the render.
+        :param fields: The fields of the message, as for `ComponentContext.edit_origin`.
+        """
+        message_id = ctx.origin_message_id
+        if message_id not in self._cooling_down:
+            return await self.edit_origin(ctx, version, **fields)
+
+        if version >= self._latest[message_id][0]:
+            self._latest[message_id] = (version, fields)
+        self._pending.pop(message_id, None)
+        await ctx.edit_origin(**self._latest[message_id][1])
+
+    async def _cool_down(self, message_id: int):
+        """
+        Wait for the end of the window of a message, then apply its latest pending render, until there is none left.
+
+        :param message_id: The Discord id of the message.
+        """
+        try:
+            await asyncio.sleep(self._window)
+            while message_id in self._pending:
+                ctx, fields = self._pending.pop(message_id)
+                try:
+                    # The response to the click has already been deferred: the edit can wait for the interactions
+                    with routed(EDIT, ('message', message_id), merge_key=('message', message_id)):
+                        await ctx.edit_origin(**fields)
+                except Exception:
+                    logger.exception(f"Failed to edit the message {message_id}.")
+                await asyncio.sleep(self._window)
+        finally:
+            del self._cooling_down[message_id]
+            del self._latest[message_id]
+
+
+# Edits of the session details messages, shared by all their buttons
+message_edits = EditCoalescer()
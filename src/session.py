@@ -1,51 +1,58 @@
-from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorDatabase
 from bson.objectid import ObjectId
 from math import modf
-from datetime import datetime
+from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
 import re
 
-from user import User
+from user import User, SWITCH_EMOJI, SCREEN_EMOJI, ADAPTER_EMOJI
+from session_cache import upcoming_sessions
 from exceptions import *
 
 
+###############
+#  CONSTANTS  #
+###############
+# Discord allows up to 25 fields in an embed and 25 options in a dropdown
+PAGE_SIZE = 25
+
+# Recurring sessions can be created for a year of weekly sessions at once
+MAX_REPEAT = 52
+
+
 class Session:
+    # Sessions wrap the documents of the session cache, which are shared: they are never changed in place
+    __slots__ = ('_data', '_index', '_host', '_participants', '_waitlist')
+
     ##################
     #  CONSTRUCTORS  #
     ##################
     def __init__(self, data: dict, index: int):
         """
-        Instantiate a Session object.
+        Instantiate a Session object. The session data is used as is, its host and participants are only wrapped in
+        User objects when they are first used.
 
         :param data: The session data retrieved from the database.
         :param index: The index of the session in the list of the next sessions.
         """
+        self._data = data
         self._index = index
-        self._id = ObjectId(str(data['_id']))
-        self._date_start = data['date_start']
-        self._date_end = data['date_end']
-        self._places = data['places']
-        self._address = data['address']
-        self._comment = data['comment']
-        self._host = User(data['host'])
-        self._participants = [User(user) for user in data['participants']]
+        self._host = None
+        self._participants = None
+        self._waitlist = None
 
     @classmethod
-    def from_index(cls, db: MongoClient, n: int):
+    async def from_index(cls, db: AsyncIOMotorDatabase, n: int, guild_id: int = None):
         """
-        Returns the nth next session.
+        Returns the nth next session of a guild.
 
         :param db: The MongoDB database instance.
         :param n: The index of the nth session to look for.
+        :param guild_id: The Discord id of the guild.
         :return: A Session instance.
         """
-        now = datetime.now()
-
         try:
-            return cls(db['session']
-                       .find({'date_start': {'$gt': now}})
-                       .sort([('date_start', 1), ('_id', 1)])
-                       .skip(n - 1).limit(1)[0], n)
+            return cls(await upcoming_sessions.get_nth(db, n, guild_id), n)
         except IndexError:
             if n == 1:
                 raise NoSessionAvailableError()
@@ -54,22 +61,24 @@ class Session:
                     "Il n'y a pas de session correspondante...\n"
                     "Tu peux voir la liste des sessions à venir avec `/list` !"
                 )
-        except ValueError:
-            raise ValueError("L'argument `n` ne peut pas être négatif !")
 
     @classmethod
-    def from_id(cls, db: MongoClient, session_id: ObjectId):
+    async def from_id(cls, db: AsyncIOMotorDatabase, session_id: ObjectId, guild_id: int = None):
         """
-        Return a session found by its database id.
+        Return a session of a guild found by its database id.
 
         :param db: The MongoDB database instance.
         :param session_id: The database id of the session to look for.
+        :param guild_id: The Discord id of the guild.
         :return: A Session instance.
         """
-        future_sessions = Session.get_future_sessions(db)
-        for future_session in future_sessions:
-            if future_session.id == session_id:
-                return future_session
+        # Past sessions and sessions of other guilds are not part of the cache of the guild
+        try:
+            data, n = await upcoming_sessions.get(db, session_id, guild_id)
+        except KeyError:
+            return None
+
+        return cls(data, n)
 
     #############
     #  METHODS  #
@@ -81,7 +90,7 @@ class Session:
         :param user: The user to look for.
         :return: True if the user is the host of the session, False otherwise.
         """
-        return self._host.id == user.id
+        return self._data['host']['id'] == user.id
 
     def is_participant(self, user: User) -> bool:
         """
@@ -90,7 +99,16 @@ class Session:
         :param user: The user to look for.
         :return: True if the user participates to the session, False otherwise.
         """
-        return user.id in [participant.id for participant in self._participants]
+        return any(participant['id'] == user.id for participant in self._data['participants'])
+
+    def is_waiting(self, user: User) -> bool:
+        """
+        Check if the user is on the waitlist of the session.
+
+        :param user: The user to look for.
+        :return: True if the user waits for a place in the session, False otherwise.
+        """
+        return any(waiting_user['id'] == user.id for waiting_user in self._data.get('waitlist', []))
 
     def add_participant(self, user: User):
         """
@@ -103,13 +121,32 @@ class Session:
             raise UserIsAlreadyHostError()
         if self.is_participant(user):
             raise UserIsAlreadyParticipantError()
+        if self.is_waiting(user):
+            raise UserIsAlreadyWaitingError()
 
         # Check if there are available places
-        if self.nb_participants >= self._places:
+        if self.nb_participants >= self.places:
             raise SessionIsFullError()
 
         # Add participant
-        self._participants.append(user)
+        self._update(participants=[*self._data['participants'], user.data])
+
+    def add_waiting_user(self, user: User):
+        """
+        Add the given user at the end of the waitlist of the session, when it is full.
+
+        :param user: The user to be added.
+        """
+        # Check if user is not already a member of the session
+        if self.is_host(user):
+            raise UserIsAlreadyHostError()
+        if self.is_participant(user):
+            raise UserIsAlreadyParticipantError()
+        if self.is_waiting(user):
+            raise UserIsAlreadyWaitingError()
+
+        # Add waiting user
+        self._update(waitlist=[*self._data.get('waitlist', []), user.data])
 
     def remove_participant(self, user: User):
         """
@@ -126,7 +163,53 @@ class Session:
             raise UserIsNotParticipantError()
 
         # Remove participant
-        self._participants = [participant for participant in self._participants if participant.id != user.id]
+        self._update(participants=[participant for participant in self._data['participants']
+                                   if participant['id'] != user.id])
+
+    def remove_waiting_user(self, user: User):
+        """
+        Remove the given user from the waitlist of the session.
+
+        :param user: The user to be removed.
+        """
+        if not self.is_waiting(user):
+            raise UserIsNotParticipantError()
+
+        # Remove waiting user
+        self._update(waitlist=[waiting_user for waiting_user in self._data['waitlist']
+                               if waiting_user['id'] != user.id])
+
+    def get_waitlist_position(self, user: User) -> int:
+        """
+        Find the position of the given user on the waitlist of the session.
+
+        :param user: The user to look for.
+        :return: The position of the user on the waitlist, starting at 1, or None if the user does not wait.
+        """
+        for position, waiting_user in enumerate(self._data.get('waitlist', []), start=1):
+            if waiting_user['id'] == user.id:
+                return position
+        return None
+
+    def get_waitlist_details(self) -> str:
+        """
+        Returns a string representation of the users on the waitlist of the session, in order.
+
+        :return: The string representation of the waitlist.
+        """
+        return '\n'.join([f'{position}. {user.details}' for position, user in enumerate(self.waitlist, start=1)])
+
+    def get_participant(self, user: User) -> User:
+        """
+        Find the given user among the participants of the session.
+
+        :param user: The user to look for.
+        :return: The participant, with their equipment, or None if the user does not participate.
+        """
+        for participant in self.participants:
+            if participant.id == user.id:
+                return participant
+        return None
 
     def get_participants_details(self) -> str:
         """
@@ -135,10 +218,22 @@ class Session:
         :return: The string representation of the participants.
         """
         if self.nb_participants > 0:
-            return '\n'.join([user.details for user in self._participants])
+            return '\n'.join([user.details for user in self.participants])
         else:
             return 'Aucun participant.'
 
+    def _update(self, **fields):
+        """
+        Change fields of the session on a copy of its data, so that the shared document is left untouched.
+
+        :param fields: The new values of the fields, by name.
+        """
+        self._data = {**self._data, **fields}
+        if 'participants' in fields:
+            self._participants = None
+        if 'waitlist' in fields:
+            self._waitlist = None
+
     ##################
     #  PROPERTIES    #
     ##################
@@ -158,7 +253,27 @@ class Session:
 
         :return: The id attribute.
         """
-        return self._id
+        return self._data['_id']
+
+    @property
+    def guild_id(self) -> int:
+        """
+        Getter for guild_id.
+
+        :return: The guild_id attribute.
+        """
+        # Missing from the sessions created before guilds were stored, which belong to the guild None
+        return self._data.get('guild_id')
+
+    @property
+    def version(self) -> int:
+        """
+        Getter for version.
+
+        :return: The version attribute.
+        """
+        # Incremented by every update of the session, missing from the sessions created before it existed
+        return self._data.get('version', 0)
 
     @property
     def places(self) -> int:
@@ -167,7 +282,7 @@ class Session:
 
         :return: The places attribute.
         """
-        return self._places
+        return self._data['places']
 
     @places.setter
     def places(self, value: int):
@@ -176,7 +291,7 @@ class Session:
 
         :param value: The new places attribute.
         """
-        self._places = value
+        self._update(places=value)
 
     @property
     def address(self) -> str:
@@ -185,10 +300,7 @@ class Session:
 
         :return: The address of the session or a custom message.
         """
-        if self._address is not None:
-            return self._address
-        else:
-            return "Demande ultérieurement en message privé !"
+        return Session.get_address(self._data['address'])
 
     @address.setter
     def address(self, value: str):
@@ -197,7 +309,7 @@ class Session:
 
         :param value: The new address attribute.
         """
-        self._address = value
+        self._update(address=value)
 
     @property
     def comment(self) -> str:
@@ -206,7 +318,7 @@ class Session:
 
         :return: The comment attribute.
         """
-        return self._comment
+        return self._data['comment']
 
     @comment.setter
     def comment(self, value: str):
@@ -215,7 +327,7 @@ class Session:
 
         :param value: The new comment attribute.
         """
-        self._comment = value
+        self._update(comment=value)
 
     @property
     def host(self) -> User:
@@ -224,6 +336,8 @@ class Session:
 
         :return: The host attribute.
         """
+        if self._host is None:
+            self._host = User(self._data['host'])
         return self._host
 
     @property
@@ -233,8 +347,22 @@ class Session:
 
         :return: The participants attribute.
         """
+        if self._participants is None:
+            self._participants = [User(participant) for participant in self._data['participants']]
         return self._participants
 
+    @property
+    def waitlist(self) -> list[User]:
+        """
+        Getter for waitlist. The users who wait for a place are stored apart from the participants, in the order they
+        joined the waitlist.
+
+        :return: The waitlist attribute.
+        """
+        if self._waitlist is None:
+            self._waitlist = [User(waiting_user) for waiting_user in self._data.get('waitlist', [])]
+        return self._waitlist
+
     @property
     def title(self) -> str:
         """
@@ -242,8 +370,7 @@ class Session:
 
         :return: The title of the session.
         """
-        return (f"#{self._index}   {self._date_start.strftime('%A %d %B: %H:%M').title()} → "
-                f"{self._date_end.strftime('%H:%M')}")
+        return Session.get_title(self._index, self._data['date_start'], self._data['date_end'])
 
     @property
     def nb_participants(self) -> int:
@@ -252,26 +379,180 @@ class Session:
 
         :return: The number of participants of the session.
         """
-        return len(self._participants)
+        return len(self._data['participants'])
+
+    @property
+    def equipment(self) -> dict:
+        """
+        Returns the total equipment brought to the session by its host and participants.
+
+        :return: The numbers of consoles, screens and adapters, by field name.
+        """
+        # Sessions created before the summary existed: count the equipment of every user
+        if 'equipment' not in self._data:
+            return Session.count_equipment(self._data)
+        return self._data['equipment']
 
     ####################
     #  STATIC METHODS  #
     ####################
     @staticmethod
-    def get_future_sessions(db: MongoClient) -> list:
+    async def get_future_sessions(db: AsyncIOMotorDatabase, guild_id: int = None) -> list:
         """
-        Get a list of all the future sessions, sorted chronologically.
+        Get a list of all the future sessions of a guild, sorted chronologically.
 
         :param db: The MongoDB database instance.
+        :param guild_id: The Discord id of the guild.
         :return: A list of Session instances containing all the future sessions.
         """
-        now = datetime.now()
         return [
             Session(session, n + 1)
             for n, session in
-            enumerate(db['session'].find({'date_start': {'$gt': now}}).sort([('date_start', 1), ('_id', 1)]))
+            enumerate(await upcoming_sessions.get_all(db, guild_id))
         ]
 
+    @staticmethod
+    async def get_future_sessions_page(db: AsyncIOMotorDatabase, cursor: (datetime, ObjectId) = None,
+                                       backward: bool = False, guild_id: int = None) -> (list, bool):
+        """
+        Get a page of the future sessions of a guild as lean documents, containing only their dates, places, host id
+        and name and number of participants. The page starts right after (or ends right before, if backward) the given
+        cursor, so that the index on (guild_id, date_start, _id) is used as a range instead of skipping the previous
+        sessions.
+
+        :param db: The MongoDB database instance.
+        :param cursor: The (date_start, _id) key of the session the page is relative to, or None for the first page.
+        :param backward: True to get the page before the cursor, False to get the page after the cursor.
+        :param guild_id: The Discord id of the guild.
+        :return: A tuple (list, bool) representing respectively the documents of the page sorted chronologically and
+        whether there are other sessions further in the direction of the page.
+        """
+        match = {'guild_id': guild_id, 'date_start': {'$gt': datetime.now()}}
+        if cursor is not None:
+            operator = '$lt' if backward else '$gt'
+            match['$or'] = [{'date_start': {operator: cursor[0]}},
+                            {'date_start': cursor[0], '_id': {operator: cursor[1]}}]
+        direction = -1 if backward else 1
+
+        documents = await db['session'].aggregate([
+            {'$match': match},
+            {'$sort': {'date_start': direction, '_id': direction}},
+            {'$limit': PAGE_SIZE + 1},
+            {'$project': {
+                'date_start': 1,
+                'date_end': 1,
+                'places': 1,
+                'host.id': 1,
+                'host.name': 1,
+                'nb_participants': {'$size': '$participants'}
+            }}
+        ]).to_list(length=None)
+
+        page = documents[:PAGE_SIZE]
+        if backward:
+            page.reverse()
+        return page, len(documents) > PAGE_SIZE
+
+    @staticmethod
+    async def get_user_sessions(db: AsyncIOMotorDatabase, user_id: int, guild_id: int = None) -> list:
+        """
+        Get the future sessions of a guild a user hosts, participates in or waits for, with a single aggregation, as
+        lean documents containing only their dates, places, host id, number of participants and waitlist ids. Each
+        branch of the $or uses its own index on (guild_id, <member>.id, date_start).
+
+        :param db: The MongoDB database instance.
+        :param user_id: The Discord id of the user.
+        :param guild_id: The Discord id of the guild.
+        :return: The documents of the next sessions of the user, sorted chronologically.
+        """
+        now = datetime.now()
+        return await db['session'].aggregate([
+            {'$match': {'$or': [{'guild_id': guild_id, 'host.id': user_id, 'date_start': {'$gt': now}},
+                                {'guild_id': guild_id, 'participants.id': user_id, 'date_start': {'$gt': now}},
+                                {'guild_id': guild_id, 'waitlist.id': user_id, 'date_start': {'$gt': now}}]}},
+            {'$sort': {'date_start': 1, '_id': 1}},
+            {'$limit': PAGE_SIZE},
+            {'$project': {
+                'guild_id': 1,
+                'date_start': 1,
+                'date_end': 1,
+                'places': 1,
+                'host.id': 1,
+                'waitlist.id': 1,
+                'nb_participants': {'$size': '$participants'}
+            }}
+        ]).to_list(length=None)
+
+    @staticmethod
+    async def get_future_sessions_equipment(db: AsyncIOMotorDatabase, guild_id: int = None) -> list:
+        """
+        Get the equipment summary of the next sessions of a guild with a single aggregation, as lean documents
+        containing only their dates, equipment and number of players.
+
+        :param db: The MongoDB database instance.
+        :param guild_id: The Discord id of the guild.
+        :return: The documents of the next sessions, sorted chronologically.
+        """
+        return await db['session'].aggregate([
+            {'$match': {'guild_id': guild_id, 'date_start': {'$gt': datetime.now()}}},
+            {'$sort': {'date_start': 1, '_id': 1}},
+            {'$limit': PAGE_SIZE},
+            {'$project': {
+                'date_start': 1,
+                'date_end': 1,
+                'equipment': 1,
+                'nb_players': {'$add': [1, {'$size': '$participants'}]}
+            }}
+        ]).to_list(length=None)
+
+    @staticmethod
+    def count_equipment(data: dict) -> dict:
+        """
+        Count the equipment brought to a session by its host and participants.
+
+        :param data: The session data retrieved from the database.
+        :return: The numbers of consoles, screens and adapters, by field name.
+        """
+        users = [data['host'], *data['participants']]
+        return {field: sum(user[field] for user in users) for field in ('consoles', 'screens', 'adapters')}
+
+    @staticmethod
+    def get_equipment_summary(equipment: dict, nb_players: int) -> str:
+        """
+        Returns the equipment brought to a session compared to its number of players.
+
+        :param equipment: The numbers of consoles, screens and adapters, by field name.
+        :param nb_players: The number of players, host included.
+        :return: The equipment summary.
+        """
+        return (f"{equipment['consoles']} {SWITCH_EMOJI}   {equipment['screens']} {SCREEN_EMOJI}   "
+                f"{equipment['adapters']} {ADAPTER_EMOJI}   pour {nb_players} joueur{'s' if nb_players > 1 else ''}")
+
+    @staticmethod
+    def get_title(index: int, date_start: datetime, date_end: datetime) -> str:
+        """
+        Returns the title of a session as its index followed by its date and time.
+
+        :param index: The index of the session in the list of the next sessions.
+        :param date_start: The start date and time of the session.
+        :param date_end: The end date and time of the session.
+        :return: The title of the session.
+        """
+        return f"#{index}   {date_start.strftime('%A %d %B: %H:%M').title()} → {date_end.strftime('%H:%M')}"
+
+    @staticmethod
+    def get_address(address: str) -> str:
+        """
+        Returns the address of a session if available, or custom message otherwise.
+
+        :param address: The address of the session, or None if it was not given.
+        :return: The address of the session or a custom message.
+        """
+        if address is not None:
+            return address
+        else:
+            return "Demande ultérieurement en message privé !"
+
     @staticmethod
     def get_dates(day: int, start_hour: float, end_hour: float) -> (datetime, datetime):
         """
@@ -306,6 +587,26 @@ class Session:
 
         return date_start, date_end
 
+    @staticmethod
+    def get_recurring_dates(date_start: datetime, date_end: datetime, repeat: int, interval: int) -> list:
+        """
+        From the dates of a first session, returns the dates of the sessions repeated at a regular interval.
+
+        :param date_start: The start date and time of the first session.
+        :param date_end: The end date and time of the first session.
+        :param repeat: The number of sessions, the first one included.
+        :param interval: The number of days between two sessions.
+        :return: A list of tuples (datetime, datetime) representing respectively the start and end dates of every
+        session, sorted chronologically.
+        """
+        if repeat < 1 or repeat > MAX_REPEAT:
+            raise ValueError(f"Tu peux créer entre 1 et {MAX_REPEAT} sessions à la fois.")
+        if interval < 1:
+            raise ValueError("Il doit y avoir au moins un jour entre deux sessions.")
+
+        return [(date_start + timedelta(days=n * interval), date_end + timedelta(days=n * interval))
+                for n in range(repeat)]
+
     @staticmethod
     def get_index_from_title(title: str) -> int:
         return int(re.search(r'#(\d*) ', title).group(1))
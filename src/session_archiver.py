@@ -0,0 +1,86 @@
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo.errors import BulkWriteError, PyMongoError
+from datetime import datetime
+import asyncio
+import logging
+import os
+
+
+###############
+#  CONSTANTS  #
+###############
+DEFAULT_ARCHIVE_INTERVAL = float(os.environ.get('SMASH_SESSION_ARCHIVE_INTERVAL', 3600))
+DEFAULT_BATCH_SIZE = int(os.environ.get('SMASH_SESSION_ARCHIVE_BATCH_SIZE', 500))
+DUPLICATE_KEY_ERROR = 11000
+
+logger = logging.getLogger(__name__)
+
+
+class SessionArchiver:
+    ##################
+    #  CONSTRUCTORS  #
+    ##################
+    def __init__(self, interval: float = DEFAULT_ARCHIVE_INTERVAL, batch_size: int = DEFAULT_BATCH_SIZE):
+        """
+        Instantiate a SessionArchiver object, which moves the finished sessions from the session collection to the
+        session_archive collection, so that the queries of the bot only work on the sessions to come.
+
+        :param interval: The number of seconds between two archivals.
+        :param batch_size: The maximum number of sessions moved with a single insert and a single delete.
+        """
+        self._interval = interval
+        self._batch_size = batch_size
+
+    #############
+    #  METHODS  #
+    #############
+    async def run(self, db: AsyncIOMotorDatabase):
+        """
+        Archive the finished sessions at a fixed interval, forever.
+
+        :param db: The MongoDB database instance.
+        """
+        while True:
+            try:
+                archived = await self.archive(db)
+                if archived > 0:
+                    logger.info(f"Archived {archived} finished sessions.")
+            except PyMongoError as exception:
+                logger.warning(f"Could not archive the finished sessions ({exception}).")
+            await asyncio.sleep(self._interval)
+
+    async def archive(self, db: AsyncIOMotorDatabase) -> int:
+        """
+        Move all the sessions which are over to the archive, batch by batch.
+
+        :param db: The MongoDB database instance.
+        :return: The number of archived sessions.
+        """
+        now = datetime.now()
+        archived = 0
+        while True:
+            documents = await (db['session']
+                               .find({'date_end': {'$lt': now}})
+                               .sort('date_end', 1)
+                               .limit(self._batch_size)
+                               .to_list(length=None))
+            if len(documents) == 0:
+                return archived
+
+            await self._insert(db, documents)
+            await db['session'].delete_many({'_id': {'$in': [document['_id'] for document in documents]}})
+            archived += len(documents)
+
+    @staticmethod
+    async def _insert(db: AsyncIOMotorDatabase, documents: list[dict]):
+        """
+        Insert a batch of sessions in the archive. Sessions already archived by an interrupted archival are skipped.
+
+        :param db: The MongoDB database instance.
+        :param documents: The session documents.
+        """
+        try:
+            await db['session_archive'].insert_many(documents, ordered=False)
+        except BulkWriteError as exception:
+            if any(error['code'] != DUPLICATE_KEY_ERROR for error in exception.details['writeErrors']):
+                raise
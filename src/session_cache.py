@@ -0,0 +1,242 @@
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from bson.objectid import ObjectId
+from datetime import datetime
+from bisect import bisect_left, bisect_right, insort
+import asyncio
+import os
+import time
+
+from metrics import metrics
+
+
+###############
+#  CONSTANTS  #
+###############
+DEFAULT_TTL = float(os.environ.get('SMASH_SESSION_CACHE_TTL', 300))
+
+
+class SessionCache:
+    ##################
+    #  CONSTRUCTORS  #
+    ##################
+    def __init__(self, ttl: float = DEFAULT_TTL):
+        """
+        Instantiate an empty SessionCache object, an in-memory copy of the upcoming sessions.
+
+        The cache holds the documents of the upcoming sessions along with their (date_start, _id) keys, sorted the same
+        way as the session list, so that sessions are found by index or by id without reading the database. It is
+        updated write-through by the actions, and fully reloaded once its time to live has expired as a safety net.
+
+        Sessions are numbered per guild, so the keys are kept per guild. A guild is only loaded on its first read, so
+        that a process only holds the sessions of the guilds it serves. Sessions created before guilds were stored
+        belong to the guild None.
+
+        The writes made while a guild is loaded are recorded, and applied again on top of the documents read by the
+        load, which may have been read before them.
+
+        :param ttl: The number of seconds after which the cache of a guild is reloaded from the database.
+        """
+        self._ttl = ttl
+        self._keys = {}
+        self._documents = {}
+        self._loaded_at = {}
+        self._loading = {}
+        self.hits = 0
+        self.misses = 0
+
+    #############
+    #  METHODS  #
+    #############
+    async def load(self, db: AsyncIOMotorDatabase, guild_id: int = None):
+        """
+        (Re)build the cache of a guild from the database with a single query on its upcoming sessions.
+
+        :param db: The MongoDB database instance.
+        :param guild_id: The Discord id of the guild.
+        """
+        # Record the writes made while the query runs, as its result may predate them
+        writes = {}
+        self._loading.setdefault(guild_id, []).append(writes)
+        try:
+            documents = await (db['session']
+                               .find({'guild_id': guild_id, 'date_start': {'$gt': datetime.now()}})
+                               .sort([('date_start', 1), ('_id', 1)])
+                               .to_list(length=None))
+        finally:
+            self._loading[guild_id] = [loading for loading in self._loading[guild_id] if loading is not writes]
+            if len(self._loading[guild_id]) == 0:
+                del self._loading[guild_id]
+
+        # Apply the recorded writes on top of the result, a removed session being recorded as None
+        documents = {document['_id']: document for document in documents}
+        documents.update(writes)
+        now = datetime.now()
+        documents = [document for document in documents.values()
+                     if document is not None and document['date_start'] > now]
+
+        for _, session_id in self._keys.get(guild_id, []):
+            self._documents.pop(session_id, None)
+        self._keys[guild_id] = sorted((document['date_start'], document['_id']) for document in documents)
+        self._documents.update({document['_id']: document for document in documents})
+        self._loaded_at[guild_id] = time.monotonic()
+
+    async def reload(self, db: AsyncIOMotorDatabase):
+        """
+        Rebuild the cache of every loaded guild from the database.
+
+        :param db: The MongoDB database instance.
+        """
+        await asyncio.gather(*[self.load(db, guild_id) for guild_id in list(self._loaded_at)])
+
+    def put(self, document: dict):
+        """
+        Insert or replace a session in the cache, at its chronological position. Sessions of the guilds which are not
+        loaded are ignored, unless they are being loaded.
+
+        :param document: The session document, as stored in the database.
+        """
+        guild_id = document.get('guild_id')
+        if guild_id in self._loaded_at:
+            self.remove(document['_id'])
+            if document['date_start'] > datetime.now():
+                insort(self._keys[guild_id], (document['date_start'], document['_id']))
+                self._documents[document['_id']] = document
+        for writes in self._loading.get(guild_id, []):
+            writes[document['_id']] = document
+
+    def remove(self, session_id: ObjectId):
+        """
+        Remove a session from the cache if it is present.
+
+        :param session_id: The database id of the session.
+        """
+        document = self._documents.pop(session_id, None)
+
+        # The guild of a session which is not cached is unknown: it is recorded as removed in every guild being loaded
+        guild_ids = [document.get('guild_id')] if document is not None else list(self._loading)
+        for guild_id in guild_ids:
+            for writes in self._loading.get(guild_id, []):
+                writes[session_id] = None
+        if document is None:
+            return
+        keys = self._keys[document.get('guild_id')]
+        position = bisect_left(keys, (document['date_start'], session_id))
+        del keys[position]
+
+    def peek(self, session_id: ObjectId) -> dict:
+        """
+        Returns the cached document of a session without reading the database, or None if it is not cached.
+
+        :param session_id: The database id of the session.
+        :return: The session document or None.
+        """
+        return self._documents.get(session_id)
+
+    def invalidate(self):
+        """
+        Mark the cache as outdated, so that every guild is reloaded from the database on its next read.
+        """
+        self._keys = {}
+        self._documents = {}
+        self._loaded_at = {}
+
+    async def get_nth(self, db: AsyncIOMotorDatabase, n: int, guild_id: int = None) -> dict:
+        """
+        Returns the document of the nth next session of a guild.
+
+        :param db: The MongoDB database instance.
+        :param n: The index of the nth session to look for.
+        :param guild_id: The Discord id of the guild.
+        :return: The session document.
+        """
+        if n < 1:
+            raise ValueError("L'argument `n` ne peut pas être négatif !")
+        await self._refresh(db, guild_id)
+        return self._documents[self._keys[guild_id][n - 1][1]]
+
+    async def get(self, db: AsyncIOMotorDatabase, session_id: ObjectId, guild_id: int = None) -> (dict, int):
+        """
+        Returns the document of an upcoming session of a guild found by its database id, with its index.
+
+        :param db: The MongoDB database instance.
+        :param session_id: The database id of the session.
+        :param guild_id: The Discord id of the guild.
+        :return: A tuple (dict, int) representing respectively the session document and its index, starting at 1.
+        """
+        await self._refresh(db, guild_id)
+        document = self._documents[session_id]
+        if document.get('guild_id') != guild_id:
+            raise KeyError(session_id)
+        return document, bisect_left(self._keys[guild_id], (document['date_start'], session_id)) + 1
+
+    async def get_index(self, db: AsyncIOMotorDatabase, document: dict) -> int:
+        """
+        Returns the index of an upcoming session in its guild, from its document, without reading the database.
+
+        :param db: The MongoDB database instance.
+        :param document: The session document, projected or not.
+        :return: The index of the session, starting at 1.
+        """
+        guild_id = document.get('guild_id')
+        await self._refresh(db, guild_id)
+        return bisect_left(self._keys[guild_id], (document['date_start'], document['_id'])) + 1
+
+    async def get_all(self, db: AsyncIOMotorDatabase, guild_id: int = None) -> list[dict]:
+        """
+        Returns the documents of all the upcoming sessions of a guild, sorted chronologically.
+
+        :param db: The MongoDB database instance.
+        :param guild_id: The Discord id of the guild.
+        :return: The list of the session documents.
+        """
+        await self._refresh(db, guild_id)
+        return [self._documents[session_id] for _, session_id in self._keys[guild_id]]
+
+    async def _refresh(self, db: AsyncIOMotorDatabase, guild_id: int):
+        """
+        Load the cache of a guild if it was never loaded or if its time to live has expired, then drop the sessions of
+        the guild which have already started.
+
+        :param db: The MongoDB database instance.
+        :param guild_id: The Discord id of the guild.
+        """
+        loaded_at = self._loaded_at.get(guild_id)
+        if loaded_at is None or time.monotonic() - loaded_at > self._ttl:
+            self.misses += 1
+            metrics.cache_reads['miss'] += 1
+            await self.load(db, guild_id)
+        else:
+            self.hits += 1
+            metrics.cache_reads['hit'] += 1
+
+        keys = self._keys[guild_id]
+        position = bisect_right(keys, (datetime.now(), ObjectId('f' * 24)))
+        for _, session_id in keys[:position]:
+            del self._documents[session_id]
+        del keys[:position]
+
+    ################
+    #  PROPERTIES  #
+    ################
+    @property
+    def hit_ratio(self) -> float:
+        """
+        Compute the ratio of the reads served from memory.
+
+        :return: The hit ratio, between 0 and 1.
+        """
+        reads = self.hits + self.misses
+        return self.hits / reads if reads > 0 else 0.
+
+    @property
+    def guild_ids(self) -> list[int]:
+        """
+        Returns the guilds whose sessions are cached.
+
+        :return: The Discord ids of the loaded guilds.
+        """
+        return list(self._loaded_at)
+
+
+# Cache shared by all the lookups of the bot
+upcoming_sessions = SessionCache()
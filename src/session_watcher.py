@@ -0,0 +1,163 @@
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo.errors import OperationFailure, PyMongoError
+import asyncio
+import logging
+import os
+
+from session_cache import SessionCache
+
+
+###############
+#  CONSTANTS  #
+###############
+DEFAULT_POLL_INTERVAL = float(os.environ.get('SMASH_SESSION_POLL_INTERVAL', 30))
+RETRY_DELAY = 5
+
+# Error codes of MongoDB when change streams are not supported, by a standalone server or a storage engine
+CHANGE_STREAMS_UNSUPPORTED = (40573, 40324)
+
+logger = logging.getLogger(__name__)
+
+
+class SessionWatcher:
+    ##################
+    #  CONSTRUCTORS  #
+    ##################
+    def __init__(self, cache: SessionCache, poll_interval: float = DEFAULT_POLL_INTERVAL):
+        """
+        Instantiate a SessionWatcher object, which keeps a session cache in sync with changes made by other processes.
+
+        :param cache: The session cache to keep in sync.
+        :param poll_interval: The number of seconds between two reloads of the cache when change streams are not
+        available.
+        """
+        self._cache = cache
+        self._poll_interval = poll_interval
+        self._resume_token = None
+
+    #############
+    #  METHODS  #
+    #############
+    async def run(self, db: AsyncIOMotorDatabase):
+        """
+        Follow the change events of the session collection and apply them to the cache, forever. Fall back to polling
+        when the database does not support change streams.
+
+        :param db: The MongoDB database instance.
+        """
+        while True:
+            try:
+                stream = db['session'].watch(resume_after=self._resume_token)
+            except TypeError as exception:
+                # In-memory stand-ins do not implement change streams
+                logger.warning(f"Change streams are not available ({exception}), falling back to polling.")
+                return await self.poll(db)
+
+            try:
+                async with stream:
+                    async for change in stream:
+                        self.apply(change)
+                        self._resume_token = stream.resume_token
+            except OperationFailure as exception:
+                if exception.code in CHANGE_STREAMS_UNSUPPORTED:
+                    # Standalone servers do not implement change streams
+                    logger.warning(f"Change streams are not available ({exception}), falling back to polling.")
+                    return await self.poll(db)
+                # The stream cannot be resumed, for instance once its resume token is out of the oplog: start over
+                # from the current state of the database instead
+                logger.warning(f"Change stream lost ({exception}), reloading the session cache in {RETRY_DELAY} "
+                               f"seconds.")
+                self._restart()
+                await asyncio.sleep(RETRY_DELAY)
+            except PyMongoError as exception:
+                logger.warning(f"Change stream interrupted ({exception}), resuming in {RETRY_DELAY} seconds.")
+                await asyncio.sleep(RETRY_DELAY)
+            except Exception as exception:
+                # The change would fail again once resumed: start over from the current state of the database instead
+                logger.exception(f"Could not apply a change to the session cache ({exception}), reloading it in "
+                                 f"{RETRY_DELAY} seconds.")
+                self._restart()
+                await asyncio.sleep(RETRY_DELAY)
+
+    def _restart(self):
+        """
+        Forget the position of the stream and the cached sessions, so that the next stream starts from the current
+        state of the database.
+        """
+        self._cache.invalidate()
+        self._resume_token = None
+
+    async def poll(self, db: AsyncIOMotorDatabase):
+        """
+        Reload the cache at a fixed interval, forever.
+
+        :param db: The MongoDB database instance.
+        """
+        while True:
+            await asyncio.sleep(self._poll_interval)
+            try:
+                await self._cache.reload(db)
+            except PyMongoError as exception:
+                logger.warning(f"Could not reload the session cache ({exception}).")
+
+    def apply(self, change: dict):
+        """
+        Apply a change event of the session collection to the cache.
+
+        :param change: The change event, as sent by the change stream.
+        """
+        operation = change['operationType']
+        if operation in ('insert', 'replace'):
+            self._cache.put(change['fullDocument'])
+        elif operation == 'update':
+            document = self._cache.peek(change['documentKey']['_id'])
+            if document is not None:
+                self._cache.put(SessionWatcher.patch(document, change['updateDescription']))
+        elif operation == 'delete':
+            self._cache.remove(change['documentKey']['_id'])
+        elif operation in ('drop', 'rename', 'dropDatabase', 'invalidate'):
+            self._cache.invalidate()
+
+    ####################
+    #  STATIC METHODS  #
+    ####################
+    @staticmethod
+    def patch(document: dict, description: dict) -> dict:
+        """
+        Apply the update description of a change event to a copy of a document.
+
+        :param document: The document as it was before the update.
+        :param description: The update description, with the updated fields and removed fields as dotted paths.
+        :return: The updated document.
+        """
+        document = {**document}
+        copied = set()
+
+        def parent_of(path: str):
+            # Copy the containers along the path before modifying them, the cached document may still be referenced
+            keys = path.split('.')
+            container = document
+            for depth, key in enumerate(keys[:-1]):
+                key = int(key) if isinstance(container, list) else key
+                if '.'.join(keys[:depth + 1]) not in copied:
+                    container[key] = container[key].copy()
+                    copied.add('.'.join(keys[:depth + 1]))
+                container = container[key]
+            last = keys[-1]
+            return container, int(last) if isinstance(container, list) else last
+
+        for truncated in description.get('truncatedArrays', []):
+            container, key = parent_of(truncated['field'])
+            container[key] = container[key][:truncated['newSize']]
+        for path in description.get('removedFields', []):
+            container, key = parent_of(path)
+            if isinstance(container, dict):
+                container.pop(key, None)
+        for path, value in description.get('updatedFields', {}).items():
+            container, key = parent_of(path)
+            if isinstance(container, list) and key == len(container):
+                container.append(value)
+            else:
+                container[key] = value
+
+        return document
@@ -1,7 +1,22 @@
 import unittest
+import asyncio
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, patch
+from datetime import datetime, timedelta
+from mongomock_motor import AsyncMongoMockClient
+from pymongo.errors import OperationFailure
 
 from main import *
 from actions import *
+from database import connect_in_memory
+from session_cache import SessionCache
+from session_watcher import SessionWatcher
+from session_archiver import SessionArchiver
+from metrics import Metrics
+from responses import DeferringSlashCommand, EditCoalescer
+from reminders import ReminderScheduler
+from outbound import OutboundDispatcher, INTERACTION, EDIT, BACKGROUND
+from indexes import ensure_indexes, SESSION_INDEXES, SUPERSEDED_INDEXES
 
 
 me = User({
@@ -14,15 +29,974 @@ me = User({
 })
 
 
-class Join(unittest.TestCase):
-    def test_join_session_already_host(self):
-        pass
+def user(n: int) -> User:
+    return User({'id': n, 'name': f'user{n}', 'discriminator': '0000', 'consoles': 0, 'screens': 0, 'adapters': 0})
 
-    def test_join_session_already_participant(self):
-        pass
 
-    def test_join_session_full(self):
-        pass
+class SessionTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        # Run the actions against an in-memory stand-in of the database
+        db.use(connect_in_memory())
+        upcoming_sessions.invalidate()
+        await upcoming_sessions.load(db)
+        self.session = await self.create(days=1, places=3)
+
+    @staticmethod
+    async def create(days: float, places: int, host: User = me) -> Session:
+        return await create_session(host, datetime.now() + timedelta(days=days),
+                                    datetime.now() + timedelta(days=days, hours=4), places, None, None)
+
+    async def snapshot(self) -> Session:
+        # Each interaction works on its own copy of the session, loaded before the others are applied
+        return await Session.from_id(db, self.session.id)
+
+    async def stored(self) -> dict:
+        # Read the session from the database itself, bypassing the cache
+        return await db['session'].find_one({'_id': self.session.id})
+
+
+class Create(SessionTestCase):
+    async def test_create_session(self):
+        self.assertEqual(1, self.session.index)
+        self.assertTrue(self.session.is_host(me))
+        self.assertEqual(0, self.session.nb_participants)
+        self.assertEqual(3, (await self.stored())['places'])
+
+    async def test_create_session_index(self):
+        earlier = await self.create(days=0.5, places=1)
+        later = await self.create(days=2, places=1)
+
+        self.assertEqual((1, 3), (earlier.index, later.index))
+        self.assertEqual(2, (await self.snapshot()).index)
+
+    async def test_create_session_negative_places(self):
+        with self.assertRaises(ValueError):
+            await self.create(days=1, places=-1)
+
+    async def test_create_session_missing_from_cache(self):
+        with patch.object(Session, 'from_id', AsyncMock(return_value=None)), self.assertRaises(SessionNotFoundError):
+            await self.create(days=1, places=1)
+
+
+class CreateRecurring(SessionTestCase):
+    async def test_create_recurring_sessions(self):
+        date_start = datetime.now() + timedelta(hours=1)
+        dates = Session.get_recurring_dates(date_start, date_start + timedelta(hours=4), 4, 7)
+        first = await create_sessions(me, dates, 2, None, None)
+
+        self.assertEqual(1, first.index)
+        self.assertEqual(date_start, upcoming_sessions.peek(first.id)['date_start'])
+        starts = [document['date_start'] for document in await upcoming_sessions.get_all(db)]
+        self.assertEqual([date_start + timedelta(days=7 * n) for n in range(4)], [starts[0], *starts[2:]])
+        self.assertEqual(5, await db['session'].count_documents({}))
+
+    async def test_recurring_dates_bounds(self):
+        date_start = datetime.now()
+        with self.assertRaises(ValueError):
+            Session.get_recurring_dates(date_start, date_start, MAX_REPEAT + 1, 7)
+        with self.assertRaises(ValueError):
+            Session.get_recurring_dates(date_start, date_start, 2, 0)
+
+
+class Join(SessionTestCase):
+    async def test_join_session(self):
+        session = await join_session(await self.snapshot(), User.from_author(user(1), consoles=1, adapters=2))
+
+        self.assertTrue(session.is_participant(user(1)))
+        self.assertEqual([{'id': 1, 'name': 'user1', 'discriminator': '0000', 'consoles': 1, 'screens': 0,
+                           'adapters': 2}], (await self.stored())['participants'])
+
+    async def test_join_session_already_host(self):
+        with self.assertRaises(UserIsAlreadyHostError):
+            await join_session(await self.snapshot(), me)
+
+    async def test_join_session_already_participant(self):
+        await join_session(await self.snapshot(), user(1))
+
+        with self.assertRaises(UserIsAlreadyParticipantError):
+            await join_session(await self.snapshot(), user(1))
+
+    async def test_join_session_full(self):
+        for n in range(3):
+            await join_session(await self.snapshot(), user(n))
+
+        session = await join_session(await self.snapshot(), user(3))
+        self.assertFalse(session.is_participant(user(3)))
+        self.assertEqual(1, session.get_waitlist_position(user(3)))
+        self.assertEqual(3, len((await self.stored())['participants']))
+
+
+class Leave(SessionTestCase):
+    async def test_leave_session(self):
+        await join_session(await self.snapshot(), user(1))
+        await join_session(await self.snapshot(), user(2))
+        session, promoted = await leave_session(await self.snapshot(), user(1))
+
+        self.assertFalse(session.is_participant(user(1)))
+        self.assertEqual([], promoted)
+        self.assertEqual([2], [participant['id'] for participant in (await self.stored())['participants']])
+
+    async def test_leave_session_host(self):
+        with self.assertRaises(UserIsHostError):
+            await leave_session(await self.snapshot(), me)
+
+    async def test_leave_session_not_participant(self):
+        with self.assertRaises(UserIsNotParticipantError):
+            await leave_session(await self.snapshot(), user(1))
+
+
+class Guilds(SessionTestCase):
+    async def test_sessions_are_numbered_per_guild(self):
+        first = await create_session(me, datetime.now() + timedelta(days=2),
+                                     datetime.now() + timedelta(days=2, hours=4), 3, None, None, guild_id=1)
+        second = await create_session(me, datetime.now() + timedelta(days=3),
+                                      datetime.now() + timedelta(days=3, hours=4), 3, None, None, guild_id=2)
+
+        self.assertEqual((1, 1), (first.index, second.index))
+        self.assertEqual(first.id, (await Session.from_index(db, 1, 1)).id)
+        self.assertEqual(self.session.id, (await Session.from_index(db, 1)).id)
+        self.assertIsNone(await Session.from_id(db, first.id, 2))
+
+    async def test_cache_only_holds_the_loaded_guilds(self):
+        cache = SessionCache(ttl=60)
+        await cache.load(db, 1)
+        await create_session(me, datetime.now() + timedelta(days=2), datetime.now() + timedelta(days=2, hours=4),
+                             3, None, None, guild_id=2)
+        cache.put(await db['session'].find_one({'guild_id': 2}))
+
+        self.assertEqual([1], cache.guild_ids)
+        self.assertEqual([], await cache.get_all(db, 1))
+
+    async def test_legacy_sessions_are_moved_to_a_guild(self):
+        await db['session'].update_one({'_id': self.session.id}, {'$unset': {'guild_id': ''}})
+        await backfill_guild(1)
+
+        self.assertEqual(1, (await self.stored())['guild_id'])
+
+    async def test_legacy_sessions_are_moved_to_the_only_guild(self):
+        await db['session'].update_one({'_id': self.session.id}, {'$unset': {'guild_id': ''}})
+        with patch('main.bot', SimpleNamespace(guilds=[SimpleNamespace(id=1)])):
+            await backfill_legacy_sessions()
+
+        self.assertEqual(1, (await self.stored())['guild_id'])
+
+    async def test_legacy_sessions_are_reported_among_several_guilds(self):
+        await db['session'].update_one({'_id': self.session.id}, {'$unset': {'guild_id': ''}})
+        with patch('main.bot', SimpleNamespace(guilds=[SimpleNamespace(id=1), SimpleNamespace(id=2)])), \
+                self.assertLogs('main', 'WARNING'):
+            await backfill_legacy_sessions()
+
+        self.assertNotIn('guild_id', await self.stored())
+
+
+class Pagination(SessionTestCase):
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        # Sessions start two by two, so that the pages are also split between sessions starting at the same time
+        date_start = datetime.now() + timedelta(days=2)
+        for n in range(54):
+            await create_session(me, date_start + timedelta(hours=n // 2), date_start + timedelta(hours=n // 2 + 4), 3,
+                                 None, None)
+
+    @staticmethod
+    async def page(custom_id: str = None, backward: bool = False) -> (list[int], list[str], dict, dict):
+        if custom_id is None:
+            embed, components = await get_session_list_message()
+        else:
+            index, cursor = parse_list_custom_id(custom_id)
+            embed, components = await get_session_list_message(index, cursor, backward)
+        indexes = [int(field.name.split()[0][1:]) for field in embed.fields]
+        session_ids = [option['value'] for option in components[0]['components'][0]['options']]
+        previous, following = components[1]['components']
+        return indexes, session_ids, previous, following
+
+    async def test_pages_follow_each_other(self):
+        session_ids = [str(document['_id']) for document in await upcoming_sessions.get_all(db)]
+
+        indexes, first_ids, previous, following = await self.page()
+        self.assertEqual((list(range(1, 26)), session_ids[:25]), (indexes, first_ids))
+        self.assertEqual((True, False), (previous.get('disabled', False), following.get('disabled', False)))
+
+        indexes, second_ids, previous, following = await self.page(following['custom_id'])
+        self.assertEqual((list(range(26, 51)), session_ids[25:50]), (indexes, second_ids))
+        self.assertEqual((False, False), (previous.get('disabled', False), following.get('disabled', False)))
+
+        indexes, last_ids, previous, following = await self.page(following['custom_id'])
+        self.assertEqual((list(range(51, 56)), session_ids[50:]), (indexes, last_ids))
+        self.assertEqual((False, True), (previous.get('disabled', False), following.get('disabled', False)))
+
+        indexes, ids, previous, following = await self.page(previous['custom_id'], backward=True)
+        self.assertEqual((list(range(26, 51)), second_ids), (indexes, ids))
+
+        indexes, ids, previous, following = await self.page(previous['custom_id'], backward=True)
+        self.assertEqual((list(range(1, 26)), first_ids), (indexes, ids))
+        self.assertEqual((True, False), (previous.get('disabled', False), following.get('disabled', False)))
+
+    async def test_single_page_has_no_buttons(self):
+        await db['session'].delete_many({'_id': {'$ne': self.session.id}})
+        upcoming_sessions.invalidate()
+
+        _, components = await get_session_list_message()
+        self.assertEqual(1, len(components))
+
+
+class Waitlist(SessionTestCase):
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        for n in range(3):
+            await join_session(await self.snapshot(), user(n))
+        await join_session(await self.snapshot(), User.from_author(user(3), consoles=1))
+        await join_session(await self.snapshot(), user(4))
+
+    async def test_waitlist_is_kept_apart_from_participants(self):
+        stored = await self.stored()
+
+        self.assertEqual([0, 1, 2], [participant['id'] for participant in stored['participants']])
+        self.assertEqual([3, 4], [waiting_user['id'] for waiting_user in stored['waitlist']])
+        self.assertEqual(2, (await self.snapshot()).get_waitlist_position(user(4)))
+
+    async def test_join_waitlist_twice(self):
+        with self.assertRaises(UserIsAlreadyWaitingError):
+            await join_session(await self.snapshot(), user(3))
+
+    async def test_leave_promotes_first_waiting_user(self):
+        session, promoted = await leave_session(await self.snapshot(), user(1))
+
+        self.assertEqual([3], [promoted_user.id for promoted_user in promoted])
+        self.assertTrue(session.is_participant(user(3)))
+        stored = await self.stored()
+        self.assertEqual([0, 3, 2], [participant['id'] for participant in stored['participants']])
+        self.assertEqual([4], [waiting_user['id'] for waiting_user in stored['waitlist']])
+        self.assertEqual(1, stored['equipment']['consoles'])
+
+    async def test_leave_waitlist(self):
+        session, promoted = await leave_session(await self.snapshot(), user(3))
+
+        self.assertEqual([], promoted)
+        self.assertEqual(1, session.get_waitlist_position(user(4)))
+        self.assertEqual(3, session.nb_participants)
+
+    async def test_new_places_promote_waiting_users(self):
+        session, promoted = await update_session(await self.snapshot(), 4, None, None)
+
+        self.assertEqual([3], [promoted_user.id for promoted_user in promoted])
+        self.assertEqual((4, 1), (session.nb_participants, len(session.waitlist)))
+
+        session, promoted = await update_session(await self.snapshot(), 10, None, None)
+        self.assertEqual([4], [promoted_user.id for promoted_user in promoted])
+        self.assertEqual([], (await self.stored())['waitlist'])
+
+    async def test_stale_leave_promotes_a_concurrently_waiting_user(self):
+        session = await self.create(days=2, places=1)
+        await join_session(await Session.from_id(db, session.id), user(5))
+        stale = await Session.from_id(db, session.id)
+        await join_session(await Session.from_id(db, session.id), user(6))
+
+        session, promoted = await leave_session(stale, user(5))
+
+        self.assertEqual([6], [promoted_user.id for promoted_user in promoted])
+        self.assertEqual(([6], []), ([participant.id for participant in session.participants], session.waitlist))
+
+    async def test_stale_new_places_promote_a_concurrently_waiting_user(self):
+        session = await self.create(days=2, places=1)
+        await join_session(await Session.from_id(db, session.id), user(5))
+        stale = await Session.from_id(db, session.id)
+        await join_session(await Session.from_id(db, session.id), user(6))
+
+        session, promoted = await update_session(stale, 3, None, None)
+
+        self.assertEqual([6], [promoted_user.id for promoted_user in promoted])
+        self.assertEqual(([5, 6], []), ([participant.id for participant in session.participants], session.waitlist))
+
+    async def test_waitlist_notice_follows_a_coalesced_click(self):
+        custom_id = f'btn_join_session_callback:{self.session.id}'
+        ctx = FakeClickContext(user(6), custom_id)
+        with patch('main.message_edits', EditCoalescer(window=0.5)):
+            await btn_join_session_callback.invoke(FakeClickContext(user(5), custom_id))
+            await btn_join_session_callback.invoke(ctx)
+
+        self.assertEqual([('edit_origin', None), ('follow-up', get_waitlist_message(await self.snapshot(), user(6)))],
+                         ctx.responses)
+
+    async def test_concurrent_leaves_promote_each_waiting_user_once(self):
+        snapshots = [await self.snapshot() for _ in range(3)]
+        results = await asyncio.gather(*[leave_session(snapshot, user(n)) for n, snapshot in enumerate(snapshots)])
+
+        promoted = [promoted_user.id for _, users in results for promoted_user in users]
+        self.assertEqual([3, 4], sorted(promoted))
+        stored = await self.stored()
+        self.assertEqual([3, 4], sorted(participant['id'] for participant in stored['participants']))
+        self.assertEqual([], stored['waitlist'])
+
+
+class Indexes(SessionTestCase):
+    async def test_superseded_indexes_are_dropped(self):
+        await db['session'].create_index([('date_start', 1), ('_id', 1)], name='date_start_id')
+        await db['session'].create_index([('host.id', 1), ('date_start', 1)], name='host_id_date_start')
+
+        await ensure_indexes(db)
+        await ensure_indexes(db)
+
+        names = set(await db['session'].index_information())
+        self.assertTrue(names.isdisjoint(SUPERSEDED_INDEXES))
+        self.assertTrue(names.issuperset(index.document['name'] for index in SESSION_INDEXES))
+
+
+class UserSessions(SessionTestCase):
+    async def test_user_sessions_are_found_with_their_role(self):
+        other = await self.create(days=2, places=1, host=user(1))
+        await join_session(await self.snapshot(), user(1))
+        await join_session(await Session.from_id(db, other.id), user(2))
+        await join_session(await Session.from_id(db, other.id), me)
+        await self.create(days=3, places=1, host=user(3))
+
+        embed, _ = await get_user_sessions_message(user(1))
+        self.assertEqual(["Participant", "Hôte"], [field.value.split('\n')[0] for field in embed.fields])
+        embed, _ = await get_user_sessions_message(me)
+        self.assertEqual(["#1", "#2"], [field.name.split()[0] for field in embed.fields])
+        self.assertEqual("Liste d'attente (position 1)", embed.fields[1].value.split('\n')[0])
+
+    async def test_user_without_session(self):
+        with self.assertRaises(NoUserSessionError):
+            await get_user_sessions_message(user(1))
+
+
+class BringEquipment(SessionTestCase):
+    async def test_bring_equipment_host(self):
+        session = await bring_equipment(await self.snapshot(), me, Equipment.Screen)
+
+        self.assertEqual(1, session.host.screens)
+        self.assertEqual(1, (await self.stored())['host']['screens'])
+
+    async def test_bring_equipment_participant(self):
+        await join_session(await self.snapshot(), user(1))
+        await join_session(await self.snapshot(), user(2))
+        session = await bring_equipment(await self.snapshot(), user(2), Equipment.Adapter)
+
+        self.assertEqual([0, 1], [participant.adapters for participant in session.participants])
+        self.assertEqual([0, 1], [participant['adapters'] for participant in (await self.stored())['participants']])
+
+    async def test_bring_equipment_not_participant(self):
+        with self.assertRaises(UserIsNotParticipantError):
+            await bring_equipment(await self.snapshot(), user(1), Equipment.Console)
+
+    async def test_bring_too_many_equipment(self):
+        for _ in range(3):
+            await bring_equipment(await self.snapshot(), me, Equipment.Console)
+
+        with self.assertRaises(TooManyEquipmentError):
+            await bring_equipment(await self.snapshot(), me, Equipment.Console)
+
+
+class EquipmentSummary(SessionTestCase):
+    async def test_summary_follows_the_actions(self):
+        await bring_equipment(await self.snapshot(), me, Equipment.Console)
+        await join_session(await self.snapshot(), User.from_author(user(1), consoles=1, adapters=2))
+        await join_session(await self.snapshot(), User.from_author(user(2), screens=1))
+        await bring_equipment(await self.snapshot(), user(2), Equipment.Adapter)
+        await leave_session(await self.snapshot(), user(1))
+
+        expected = {'consoles': 1, 'screens': 1, 'adapters': 1}
+        self.assertEqual(expected, (await self.stored())['equipment'])
+        self.assertEqual(expected, Session.count_equipment(await self.stored()))
+        self.assertEqual(expected, (await self.snapshot()).equipment)
+
+    async def test_leave_after_equipment_changed_meanwhile(self):
+        await join_session(await self.snapshot(), user(1))
+        snapshot = await self.snapshot()
+        await bring_equipment(await self.snapshot(), user(1), Equipment.Screen)
+        await leave_session(snapshot, user(1))
+
+        self.assertEqual({'consoles': 0, 'screens': 0, 'adapters': 0}, (await self.stored())['equipment'])
+
+    async def test_equipment_overview(self):
+        await self.create(days=2, places=1)
+        await join_session(await self.snapshot(), User.from_author(user(1), consoles=2))
+
+        documents = await Session.get_future_sessions_equipment(db)
+        self.assertEqual([(2, 2), (0, 1)],
+                         [(document['equipment']['consoles'], document['nb_players']) for document in documents])
+
+    async def test_backfill_equipment(self):
+        await db['session'].update_one({'_id': self.session.id}, {'$unset': {'equipment': 1},
+                                                                  '$set': {'host.consoles': 2}})
+        await backfill_equipment([None])
+
+        self.assertEqual({'consoles': 2, 'screens': 0, 'adapters': 0}, (await self.stored())['equipment'])
+
+
+class Update(SessionTestCase):
+    async def test_update_session(self):
+        session = await self.snapshot()
+        await update_session(session, 5, "Quelque part", None)
+
+        self.assertEqual((5, "Quelque part", None), (session.places, session.address, session.comment))
+        stored = await self.stored()
+        self.assertEqual((5, "Quelque part", None), (stored['places'], stored['address'], stored['comment']))
+        self.assertEqual(5, (await self.snapshot()).places)
+
+
+class FromIndex(SessionTestCase):
+    async def test_from_index(self):
+        later = await self.create(days=2, places=1)
+        earlier = await self.create(days=0.5, places=1)
+
+        sessions = [await Session.from_index(db, n) for n in (1, 2, 3)]
+        self.assertEqual([earlier.id, self.session.id, later.id], [session.id for session in sessions])
+        self.assertEqual([1, 2, 3], [session.index for session in sessions])
+
+    async def test_from_index_skips_past_sessions(self):
+        await db['session'].insert_one({**(await self.stored()), '_id': ObjectId(),
+                                        'date_start': datetime.now() - timedelta(days=1)})
+        await upcoming_sessions.load(db)
+
+        self.assertEqual(self.session.id, (await Session.from_index(db, 1)).id)
+
+    async def test_from_index_out_of_range(self):
+        with self.assertRaises(IndexError):
+            await Session.from_index(db, 2)
+
+    async def test_from_index_negative(self):
+        with self.assertRaises(ValueError):
+            await Session.from_index(db, -1)
+
+    async def test_from_index_no_session(self):
+        await db['session'].delete_one({'_id': self.session.id})
+        upcoming_sessions.remove(self.session.id)
+
+        with self.assertRaises(NoSessionAvailableError):
+            await Session.from_index(db, 1)
+
+
+class Models(SessionTestCase):
+    async def test_changes_leave_cached_document_untouched(self):
+        await join_session(await self.snapshot(), user(1))
+        document = upcoming_sessions.peek(self.session.id)
+        session = Session(document, 1)
+        session.add_participant(user(2))
+        session.participants[0].add_equipment(Equipment.Console)
+        session.places = 10
+
+        self.assertEqual((2, 1, 10), (session.nb_participants, session.participants[0].consoles, session.places))
+        self.assertEqual(1, len(document['participants']))
+        self.assertEqual((0, 3), (document['participants'][0]['consoles'], document['places']))
+
+    async def test_user_input_is_checked(self):
+        with self.assertRaises(ValueError):
+            User.from_author(user(1), consoles=-1)
+        with self.assertRaises(TooManyEquipmentError):
+            User.from_author(user(1), adapters=4)
+
+
+class Rendering(SessionTestCase):
+    async def test_mutations_bump_version(self):
+        await join_session(await self.snapshot(), user(1))
+        await bring_equipment(await self.snapshot(), user(1), Equipment.Screen)
+        await update_session(await self.snapshot(), 4, None, None)
+        await leave_session(await self.snapshot(), user(1))
+
+        self.assertEqual(0, self.session.version)
+        self.assertEqual(4, (await self.snapshot()).version)
+        self.assertEqual(4, (await self.stored())['version'])
+
+    async def test_render_is_reused_until_the_session_changes(self):
+        embed, components = get_session_details_message(await self.snapshot())
+        self.assertIs(embed, get_session_details_message(await self.snapshot())[0])
+
+        session = await join_session(await self.snapshot(), user(1))
+        self.assertIsNot(embed, get_session_details_message(session)[0])
+        self.assertIs(components, get_session_details_message(session)[1])
+
+
+class LegacyCustomIds(SessionTestCase):
+    # Components of the messages sent before the custom ids carried the session id
+    def context(self, custom_id: str, selected_options: list[str] = None) -> SimpleNamespace:
+        return SimpleNamespace(author=user(1), custom_id=custom_id, selected_options=selected_options,
+                               origin_message=SimpleNamespace(embeds=[SimpleNamespace(title=self.session.title)]),
+                               origin_message_id=None, guild_id=None, send=AsyncMock(), edit_origin=AsyncMock())
+
+    async def test_button_finds_the_session_from_the_title(self):
+        await self.create(days=2, places=1)
+        ctx = self.context('btn_join_session_callback')
+        with patch.object(slash, 'invoke_component_callback', AsyncMock()) as invoke:
+            await on_component(ctx)
+        await btn_join_session_callback.invoke(ctx)
+
+        # The legacy custom id is dispatched by discord_slash itself, not routed a second time
+        invoke.assert_not_awaited()
+        self.assertTrue((await self.snapshot()).is_participant(user(1)))
+
+    async def test_option_finds_the_session_from_the_index(self):
+        later = await self.create(days=2, places=1)
+        ctx = self.context('dropdown_select_session_callback', selected_options=['2'])
+        await dropdown_select_session_callback.invoke(ctx)
+
+        embed = ctx.edit_origin.await_args.kwargs['embed']
+        self.assertEqual((await Session.from_id(db, later.id)).title, embed.title)
+
+
+class ConcurrentParticipants(SessionTestCase):
+    async def test_concurrent_joins_do_not_exceed_places(self):
+        snapshots = [await self.snapshot() for _ in range(10)]
+        results = await asyncio.gather(*[join_session(snapshot, user(n)) for n, snapshot in enumerate(snapshots)],
+                                       return_exceptions=True)
+
+        self.assertTrue(all(isinstance(result, Session) for result in results))
+        self.assertEqual(3, (await self.snapshot()).nb_participants)
+        self.assertEqual(7, len((await self.snapshot()).waitlist))
+
+    async def test_concurrent_joins_of_the_same_user(self):
+        snapshots = [await self.snapshot() for _ in range(5)]
+        results = await asyncio.gather(*[join_session(snapshot, user(1)) for snapshot in snapshots],
+                                       return_exceptions=True)
+
+        self.assertEqual(1, len([result for result in results if isinstance(result, Session)]))
+        self.assertEqual(4, len([result for result in results if isinstance(result, UserIsAlreadyParticipantError)]))
+        self.assertEqual(1, (await self.snapshot()).nb_participants)
+
+    async def test_concurrent_joins_and_leaves(self):
+        for n in range(3):
+            await join_session(await self.snapshot(), user(n))
+
+        snapshots = [await self.snapshot() for _ in range(6)]
+        await asyncio.gather(*[leave_session(snapshot, user(n)) for n, snapshot in enumerate(snapshots[:3])],
+                             *[join_session(snapshot, user(n + 3)) for n, snapshot in enumerate(snapshots[3:])],
+                             return_exceptions=True)
+
+        participants = [participant.id for participant in (await self.snapshot()).participants]
+        self.assertTrue(all(n not in participants for n in range(3)))
+        self.assertLessEqual(len(participants), 3)
+
+    async def test_concurrent_equipment_does_not_exceed_maximum(self):
+        await join_session(await self.snapshot(), user(1))
+
+        snapshots = [await self.snapshot() for _ in range(5)]
+        results = await asyncio.gather(*[bring_equipment(snapshot, user(1), Equipment.Console)
+                                         for snapshot in snapshots], return_exceptions=True)
+
+        self.assertEqual(3, len([result for result in results if isinstance(result, Session)]))
+        self.assertEqual(3, (await self.snapshot()).participants[0].consoles)
+
+
+class Instrumentation(SessionTestCase):
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.metrics = Metrics()
+        patcher = patch('metrics.metrics', self.metrics)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def context(author: User, custom_id: str = None) -> SimpleNamespace:
+        return SimpleNamespace(author=author, custom_id=custom_id, origin_message_id=None, guild_id=None,
+                               send=AsyncMock(), edit_origin=AsyncMock())
+
+    async def test_interactions_are_measured(self):
+        ctx = self.context(user(1), f'btn_join_session_callback:{self.session.id}')
+        await btn_join_session_callback.invoke(ctx)
+
+        self.assertEqual(1, self.metrics.interactions['btn_join_session_callback'])
+        self.assertEqual(1, self.metrics.operations['btn_join_session_callback'])
+        self.assertEqual(1, self.metrics.latencies[('btn_join_session_callback', 'db')].count)
+        ctx.edit_origin.assert_awaited_once()
+
+    async def test_errors_are_counted_by_class(self):
+        with self.assertRaises(UserIsAlreadyHostError):
+            await join.invoke(self.context(me), n=1)
+
+        self.assertEqual(1, self.metrics.errors[('join', 'UserIsAlreadyHostError')])
+        self.assertIn('smash_session_interaction_errors_total{interaction="join",exception="UserIsAlreadyHostError"} 1',
+                      self.metrics.render())
+
+    async def test_cache_reads_are_exported(self):
+        with patch('session_cache.metrics', self.metrics):
+            await Session.from_index(db, 1)
+
+        self.assertIn('smash_session_cache_reads_total{result="hit"} 1', self.metrics.render())
+        self.assertIn("session cache: 1 reads, 100.0% served from memory", self.metrics.summarize())
+
+
+class FakeComponentContext(ComponentContext):
+    def __init__(self, origin_message_id: int = None, defer_duration: float = 0.05):
+        self.origin_message_id = origin_message_id
+        self.defer_duration = defer_duration
+        self.responded = False
+        self.deferred = False
+        self.responses = []
+
+    async def defer(self, hidden: bool = False, edit_origin: bool = False, ignore: bool = False):
+        await asyncio.sleep(self.defer_duration)
+        self.deferred = True
+        self.responses.append('defer')
+
+    async def edit_origin(self, **fields):
+        self.deferred = False
+        self.responded = True
+        self.responses.append(('edit_origin', fields.get('content')) if fields else 'edit_origin')
+
+
+class FakeClickContext(FakeComponentContext):
+    def __init__(self, author: User, custom_id: str):
+        super().__init__(origin_message_id=1, defer_duration=0)
+        self.author = author
+        self.custom_id = custom_id
+        self.guild_id = None
+
+    async def send(self, content: str = None, **fields):
+        # The message of a deferred interaction without response is replaced by the content, instead of a follow-up
+        self.responses.append(('replace' if self.deferred else 'follow-up', content))
+
+
+class FakeSlashContext(SlashContext):
+    def __init__(self):
+        self.responded = False
+        self.deferred = False
+        self.responses = []
+
+    async def defer(self, hidden: bool = False):
+        await asyncio.sleep(0.05)
+        self.deferred = True
+        self.responses.append('defer')
+
+    async def send(self, content: str = None, **fields):
+        self.deferred = False
+        self.responded = True
+        self.responses.append(('send', content))
+
+
+class Deferring(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.slash = DeferringSlashCommand(Bot(command_prefix="!"), sync_commands=False, defer_after=0.02)
+
+    @staticmethod
+    def callback(duration: float) -> SimpleNamespace:
+        async def invoke(ctx):
+            await asyncio.sleep(duration)
+            await ctx.edit_origin(content="ok")
+        return SimpleNamespace(invoke=invoke)
+
+    async def test_fast_callback_is_not_deferred(self):
+        ctx = FakeComponentContext()
+        await self.slash.invoke_component_callback(self.callback(0), ctx)
+        await asyncio.sleep(0.05)
+
+        self.assertEqual([('edit_origin', 'ok')], ctx.responses)
+
+    async def test_slow_callback_is_deferred(self):
+        ctx = FakeComponentContext()
+        await self.slash.invoke_component_callback(self.callback(0.3), ctx)
+
+        self.assertEqual(['defer', ('edit_origin', 'ok')], ctx.responses)
+
+    async def test_slow_slash_command_is_deferred(self):
+        async def invoke(ctx):
+            await asyncio.sleep(0.3)
+            await ctx.send("ok")
+
+        ctx = FakeSlashContext()
+        await self.slash.invoke_command(SimpleNamespace(invoke=invoke), ctx, {})
+
+        self.assertEqual(['defer', ('send', 'ok')], ctx.responses)
+
+    async def test_response_waits_for_the_deferral_in_flight(self):
+        ctx = FakeComponentContext(defer_duration=0.2)
+        await self.slash.invoke_component_callback(self.callback(0.1), ctx)
+
+        self.assertEqual(['defer', ('edit_origin', 'ok')], ctx.responses)
+
+
+class Outbound(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.sent = []
+
+    def call(self, name: str, duration: float = 0):
+        async def send():
+            await asyncio.sleep(duration)
+            self.sent.append(name)
+            return name
+        return send
+
+    async def test_interactions_are_sent_before_background_work(self):
+        dispatcher = OutboundDispatcher(max_in_flight=1)
+        busy = asyncio.ensure_future(dispatcher.submit(self.call('busy', 0.1), INTERACTION))
+        await asyncio.sleep(0.01)
+        await asyncio.gather(dispatcher.submit(self.call('reminder'), BACKGROUND, ('channel', 1)),
+                             dispatcher.submit(self.call('edit'), EDIT, ('message', 1)),
+                             dispatcher.submit(self.call('response'), INTERACTION), busy)
+
+        self.assertEqual(['busy', 'response', 'edit', 'reminder'], self.sent)
+
+    async def test_saturated_route_does_not_hold_back_other_routes(self):
+        dispatcher = OutboundDispatcher()
+        held_back = [asyncio.ensure_future(dispatcher.submit(self.call(f'dm{n}'), BACKGROUND, ('channel', 1)))
+                     for n in range(6)]
+        await dispatcher.submit(self.call('other'), BACKGROUND, ('channel', 2))
+        await asyncio.sleep(0.1)
+
+        self.assertEqual({'dm0', 'dm1', 'dm2', 'dm3', 'dm4', 'other'}, set(self.sent))
+        self.assertFalse(held_back[5].done())
+        held_back[5].cancel()
+
+    async def test_queued_edits_of_a_message_are_merged(self):
+        dispatcher = OutboundDispatcher(max_in_flight=1)
+        waits = metrics.outbound_waits['edit'].count
+        busy = asyncio.ensure_future(dispatcher.submit(self.call('busy', 0.1), INTERACTION))
+        await asyncio.sleep(0.01)
+        results = await asyncio.gather(*[dispatcher.submit(self.call(f'edit{n}'), EDIT, ('message', 1), ('message', 1))
+                                         for n in range(3)], busy)
+
+        self.assertEqual(['busy', 'edit2'], self.sent)
+        self.assertEqual(['edit2'] * 3, results[:3])
+        self.assertEqual(waits + 1, metrics.outbound_waits['edit'].count)
+        self.assertEqual(0, metrics.outbound_depths['edit'])
+
+
+class Coalescing(unittest.IsolatedAsyncioTestCase):
+    async def test_clicks_during_the_window_are_coalesced(self):
+        edits = EditCoalescer(window=0.05)
+        contexts = [FakeComponentContext(origin_message_id=1, defer_duration=0) for _ in range(4)]
+        for n, ctx in enumerate(contexts):
+            await edits.edit_origin(ctx, n, content=str(n))
+        await asyncio.sleep(0.15)
+
+        self.assertEqual([[('edit_origin', '0')], ['defer'], ['defer'], ['defer', ('edit_origin', '3')]],
+                         [ctx.responses for ctx in contexts])
+
+    async def test_older_render_does_not_replace_newer(self):
+        edits = EditCoalescer(window=0.05)
+        contexts = [FakeComponentContext(origin_message_id=1, defer_duration=0) for _ in range(3)]
+        for version, ctx in zip((0, 2, 1), contexts):
+            await edits.edit_origin(ctx, version, content=str(version))
+        await asyncio.sleep(0.1)
+
+        self.assertEqual([[('edit_origin', '0')], ['defer', ('edit_origin', '2')], ['defer']],
+                         [ctx.responses for ctx in contexts])
+
+    async def test_immediate_edit_does_not_bring_back_an_older_render(self):
+        edits = EditCoalescer(window=0.5)
+        contexts = [FakeComponentContext(origin_message_id=1, defer_duration=0) for _ in range(2)]
+        await edits.edit_origin(contexts[0], 6, content='v6')
+        await edits.edit_origin_now(contexts[1], 5, content='v5')
+
+        self.assertEqual([[('edit_origin', 'v6')], [('edit_origin', 'v6')]], [ctx.responses for ctx in contexts])
+
+    async def test_messages_are_edited_independently(self):
+        edits = EditCoalescer(window=0.05)
+        contexts = [FakeComponentContext(origin_message_id=n, defer_duration=0) for n in range(2)]
+        for ctx in contexts:
+            await edits.edit_origin(ctx, 0, content="ok")
+
+        self.assertEqual([[('edit_origin', 'ok')]] * 2, [ctx.responses for ctx in contexts])
+
+
+class Archiver(SessionTestCase):
+    async def insert_finished(self, hours: float) -> ObjectId:
+        result = await db['session'].insert_one({**(await self.stored()), '_id': ObjectId(),
+                                                 'date_start': datetime.now() - timedelta(hours=hours + 4),
+                                                 'date_end': datetime.now() - timedelta(hours=hours)})
+        return result.inserted_id
+
+    @staticmethod
+    async def ids(collection: str) -> set:
+        return {document['_id'] for document in await db[collection].find().to_list(length=None)}
+
+    async def test_finished_sessions_are_archived_in_batches(self):
+        finished = [await self.insert_finished(hours) for hours in range(1, 6)]
+        ongoing = await self.insert_finished(-1)
+
+        self.assertEqual(5, await SessionArchiver(batch_size=2).archive(db))
+        self.assertEqual({self.session.id, ongoing}, await self.ids('session'))
+        self.assertEqual(set(finished), await self.ids('session_archive'))
+
+    async def test_interrupted_archival_is_resumed(self):
+        session_id = await self.insert_finished(1)
+        await db['session_archive'].insert_one(await db['session'].find_one({'_id': session_id}))
+
+        self.assertEqual(1, await SessionArchiver().archive(db))
+        self.assertIsNone(await db['session'].find_one({'_id': session_id}))
+        self.assertEqual(1, await db['session_archive'].count_documents({}))
+
+
+class Reminders(SessionTestCase):
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        for n in range(3):
+            await join_session(await self.snapshot(), user(n))
+        self.send = AsyncMock()
+
+    async def run_scheduler(self, scheduler: ReminderScheduler, duration: float = 0.2):
+        task = asyncio.ensure_future(scheduler.run(db, self.send))
+        await asyncio.sleep(duration)
+        task.cancel()
+
+    async def test_due_reminder_is_sent_to_every_member_in_batches(self):
+        scheduler = ReminderScheduler(hours=48, batch_size=3, batch_delay=0)
+        await scheduler.load(db)
+        later = await self.create(days=3, places=1)
+        scheduler.schedule(upcoming_sessions.peek(later.id))
+        await self.run_scheduler(scheduler)
+
+        self.assertEqual([me.id, 0, 1, 2], [call.args[0] for call in self.send.await_args_list])
+        self.assertTrue((await self.stored())['reminded'])
+        self.assertEqual(1, scheduler.nb_scheduled)
+
+    async def test_reminder_without_address_asks_for_it(self):
+        await ReminderScheduler(hours=48).remind(db, self.session.id, self.send)
+
+        self.assertTrue(self.send.await_args.args[1].endswith("Adresse : Demande ultérieurement en message privé !"))
+
+    async def test_reminder_is_not_sent_twice_after_a_restart(self):
+        scheduler = ReminderScheduler(hours=48)
+        await scheduler.load(db)
+        await scheduler.remind(db, self.session.id, self.send)
+
+        restarted = ReminderScheduler(hours=48)
+        await restarted.load(db)
+        await restarted.remind(db, self.session.id, self.send)
+
+        self.assertEqual(0, restarted.nb_scheduled)
+        self.assertEqual(4, self.send.await_count)
+
+    async def test_unscheduled_reminder_is_not_sent(self):
+        scheduler = ReminderScheduler(hours=48)
+        await scheduler.load(db)
+        scheduler.unschedule(self.session.id)
+        await self.run_scheduler(scheduler)
+
+        self.send.assert_not_awaited()
+
+
+class Cache(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.db = AsyncMongoMockClient()['test']
+        self.cache = SessionCache(ttl=60)
+        await self.cache.load(self.db)
+
+    @staticmethod
+    def document(hours: float) -> dict:
+        return {'_id': ObjectId(), 'date_start': datetime.now() + timedelta(hours=hours)}
+
+    async def test_put_keeps_chronological_order(self):
+        documents = [self.document(hours) for hours in (3, 1, 2)]
+        for document in documents:
+            self.cache.put(document)
+
+        self.assertEqual([documents[1], documents[2], documents[0]], await self.cache.get_all(self.db))
+        self.assertEqual((documents[0], 3), await self.cache.get(self.db, documents[0]['_id']))
+
+    async def test_started_sessions_are_evicted(self):
+        document = self.document(0.0001)
+        self.cache.put(document)
+        await asyncio.sleep(0.5)
+
+        with self.assertRaises(KeyError):
+            await self.cache.get(self.db, document['_id'])
+
+    async def test_reads_are_served_from_memory(self):
+        self.cache.put(self.document(1))
+        for _ in range(10):
+            await self.cache.get_nth(self.db, 1)
+
+        self.assertEqual((10, 0), (self.cache.hits, self.cache.misses))
+
+    async def test_writes_during_a_load_are_kept(self):
+        stale, created = self.document(1), self.document(2)
+        queried = asyncio.Event()
+
+        class SlowCursor:
+            def sort(self, keys: list) -> 'SlowCursor':
+                return self
+
+            async def to_list(self, length: int) -> list[dict]:
+                # The result is read before the writes below
+                await queried.wait()
+                return [stale]
+
+        load = asyncio.ensure_future(self.cache.load({'session': SimpleNamespace(find=lambda query: SlowCursor())}))
+        await asyncio.sleep(0)
+        self.cache.put(created)
+        self.cache.remove(stale['_id'])
+        queried.set()
+        await load
+
+        self.assertEqual([created], await self.cache.get_all(self.db))
+
+
+class Watcher(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.db = AsyncMongoMockClient()['test']
+        self.cache = SessionCache(ttl=60)
+        await self.cache.load(self.db)
+        self.watcher = SessionWatcher(self.cache)
+        self.document = {'_id': ObjectId(), 'date_start': datetime.now() + timedelta(days=1), 'places': 2,
+                         'participants': [{'id': 1, 'consoles': 0}]}
+        self.watcher.apply({'operationType': 'insert', 'fullDocument': self.document})
+
+    async def test_update_patches_cached_document(self):
+        self.watcher.apply({'operationType': 'update', 'documentKey': {'_id': self.document['_id']},
+                            'updateDescription': {'updatedFields': {'places': 3, 'participants.0.consoles': 1,
+                                                                    'participants.1': {'id': 2, 'consoles': 0}},
+                                                  'removedFields': []}})
+
+        document, _ = await self.cache.get(self.db, self.document['_id'])
+        self.assertEqual(3, document['places'])
+        self.assertEqual([{'id': 1, 'consoles': 1}, {'id': 2, 'consoles': 0}], document['participants'])
+        self.assertEqual([{'id': 1, 'consoles': 0}], self.document['participants'])
+
+    async def test_delete_removes_cached_document(self):
+        self.watcher.apply({'operationType': 'delete', 'documentKey': {'_id': self.document['_id']}})
+
+        self.assertEqual([], await self.cache.get_all(self.db))
+
+    async def run_watcher(self, change: dict = None, exception: Exception = None) -> (list, AsyncMock):
+        streams = []
+
+        class FakeChangeStream:
+            resume_token = None
+
+            async def __aenter__(self):
+                return self
+
+            async def __aexit__(self, *exception):
+                pass
+
+            async def __aiter__(self):
+                if exception is not None:
+                    raise exception
+                yield change
+
+        def watch(resume_after=None):
+            streams.append(FakeChangeStream())
+            return streams[-1]
+
+        db = {'session': SimpleNamespace(watch=watch)}
+        with patch('session_watcher.RETRY_DELAY', 0), patch.object(self.watcher, 'poll') as poll, \
+                self.assertLogs('session_watcher'):
+            task = asyncio.ensure_future(self.watcher.run(db))
+            await asyncio.sleep(0.05)
+            task.cancel()
+        return streams, poll
+
+    async def test_change_failing_to_apply_restarts_the_stream(self):
+        # An update event without its document key
+        streams, poll = await self.run_watcher(change={'operationType': 'update'})
+
+        poll.assert_not_called()
+        self.assertGreater(len(streams), 1)
+        self.assertEqual([], self.cache.guild_ids)
+
+    async def test_lost_stream_restarts_the_stream(self):
+        streams, poll = await self.run_watcher(exception=OperationFailure("Resume token not found", 286))
+
+        poll.assert_not_called()
+        self.assertGreater(len(streams), 1)
+        self.assertEqual([], self.cache.guild_ids)
+
+    async def test_standalone_server_falls_back_to_polling(self):
+        streams, poll = await self.run_watcher(exception=OperationFailure("Not a replica set", 40573))
+
+        poll.assert_awaited_once()
+        self.assertEqual(1, len(streams))
 
 
 if __name__ == '__main__':
@@ -15,34 +15,40 @@ from exceptions import TooManyEquipmentError
 MAX_CONSOLES = 3
 MAX_SCREENS = 3
 MAX_ADAPTERS = 3
+EQUIPMENT_FIELDS = {
+    Equipment.Console: ('consoles', MAX_CONSOLES),
+    Equipment.Screen: ('screens', MAX_SCREENS),
+    Equipment.Adapter: ('adapters', MAX_ADAPTERS)
+}
+SWITCH_EMOJI = '<:switch:801390051463397386>'
+SCREEN_EMOJI = '<:screen:801390701958791189>'
+ADAPTER_EMOJI = '<:gc:885488021355495444>'
 
 class User:
+    # Users wrap the documents of the sessions, which are shared with the session cache: they are never changed in place
+    __slots__ = ('_data',)
+
     ##################
     #  CONSTRUCTORS  #
     ##################
     def __init__(self, data: dict):
         """
-        Instantiate a User object.
+        Instantiate a User object. The user data is used as is, it is only checked when it changes.
 
         :param data: The user data retrieved from the database.
         """
-        self._id = data['id']
-        self._name = data['name']
-        self._discriminator = data['discriminator']
-        self._consoles = data['consoles']
-        self._screens = data['screens']
-        self._adapters = data['adapters']
+        self._data = data
 
+    @classmethod
+    def from_author(cls, author: discord.user.User, consoles: int = 0, screens: int = 0, adapters: int = 0):
         # Check if any equipment is negative
-        if self._consoles < 0 or self._screens < 0 or self._adapters < 0:
+        if consoles < 0 or screens < 0 or adapters < 0:
             raise ValueError("Tu ne peux pas apporter un nombre négatif d'équipement... :sweat_smile:")
 
         # Check if any equipment is too high
-        if self._consoles > MAX_CONSOLES or self._screens > MAX_SCREENS or self._adapters > MAX_ADAPTERS:
+        if consoles > MAX_CONSOLES or screens > MAX_SCREENS or adapters > MAX_ADAPTERS:
             raise TooManyEquipmentError()
 
-    @classmethod
-    def from_author(cls, author: discord.user.User, consoles: int = 0, screens: int = 0, adapters: int = 0):
         return cls({
             'id': author.id,
             'name': author.name,
@@ -61,18 +67,10 @@ class User:
 
         :param equipment: The kind of equipment to be incremented.
         """
-        if equipment == Equipment.Console:
-            if self._consoles + 1 > MAX_CONSOLES:
-                raise TooManyEquipmentError()
-            self._consoles += 1
-        elif equipment == Equipment.Screen:
-            if self._screens + 1 > MAX_SCREENS:
-                raise TooManyEquipmentError()
-            self._screens += 1
-        elif equipment == Equipment.Adapter:
-            if self._adapters + 1 > MAX_ADAPTERS:
-                raise TooManyEquipmentError()
-            self._adapters += 1
+        field, maximum = EQUIPMENT_FIELDS[equipment]
+        if self._data[field] + 1 > maximum:
+            raise TooManyEquipmentError()
+        self._data = {**self._data, field: self._data[field] + 1}
 
     ################
     #  PROPERTIES  #
@@ -84,14 +82,7 @@ class User:
 
         :return: The data attribute.
         """
-        return {
-            'id': self._id,
-            'name': self._name,
-            'discriminator': self._discriminator,
-            'consoles': self._consoles,
-            'screens': self._screens,
-            'adapters': self._adapters
-        }
+        return self._data
 
     @property
     def id(self) -> int:
@@ -100,7 +91,7 @@ class User:
 
         :return: The id attribute.
         """
-        return self._id
+        return self._data['id']
 
     @property
     def name(self) -> str:
@@ -109,7 +100,7 @@ class User:
 
         :return: The name attribute.
         """
-        return self._name
+        return self._data['name']
 
     @property
     def discriminator(self) -> str:
@@ -118,7 +109,7 @@ class User:
 
         :return: The discriminator attribute.
         """
-        return self._discriminator
+        return self._data['discriminator']
 
     @property
     def consoles(self) -> int:
@@ -127,7 +118,7 @@ class User:
 
         :return: The consoles attribute.
         """
-        return self._consoles
+        return self._data['consoles']
 
     @property
     def screens(self) -> int:
@@ -136,7 +127,7 @@ class User:
 
         :return: The screens attribute.
         """
-        return self._screens
+        return self._data['screens']
 
     @property
     def adapters(self) -> int:
@@ -145,7 +136,7 @@ class User:
 
         :return: The adapters attribute.
         """
-        return self._adapters
+        return self._data['adapters']
 
     @property
     def details(self) -> str:
@@ -154,11 +145,11 @@ class User:
 
         :return: A string representing the user details.
         """
-        user_str = f"<@{self._id}> "
-        for _ in range(self._consoles):
-            user_str += f"<:switch:801390051463397386> "
-        for _ in range(self._screens):
-            user_str += f"<:screen:801390701958791189> "
-        for _ in range(self._adapters):
-            user_str += f"<:gc:885488021355495444> "
+        user_str = f"<@{self.id}> "
+        for _ in range(self.consoles):
+            user_str += f"{SWITCH_EMOJI} "
+        for _ in range(self.screens):
+            user_str += f"{SCREEN_EMOJI} "
+        for _ in range(self.adapters):
+            user_str += f"{ADAPTER_EMOJI} "
         return user_str